@@ -0,0 +1,557 @@
+"""Tracker and transfer benchmark with a simulated fleet of peers.
+
+Starts the tracker in a child process on a temporary database and runs
+two phases against it over localhost:
+
+* ``tracker``: --peers simulated peers, spread over --workers processes,
+  register, log in and share a synthetic catalog, then each replays a
+  closed loop of heartbeat / search / files / share requests in the
+  proportions given by --mix for --duration seconds.
+* ``transfers``: --seeders headless peers (engine.PeerEngine, each in
+  its own process and directory) share files of each of --sizes MB, and
+  another engine downloads every file --repeat times, from one seeder
+  and as a swarm from all of them.
+
+Results are one JSON document: per-operation throughput and latency
+percentiles, transfer speeds, and the CPU time and peak RSS of the
+tracker and the seeders, along with the commit they were measured on.
+
+    python bench_fleet.py --peers 50 --duration 20 --output after.json
+    python bench_fleet.py --compare before.json after.json
+
+The tracker is started the way ``server.py`` starts it, on Flask's
+development server, but with per-request logging turned off.  With
+--tracker-workers it runs under ``serve.py`` instead, with that many
+worker processes; its CPU and RSS are then summed over all of them.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import requests
+
+from bench_search import random_filename
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(BENCH_DIR, '..', 'server')
+CLIENT_DIR = os.path.join(BENCH_DIR, '..', 'client')
+sys.path.insert(0, CLIENT_DIR)
+from download_queue import DONE, FAILED  # noqa: E402
+from engine import PeerEngine  # noqa: E402
+
+DEFAULT_MIX = 'heartbeat=70,search=15,files=5,share=10'
+SEARCH_TERMS = ['build', 'report', 'final', 'dataset', 'photo', 'log', 'archive', 'zzzz']
+PASSWORD = 'bench'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+def read_proc(pid):
+    """(CPU seconds, RSS bytes) of a process, or None where /proc is unavailable"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            rss_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return ((int(fields[11]) + int(fields[12])) / ticks,
+            rss_pages * os.sysconf('SC_PAGE_SIZE'))
+
+
+class ProcessSampler:
+    """Samples CPU time and RSS of processes while a phase runs"""
+
+    def __init__(self, pids, interval=0.2):
+        self.pids = pids
+        self.interval = interval
+        self._stop = threading.Event()
+        self._start = {pid: read_proc(pid) for pid in pids}
+        self._peak = {pid: 0 for pid in pids}
+        self._last = dict(self._start)
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        for pid in self.pids:
+            usage = read_proc(pid)
+            if usage:
+                self._last[pid] = usage
+                self._peak[pid] = max(self._peak[pid], usage[1])
+
+    def stop(self):
+        """Per-process {'cpu_seconds', 'cpu_percent', 'rss_peak_mb'} over the phase"""
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        elapsed = time.perf_counter() - self._started
+        results = []
+        for pid in self.pids:
+            if not self._start[pid] or not self._last[pid]:
+                results.append(None)
+                continue
+            cpu = self._last[pid][0] - self._start[pid][0]
+            results.append({'cpu_seconds': round(cpu, 3),
+                            'cpu_percent': round(cpu / elapsed * 100, 1),
+                            'rss_peak_mb': round(self._peak[pid] / 1024 ** 2, 1)})
+        return results
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3)
+    return {'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99), 'max_ms': at(1.0)}
+
+
+# Tracker
+
+def run_tracker(workdir, port):
+    """Child process: the tracker, started as server.py's __main__ does"""
+    os.chdir(workdir)
+    sys.stdout = sys.stderr
+    sys.path.insert(0, SERVER_DIR)
+    import server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server.init_db()
+    threading.Thread(target=server.cleanup_inactive_peers, daemon=True).start()
+    threading.Thread(target=server.liveness.run_flusher, args=(server.db,), daemon=True).start()
+    server.app.run(host='127.0.0.1', port=port, threaded=True)
+
+
+def start_tracker(workdir, port, workers):
+    """Start the tracker: server.py's way if workers is 0, else serve.py's"""
+    if not workers:
+        tracker = multiprocessing.Process(target=run_tracker, args=(workdir, port))
+        tracker.start()
+        return tracker
+    return subprocess.Popen(
+        [sys.executable, os.path.join(SERVER_DIR, 'serve.py'), '--host', '127.0.0.1',
+         '--port', str(port), '--workers', str(workers), '--quiet'],
+        cwd=workdir, stdout=sys.stderr)
+
+
+def stop_tracker(tracker):
+    tracker.terminate()
+    if isinstance(tracker, subprocess.Popen):
+        tracker.wait()
+    else:
+        tracker.join()
+
+
+def process_tree(pid):
+    """pid and its children, where /proc lists them"""
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [pid] + [int(child) for child in f.read().split()]
+    except OSError:
+        return [pid]
+
+
+def total_usage(usages):
+    usages = [usage for usage in usages if usage]
+    if not usages:
+        return None
+    return {key: round(sum(usage[key] for usage in usages), 3) for key in usages[0]}
+
+
+class SimulatedPeer:
+    """One peer's tracker traffic; it never actually serves files"""
+
+    def __init__(self, base_url, name, port, files_per_peer, rng):
+        self.base_url = base_url
+        self.name = name
+        self.port = port
+        self.rng = rng
+        self.session = requests.Session()
+        self.files = [random_filename(rng) for _ in range(files_per_peer)]
+        self.version = None
+        self.etag = None
+        self.identity = {'username': name, 'ip': '127.0.0.1', 'port': port}
+
+    def post(self, path, data):
+        response = self.session.post(f"{self.base_url}{path}", json=data)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path}: HTTP {response.status_code}")
+        return response.json()
+
+    def register(self):
+        self.post('/register', dict(self.identity, password=PASSWORD))
+
+    def login(self):
+        self.post('/login', dict(self.identity, password=PASSWORD))
+
+    def share_files(self):
+        body = self.post('/share_files', {'username': self.name, 'filename': self.files,
+                                          'peer_ip': '127.0.0.1', 'peer_port': self.port})
+        self.version = body.get('version')
+
+    def heartbeat(self):
+        self.post('/heartbeat', self.identity)
+
+    def search(self):
+        response = self.session.get(f"{self.base_url}/search_files",
+                                    params={'filename': self.rng.choice(SEARCH_TERMS),
+                                            'limit': 100})
+        if response.status_code != 200:
+            raise RuntimeError(f"/search_files: HTTP {response.status_code}")
+
+    def list_files(self):
+        # First page only, revalidated like the client's refresh
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        response = self.session.get(f"{self.base_url}/files", params={'limit': 1000},
+                                    headers=headers)
+        if response.status_code not in (200, 304):
+            raise RuntimeError(f"/files: HTTP {response.status_code}")
+        self.etag = response.headers.get('ETag', self.etag)
+
+    def share(self):
+        """Swap one shared file for a new one, as a delta"""
+        removed = self.files.pop(self.rng.randrange(len(self.files)))
+        added = random_filename(self.rng)
+        self.files.append(added)
+        response = self.session.post(f"{self.base_url}/share_files_delta", json={
+            'username': self.name, 'base_version': self.version, 'added': [added],
+            'removed': [removed], 'peer_ip': '127.0.0.1', 'peer_port': self.port})
+        if response.status_code == 409:
+            self.share_files()
+        elif response.status_code != 200:
+            raise RuntimeError(f"/share_files_delta: HTTP {response.status_code}")
+        else:
+            self.version = response.json().get('version')
+
+
+def timed(latencies, errors, op, func):
+    start = time.perf_counter()
+    try:
+        func()
+    except Exception:
+        errors[op] = errors.get(op, 0) + 1
+        return
+    latencies.setdefault(op, []).append(time.perf_counter() - start)
+
+
+def run_fleet_worker(base_url, names, args, start_at, results):
+    """Child process: simulate some of the peers and report their latencies"""
+    mix = parse_mix(args['mix'])
+    ops, weights = list(mix), list(mix.values())
+    # op -> latencies and op -> error count, for setup and for the timed mix
+    setup_latencies, setup_errors, latencies, errors = {}, {}, {}, {}
+    lock = threading.Lock()
+
+    def simulate(index, name):
+        rng = random.Random(f"{args['seed']}-{name}")
+        peer = SimulatedPeer(base_url, name, 20000 + index, args['files_per_peer'], rng)
+        mine_setup, my_setup_errors, mine, my_errors = {}, {}, {}, {}
+        for op in ('register', 'login', 'share_files'):
+            timed(mine_setup, my_setup_errors, op, getattr(peer, op))
+        time.sleep(max(0.0, start_at - time.time()))
+        actions = {'heartbeat': peer.heartbeat, 'search': peer.search,
+                   'files': peer.list_files, 'share': peer.share}
+        end = start_at + args['duration']
+        while time.time() < end:
+            op = rng.choices(ops, weights)[0]
+            timed(mine, my_errors, op, actions[op])
+            if args['think_ms']:
+                time.sleep(args['think_ms'] / 1000)
+        with lock:
+            merge((setup_latencies, setup_errors, latencies, errors),
+                  (mine_setup, my_setup_errors, mine, my_errors))
+
+    threads = [threading.Thread(target=simulate, args=(int(name[4:]), name)) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.send((setup_latencies, setup_errors, latencies, errors))
+
+
+def merge(totals, part):
+    """Add part's (latencies, errors, ...) dicts into totals"""
+    for total, source in zip(totals, part):
+        for op, value in source.items():
+            if isinstance(value, list):
+                total.setdefault(op, []).extend(value)
+            else:
+                total[op] = total.get(op, 0) + value
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        op, weight = part.split('=')
+        if op not in ('heartbeat', 'search', 'files', 'share'):
+            raise ValueError(f"Unknown operation in mix: {op}")
+        mix[op] = float(weight)
+    return mix
+
+
+def summarize_ops(latencies, errors, seconds):
+    summary = {}
+    for op in sorted(set(latencies) | set(errors)):
+        values = latencies.get(op, [])
+        summary[op] = dict({'count': len(values), 'errors': errors.get(op, 0),
+                            'ops_per_sec': round(len(values) / seconds, 1) if seconds else None},
+                           **percentiles(values))
+    return summary
+
+
+def bench_tracker(base_url, tracker_pid, args):
+    names = [f"peer{i}" for i in range(args.peers)]
+    workers = max(1, min(args.workers, args.peers))
+    # Setup (registering and sharing every peer) has to finish before the timed mix
+    start_at = time.time() + args.setup_seconds
+    settings = {'mix': args.mix, 'duration': args.duration, 'think_ms': args.think_ms,
+                'files_per_peer': args.files_per_peer, 'seed': args.seed}
+    processes, pipes = [], []
+    for index in range(workers):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_fleet_worker, args=(
+            base_url, names[index::workers], settings, start_at, sender))
+        process.start()
+        processes.append(process)
+        pipes.append(receiver)
+
+    time.sleep(max(0.0, start_at - time.time()))
+    sampler = ProcessSampler(process_tree(tracker_pid))
+    setup_latencies, setup_errors, latencies, errors = {}, {}, {}, {}
+    for receiver in pipes:
+        merge((setup_latencies, setup_errors, latencies, errors), receiver.recv())
+    tracker_usage = total_usage(sampler.stop())
+    for process in processes:
+        process.join()
+
+    ops = summarize_ops(latencies, errors, args.duration)
+    return {
+        'peers': args.peers,
+        'workers': workers,
+        'duration': args.duration,
+        'mix': parse_mix(args.mix),
+        'setup': summarize_ops(setup_latencies, setup_errors, None),
+        'ops': ops,
+        'total_ops_per_sec': round(sum(op['count'] for op in ops.values()) / args.duration, 1),
+        'tracker_process': tracker_usage,
+    }
+
+
+# Transfers
+
+def run_seeder(workdir, base_url, name, ready, stop):
+    """Child process: a headless peer sharing everything in workdir/shared_files"""
+    os.chdir(workdir)
+    sys.stdout = sys.stderr
+    engine = PeerEngine(base_url, ip='127.0.0.1')
+    engine.register(name, PASSWORD)
+    engine.login(name, PASSWORD)
+    wait_for_port(engine.listening_port)
+    ready.send(engine.listening_port)
+    stop.recv()
+    engine.shutdown()
+
+
+def download(engine, filename, peer_port, digest, swarm):
+    """Seconds to download filename through the engine's queue"""
+    for leftover in ('downloads/' + filename, 'downloads/' + filename + '.part',
+                     'downloads/' + filename + '.part.state'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    start = time.perf_counter()
+    job = engine.download(filename, '127.0.0.1', peer_port, digest, swarm=swarm)
+    while job.state not in (DONE, FAILED):
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    if job.state == FAILED:
+        raise RuntimeError(f"Download of {filename} failed: {job.error}")
+    return elapsed
+
+
+def bench_transfers(base_url, root, args):
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    seed_dirs = [os.path.join(root, f'seeder{i}') for i in range(args.seeders)]
+    for seed_dir in seed_dirs:
+        os.makedirs(os.path.join(seed_dir, 'shared_files'))
+    for size in sizes:
+        first = os.path.join(seed_dirs[0], 'shared_files', f'payload_{size}mb.bin')
+        with open(first, 'wb') as f:
+            for _ in range(size):
+                f.write(os.urandom(1024 * 1024))
+        for seed_dir in seed_dirs[1:]:
+            shutil.copyfile(first, os.path.join(seed_dir, 'shared_files', os.path.basename(first)))
+
+    seeders = []
+    for index, seed_dir in enumerate(seed_dirs):
+        ready_recv, ready_send = multiprocessing.Pipe(duplex=False)
+        stop_recv, stop_send = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_seeder, args=(
+            seed_dir, base_url, f'seeder{index}', ready_send, stop_recv))
+        process.start()
+        seeders.append((process, ready_recv.recv(), stop_send))
+
+    leech_dir = os.path.join(root, 'leecher')
+    os.makedirs(leech_dir)
+    cwd = os.getcwd()
+    os.chdir(leech_dir)
+    engine = PeerEngine(base_url, ip='127.0.0.1')
+    results = []
+    try:
+        engine.register('leecher', PASSWORD)
+        engine.login('leecher', PASSWORD)
+        modes = ['single'] + (['swarm'] if args.seeders > 1 else [])
+        sampler = ProcessSampler([process.pid for process, _, _ in seeders])
+        for size in sizes:
+            filename = f'payload_{size}mb.bin'
+            digest = next(file[5] for file in engine.search_files(filename=filename)
+                          if file[0] == filename)
+            for mode in modes:
+                timings = [download(engine, filename, seeders[0][1], digest, mode == 'swarm')
+                           for _ in range(args.repeat)]
+                median = sorted(timings)[len(timings) // 2]
+                results.append({'size_mb': size, 'mode': mode, 'repeat': args.repeat,
+                                'seconds_p50': round(median, 4),
+                                'seconds_min': round(min(timings), 4),
+                                'mb_per_sec': round(size / median, 1)})
+        seeder_usage = sampler.stop()
+    finally:
+        engine.shutdown()
+        os.chdir(cwd)
+        for process, _, stop in seeders:
+            stop.send(True)
+            process.join()
+    return {'seeders': args.seeders, 'results': results, 'seeder_processes': seeder_usage}
+
+
+# Reporting
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def change(before, after):
+    if not before or after is None:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before['meta']['commit']} -> {after['meta']['commit']}")
+    old_ops = (before.get('tracker') or {}).get('ops', {})
+    for op, new in (after.get('tracker') or {}).get('ops', {}).items():
+        old = old_ops.get(op, {})
+        print(f"{op:>10}: {new['ops_per_sec']:9.1f} ops/s ({change(old.get('ops_per_sec'), new['ops_per_sec'])})"
+              f"  p50 {new.get('p50_ms', 0):8.2f} ms ({change(old.get('p50_ms'), new.get('p50_ms'))})"
+              f"  p99 {new.get('p99_ms', 0):8.2f} ms ({change(old.get('p99_ms'), new.get('p99_ms'))})")
+    old_transfers = {(r['size_mb'], r['mode']): r
+                     for r in (before.get('transfers') or {}).get('results', [])}
+    for new in (after.get('transfers') or {}).get('results', []):
+        old = old_transfers.get((new['size_mb'], new['mode']), {})
+        print(f"{new['size_mb']:>6} MB {new['mode']:>6}: {new['mb_per_sec']:8.1f} MB/s "
+              f"({change(old.get('mb_per_sec'), new['mb_per_sec'])})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--phases', default='tracker,transfers')
+    parser.add_argument('--peers', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=2, help="Load generating processes")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds of mixed tracker load")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Relative weights of tracker operations")
+    parser.add_argument('--think-ms', type=float, default=0, help="Pause between a peer's requests")
+    parser.add_argument('--files-per-peer', type=int, default=20)
+    parser.add_argument('--setup-seconds', type=float, default=10,
+                        help="Time allowed for every peer to register and share before the mix")
+    parser.add_argument('--sizes', default='1,16,128', help="Transfer sizes in MB")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seeders', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tracker-workers', type=int, default=0,
+                        help="Run the tracker under serve.py with this many workers")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="Compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    phases = set(args.phases.split(','))
+    results = {'meta': {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key != 'compare'},
+    }}
+
+    with tempfile.TemporaryDirectory() as root, redirect_stdout(sys.stderr):
+        tracker_dir = os.path.join(root, 'tracker')
+        os.makedirs(tracker_dir)
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        tracker = start_tracker(tracker_dir, port, args.tracker_workers)
+        try:
+            wait_for_port(port)
+            if 'tracker' in phases:
+                results['tracker'] = bench_tracker(base_url, tracker.pid, args)
+            if 'transfers' in phases:
+                results['transfers'] = bench_transfers(base_url, root, args)
+        finally:
+            stop_tracker(tracker)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
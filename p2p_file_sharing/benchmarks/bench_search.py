@@ -0,0 +1,98 @@
+"""Filename search benchmark: FTS5 index against the LIKE '%term%' scan.
+
+Builds a synthetic catalog in a temporary tracker database (one million
+files by default, spread over a few thousand live peers) and times both
+search paths of the tracker's /files query for a set of search terms:
+
+    python bench_search.py --rows 1000000 --repeat 5
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server')
+
+WORDS = ['build', 'release', 'report', 'backup', 'photo', 'video', 'dataset', 'log',
+         'invoice', 'draft', 'final', 'archive', 'music', 'scan', 'export', 'notes']
+EXTENSIONS = ['tar.gz', 'zip', 'pdf', 'csv', 'jpg', 'mp4', 'txt', 'iso', 'log']
+TERMS = ['build', 'rep', 'final report', 'dataset 2019', 'zzzz', 'mp4']
+
+
+def random_filename(rng):
+    words = rng.sample(WORDS, rng.randint(1, 3))
+    return f"{'_'.join(words)}_{rng.randint(2000, 2030)}_{rng.randint(0, 99999)}.{rng.choice(EXTENSIONS)}"
+
+
+def populate(server, rows, peers, seed=1):
+    rng = random.Random(seed)
+    conn = server.db.acquire()
+    now = datetime.now()
+    conn.executemany('INSERT INTO peers (username, password, ip, port, last_heartbeat) VALUES (?, ?, ?, ?, ?)',
+                     [(f"peer{i}", 'x', '10.0.0.1', 6000 + i % 1000, now) for i in range(peers)])
+    batch = []
+    for i in range(rows):
+        batch.append((random_filename(rng), f"peer{i % peers}", '10.0.0.1', 6000))
+        if len(batch) == 50000:
+            conn.executemany('INSERT INTO files (filename, username, peer_ip, peer_port) VALUES (?, ?, ?, ?)', batch)
+            batch = []
+    if batch:
+        conn.executemany('INSERT INTO files (filename, username, peer_ip, peer_port) VALUES (?, ?, ?, ?)', batch)
+    conn.commit()
+    server.db.release(conn)
+
+
+def time_query(server, term, like, repeat):
+    conn = server.db.acquire()
+    try:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = conn.execute(*server.build_files_query(term, '', '', like)).fetchall()
+            timings.append(time.perf_counter() - start)
+        return len(rows), sorted(timings)[len(timings) // 2]
+    finally:
+        server.db.release(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--peers', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help="Print one JSON object per result")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The tracker opens p2p.db relative to the working directory
+        os.chdir(tmp)
+        sys.path.insert(0, SERVER_DIR)
+        import server
+
+        server.init_db()
+        start = time.perf_counter()
+        populate(server, args.rows, args.peers)
+        print(f"Populated {args.rows} files (FTS index kept in sync by triggers) "
+              f"in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+        for term in TERMS:
+            like_rows, like_time = time_query(server, term, True, args.repeat)
+            fts_rows, fts_time = time_query(server, term, False, args.repeat)
+            result = {'term': term, 'rows': args.rows,
+                      'like_ms': round(like_time * 1000, 2), 'like_matches': like_rows,
+                      'fts_ms': round(fts_time * 1000, 2), 'fts_matches': fts_rows}
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{term!r:>16}: LIKE {result['like_ms']:9.2f} ms ({like_rows:7} rows)   "
+                      f"FTS {result['fts_ms']:9.2f} ms ({fts_rows:7} rows)")
+        server.db.close_all()
+        os.chdir('/')
+
+
+if __name__ == '__main__':
+    main()
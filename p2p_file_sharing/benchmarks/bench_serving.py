@@ -0,0 +1,131 @@
+"""Loopback benchmark for the peer file-serving path.
+
+Serves one file from a child process using each sending strategy and
+downloads it repeatedly over localhost, reporting uploads per second,
+throughput and server CPU seconds per GB sent:
+
+    python bench_serving.py --size-mb 256 --downloads 20 --concurrency 4
+
+``read8k`` is the original ``f.read(8192)`` + ``sendall`` loop, kept here
+as the baseline; ``buffered`` is the large-buffer fallback and
+``sendfile`` the zero-copy path used by the peer server.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+import peer_protocol  # noqa: E402
+
+
+def send_read8k(conn, f, offset, length):
+    f.seek(offset)
+    remaining = length
+    while remaining > 0:
+        chunk = f.read(min(8192, remaining))
+        if not chunk:
+            break
+        conn.sendall(chunk)
+        remaining -= len(chunk)
+    return length - remaining
+
+
+STRATEGIES = {
+    'read8k': send_read8k,
+    'buffered': peer_protocol.send_file_buffered,
+    'sendfile': peer_protocol.send_file_range,
+}
+
+
+def serve(path, strategy, expected, ready, results):
+    """Child process: serve `expected` range requests, then report CPU time"""
+    send = STRATEGIES[strategy]
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(128)
+    ready.send(server_socket.getsockname()[1])
+
+    def handle(conn):
+        with conn:
+            peer_protocol.serve_framed_session(conn, os.path.dirname(path), send, codecs=[])
+
+    cpu_start = time.process_time()
+    threads = []
+    for _ in range(expected):
+        conn, _ = server_socket.accept()
+        thread = threading.Thread(target=handle, args=(conn,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    results.send(time.process_time() - cpu_start)
+    server_socket.close()
+
+
+def download(port, filename):
+    with peer_protocol.RangeResponse('127.0.0.1', port, filename) as response:
+        return sum(len(chunk) for chunk in response.iter_chunks(1024 * 1024))
+
+
+def run(path, strategy, downloads, concurrency):
+    ready_recv, ready_send = multiprocessing.Pipe(duplex=False)
+    results_recv, results_send = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=serve,
+                                     args=(path, strategy, downloads, ready_send, results_send))
+    server.start()
+    port = ready_recv.recv()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        total = sum(pool.map(lambda _: download(port, os.path.basename(path)), range(downloads)))
+    elapsed = time.perf_counter() - start
+
+    server_cpu = results_recv.recv()
+    server.join()
+    gigabytes = total / 1024 ** 3
+    return {
+        'strategy': strategy,
+        'downloads': downloads,
+        'concurrency': concurrency,
+        'bytes': total,
+        'seconds': round(elapsed, 4),
+        'uploads_per_sec': round(downloads / elapsed, 2),
+        'mb_per_sec': round(total / 1024 ** 2 / elapsed, 1),
+        'server_cpu_sec_per_gb': round(server_cpu / gigabytes, 3) if gigabytes else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--downloads', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--strategy', choices=sorted(STRATEGIES), action='append')
+    parser.add_argument('--json', action='store_true', help="Print one JSON object per result")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'payload.bin')
+        with open(path, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        for strategy in args.strategy or ['read8k', 'buffered', 'sendfile']:
+            result = run(path, strategy, args.downloads, args.concurrency)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{strategy:>9}: {result['uploads_per_sec']:8.2f} uploads/s "
+                      f"{result['mb_per_sec']:9.1f} MB/s "
+                      f"{result['server_cpu_sec_per_gb']:7.3f} CPU s/GB")
+
+
+if __name__ == '__main__':
+    main()
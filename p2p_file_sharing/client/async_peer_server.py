@@ -0,0 +1,282 @@
+"""Event-loop peer server.
+
+Serves the same wire protocol as ``PeerClient.handle_peer_connection`` but
+multiplexes every connection on one asyncio loop instead of starting a
+thread per downloader, so memory and scheduling overhead stay flat as the
+number of concurrent downloaders grows.
+
+* At most ``max_connections`` transfers run at once; further connections
+  wait for a slot (up to ``request_timeout``) instead of piling on threads.
+* A peer must send its request within ``request_timeout`` seconds, and a
+  transfer must average at least ``MIN_SEND_RATE`` or it is dropped.
+* Framed sessions are answered request by request for as long as the
+  client keeps sending, closing after ``SESSION_IDLE_TIMEOUT`` of silence.
+* Uploads are paced by ``limiter`` (see rate_limit.py) when it has limits
+  set, slice by slice, without holding up other connections.
+* ``stop()`` stops accepting, gives in-flight transfers ``shutdown_grace``
+  seconds to finish and then cancels the rest.
+"""
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import compression
+import peer_protocol
+import rate_limit
+import transfer_stats
+
+MIN_SEND_RATE = 64 * 1024  # Bytes per second a downloader must sustain
+
+
+class _PrefixedReader:
+    """A StreamReader with some bytes already read from it put back in front"""
+
+    def __init__(self, prefix, reader):
+        self.prefix = prefix
+        self.reader = reader
+
+    async def readexactly(self, n):
+        if not self.prefix:
+            return await self.reader.readexactly(n)
+        data, self.prefix = self.prefix[:n], self.prefix[n:]
+        if len(data) < n:
+            data += await self.reader.readexactly(n - len(data))
+        return data
+
+
+class AsyncPeerServer:
+    def __init__(self, host, port, shared_dir='shared_files', max_connections=1024,
+                 request_timeout=30, shutdown_grace=10, codecs=None, limiter=None):
+        self.host = host
+        self.port = port
+        self.shared_dir = Path(shared_dir)
+        self.max_connections = max_connections
+        self.request_timeout = request_timeout
+        self.shutdown_grace = shutdown_grace
+        self.codecs = codecs  # Compression codecs to accept; None for all available
+        self.limiter = limiter or rate_limit.RateLimiter("Upload")
+
+        self.active = 0
+        self._loop = None
+        self._stopping = None
+        self._slots = None
+        self._tasks = set()
+
+    def run(self):
+        """Serve until stop() is called; meant to be a thread's target"""
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """Thread-safe request for a graceful shutdown"""
+        if self._loop is not None and self._stopping is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        # Named so the profiler can pick out the threads compressing for us
+        self._loop.set_default_executor(ThreadPoolExecutor(thread_name_prefix='peer-compress'))
+        self._stopping = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_connections)
+
+        server = await asyncio.start_server(self._accept, self.host, self.port,
+                                            backlog=min(self.max_connections, 4096))
+        print(f"Listening for incoming files on port {self.port} (asyncio)")
+        async with server:
+            await self._stopping.wait()
+            server.close()
+            await server.wait_closed()
+
+        if self._tasks:
+            print(f"Waiting for {len(self._tasks)} transfer(s) to finish...")
+            _, pending = await asyncio.wait(self._tasks, timeout=self.shutdown_grace)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _accept(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.request_timeout)
+        except asyncio.TimeoutError:
+            print("Peer server busy, dropping connection")
+            writer.close()
+            self._tasks.discard(task)
+            return
+
+        self.active += 1
+        peer = writer.get_extra_info('peername')
+        meter = self.limiter.open(peer[0] if peer else None)
+        try:
+            await self._handle(reader, writer, meter)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            print(f"Peer connection dropped: {e!r}")
+        except Exception as e:
+            print(f"Error in peer connection: {str(e)}")
+        finally:
+            self.limiter.close(meter)
+            self.active -= 1
+            self._slots.release()
+            self._tasks.discard(task)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+
+    async def _read_request(self, reader, data):
+        while data and not peer_protocol.request_complete(data):
+            more = await reader.read(1024)
+            if not more:
+                break
+            data += more
+        return peer_protocol.parse_request(data)
+
+    async def _handle(self, reader, writer, meter):
+        data = await asyncio.wait_for(reader.read(1024), self.request_timeout)
+        if data.startswith(peer_protocol.MAGIC[:1]):
+            await self._serve_framed(_PrefixedReader(data, reader), writer, meter)
+            return
+
+        filename, offset, length, is_range = await asyncio.wait_for(
+            self._read_request(reader, data), self.request_timeout)
+        file_path = peer_protocol.shared_path(self.shared_dir, filename)
+
+        if file_path is None or not os.path.isfile(file_path):
+            writer.write(peer_protocol.not_found_response(is_range))
+            await writer.drain()
+            return
+        await self._send_file(writer, Path(file_path), offset, length,
+                              lambda file_size, length: peer_protocol.response_header(
+                                  file_size, length, is_range), meter)
+
+    async def _serve_framed(self, reader, writer, meter):
+        """Answer a framed session's requests in order until the client hangs up"""
+        greeting = await asyncio.wait_for(
+            reader.readexactly(len(peer_protocol.MAGIC) + 1), self.request_timeout)
+        peer_protocol.check_greeting(greeting)
+        frame_type, _, _, length = peer_protocol.unpack_request_header(
+            await asyncio.wait_for(reader.readexactly(peer_protocol.FRAME_HEADER.size),
+                                   self.request_timeout))
+        if frame_type != peer_protocol.FRAME_HELLO:
+            raise peer_protocol.PeerProtocolError(f"Expected HELLO, got frame type {frame_type}")
+        options = json.loads(await asyncio.wait_for(reader.readexactly(length),
+                                                    self.request_timeout) or b"{}")
+        codec = compression.choose(options.get('codecs', []), self.codecs)
+        writer.write(peer_protocol.hello({'codec': codec}))
+
+        while True:
+            try:
+                header = await asyncio.wait_for(
+                    reader.readexactly(peer_protocol.FRAME_HEADER.size),
+                    peer_protocol.SESSION_IDLE_TIMEOUT)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise ConnectionError("Peer closed connection mid-frame")
+                return  # Client is done
+            frame_type, _, request_id, length = peer_protocol.unpack_request_header(header)
+            payload = await asyncio.wait_for(reader.readexactly(length), self.request_timeout)
+            if frame_type != peer_protocol.FRAME_GET:
+                writer.write(peer_protocol.pack_frame(
+                    peer_protocol.FRAME_ERROR, request_id,
+                    f"Unexpected frame type {frame_type}".encode()))
+                continue
+
+            filename, offset, length = peer_protocol.parse_get(payload)
+            file_path = peer_protocol.shared_path(self.shared_dir, filename)
+            if file_path is None or not os.path.isfile(file_path):
+                writer.write(peer_protocol.pack_frame(peer_protocol.FRAME_NOT_FOUND, request_id))
+                await writer.drain()
+                continue
+            await self._send_file(writer, Path(file_path), offset, length,
+                                  lambda file_size, length: peer_protocol.data_header(
+                                      request_id, file_size, length),
+                                  meter, request_id, codec)
+
+    async def _send_file(self, writer, file_path, offset, length, header, meter,
+                         request_id=None, codec=None):
+        """Send header(file_size, length) and then the requested part of the file.
+
+        With a codec, compressible files go out as compressed CHUNK frames
+        behind a chunked DATA header instead.  Each file sent is recorded
+        in transfer_stats.
+        """
+        with open(file_path, 'rb') as f, transfer_stats.TransferStats(
+                'upload', meter.peer, file_path.name, offset,
+                'legacy' if request_id is None else 'framed', meter) as stats:
+            file_size = os.fstat(f.fileno()).st_size
+            offset, length = peer_protocol.clamp_range(file_size, offset, length)
+            compress = codec is not None and compression.worth_compressing(file_path.name, length)
+            with stats.timing('send'):
+                if compress:
+                    writer.write(peer_protocol.chunked_data_header(request_id, file_size, length))
+                else:
+                    writer.write(header(file_size, length))
+                await writer.drain()
+            if length <= 0:
+                return
+
+            if compress:
+                await self._send_compressed(writer, f, request_id, offset, length, codec,
+                                            meter, stats)
+            else:
+                await self._sendfile(writer, f, offset, length, meter, stats)
+            stats.bytes = length
+
+    async def _sendfile(self, writer, f, offset, length, meter, stats):
+        step = self.limiter.slice_size()
+        if not step:
+            # Zero-copy where the transport supports it, chunked copies otherwise
+            with stats.timing('send'):
+                sent = await asyncio.wait_for(
+                    self._loop.sendfile(writer.transport, f, offset, length),
+                    self.request_timeout + length / MIN_SEND_RATE)
+            meter.bytes += sent
+        else:
+            # Rate limited: a slice at a time, waiting for tokens in between
+            sent = 0
+            while sent < length:
+                n = min(step, length - sent)
+                with stats.timing('throttle'):
+                    await asyncio.sleep(self.limiter.delay(meter, n))
+                with stats.timing('send'):
+                    just_sent = await asyncio.wait_for(
+                        self._loop.sendfile(writer.transport, f, offset + sent, n),
+                        self.request_timeout + n / MIN_SEND_RATE)
+                if just_sent < n:
+                    self.limiter.refund(meter, n - just_sent)
+                if not just_sent:
+                    break
+                sent += just_sent
+        if sent != length:
+            raise ConnectionError("File shrank while being sent")
+
+    async def _send_compressed(self, writer, f, request_id, offset, length, codec, meter,
+                               stats):
+        blocks = compression.iter_blocks(f, offset, length, codec)
+        while True:
+            # Reading and compressing a block would stall every other transfer
+            with stats.timing('cpu'):
+                item = await self._loop.run_in_executor(None, next, blocks, None)
+            if item is None:
+                return
+            packed, raw_offset = item
+            if packed is not None:
+                frame = peer_protocol.pack_frame(peer_protocol.FRAME_CHUNK, request_id,
+                                                 packed, peer_protocol.FLAG_COMPRESSED)
+                with stats.timing('throttle'):
+                    await asyncio.sleep(self.limiter.delay(meter, len(frame)))
+                with stats.timing('send'):
+                    writer.write(frame)
+                    await asyncio.wait_for(writer.drain(),
+                                           self.request_timeout + len(frame) / MIN_SEND_RATE)
+                continue
+            rest = offset + length - raw_offset
+            with stats.timing('send'):
+                writer.write(peer_protocol.FRAME_HEADER.pack(peer_protocol.FRAME_CHUNK, 0,
+                                                             request_id, rest))
+                await writer.drain()
+            await self._sendfile(writer, f, raw_offset, rest, meter, stats)
+            return
@@ -0,0 +1,277 @@
+"""Headless peer: seeds shared_files and runs downloads without a display.
+
+    python daemon.py --server http://10.38.12.8:5001 --username alice
+
+The password is read from --password or the P2P_PASSWORD environment
+variable.  Once logged in, the daemon is controlled over a small JSON API
+on localhost (port 7471 by default):
+
+    GET  /status                       who we are, what we share, limits
+    GET  /files?filename=&username=    search the catalog (all files if no query)
+    GET  /downloads                    every queued, running and finished download
+    GET  /downloads/<id>
+    POST /downloads                    queue one {"filename": ...} or a list of them;
+                                       peer_ip/peer_port, digest, swarm and
+                                       priority are optional
+    POST /downloads/<id>/pause         also /resume and /cancel
+    POST /downloads/<id>/priority      {"priority": 5}
+    POST /downloads/clear              forget finished downloads
+    POST /share                        {"path": ..., "in_place": true}
+    GET  /limits, POST /limits         bytes/s: upload, upload_per_peer,
+                                       download, download_per_peer (null = unlimited)
+    GET  /stats                        throughput of every open connection
+    GET  /transfers?n=20               stats of the last finished transfers
+    GET  /profile                      sampling profiler status and hottest lines
+    POST /profile/start                {"interval": 0.005} (seconds, optional)
+    POST /profile/stop                 writes collapsed stacks, returns the summary
+    POST /shutdown
+
+Every transfer is also logged to logs/transfers.jsonl (see --stats-log),
+and SIGUSR2 switches the profiler on and off.
+
+For example, to pull every file in a list:
+
+    jq -R '{filename: .}' names.txt | jq -s . |
+        curl -s -d @- localhost:7471/downloads
+
+The API has no authentication, so it only ever listens on loopback.
+"""
+import argparse
+import json
+import os
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import rate_limit
+import transfer_stats
+from engine import SERVER_URL, EngineError, PeerEngine
+
+CONTROL_PORT = 7471
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    engine = None  # Set by serve_control_api
+
+    def log_message(self, format, *args):
+        pass  # Scripts poll /downloads; logging every request drowns everything else
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def find_job(self, job_id):
+        job = next((job for job in self.engine.downloads.jobs() if str(job.id) == job_id), None)
+        if job is None:
+            raise LookupError(f"No download {job_id}")
+        return job
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        try:
+            status, body = self.route(method, parts, parse_qs(url.query))
+        except (ValueError, TypeError, KeyError) as e:
+            # Before LookupError, which KeyError is a kind of
+            status, body = 400, {'error': f"Bad request: {str(e)}"}
+        except LookupError as e:
+            status, body = 404, {'error': str(e)}
+        except EngineError as e:
+            status, body = 502, {'error': str(e)}
+        except Exception as e:
+            print(f"Control API error: {str(e)}")
+            status, body = 500, {'error': str(e)}
+        self.send_json(status, body)
+
+    def route(self, method, parts, query):
+        engine = self.engine
+        if method == 'GET' and parts == ['status']:
+            return 200, {'username': engine.username, 'logged_in': engine.is_logged_in,
+                         'ip': engine.ip, 'port': engine.listening_port,
+                         'shared_files': len(engine.share_index.digests()),
+                         'limits': limits()}
+        if method == 'GET' and parts == ['files']:
+            filename = query.get('filename', [None])[0]
+            username = query.get('username', [None])[0]
+            if filename or username:
+                files = engine.search_files(filename, username)
+            else:
+                files, _ = engine.list_files()
+            return 200, {'files': files}
+        if parts[:1] == ['downloads']:
+            return self.route_downloads(method, parts[1:])
+        if method == 'POST' and parts == ['share']:
+            body = self.read_json()
+            name = engine.import_shared_file(body['path'], body.get('in_place', True))
+            return 200, {'shared': name}
+        if parts == ['limits']:
+            if method == 'POST':
+                body = self.read_json()
+                current = limits()
+                rate_limit.upload_limiter.set_limits(
+                    body.get('upload', current['upload']),
+                    body.get('upload_per_peer', current['upload_per_peer']))
+                rate_limit.download_limiter.set_limits(
+                    body.get('download', current['download']),
+                    body.get('download_per_peer', current['download_per_peer']))
+            return 200, limits()
+        if method == 'GET' and parts == ['stats']:
+            return 200, {'upload': rate_limit.upload_limiter.stats(),
+                         'download': rate_limit.download_limiter.stats()}
+        if method == 'GET' and parts == ['transfers']:
+            return 200, {'transfers': transfer_stats.recent(int(query.get('n', [20])[0]))}
+        if parts[:1] == ['profile']:
+            return self.route_profile(method, parts[1:])
+        if method == 'POST' and parts == ['shutdown']:
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return 200, {'shutting_down': True}
+        raise LookupError(f"No such endpoint: {method} /{'/'.join(parts)}")
+
+    def route_profile(self, method, parts):
+        engine = self.engine
+        if method == 'GET' and not parts:
+            if engine.profiler is None:
+                return 200, {'running': False}
+            return 200, engine.profiler.summary()
+        if method == 'POST' and parts == ['start']:
+            body = self.read_json()
+            if 'interval' in body:
+                return 200, engine.start_profiling(float(body['interval']))
+            return 200, engine.start_profiling()
+        if method == 'POST' and parts == ['stop']:
+            summary = engine.stop_profiling()
+            if summary is None:
+                raise LookupError("The profiler is not running")
+            return 200, summary
+        raise LookupError(f"No such endpoint: {method} /profile/{'/'.join(parts)}")
+
+    def route_downloads(self, method, parts):
+        downloads = self.engine.downloads
+        if not parts:
+            if method == 'GET':
+                return 200, {'downloads': [job.as_dict() for job in downloads.jobs()]}
+            body = self.read_json()
+            jobs, errors = [], []
+            for request in body if isinstance(body, list) else [body]:
+                try:
+                    job = self.engine.download(request['filename'], request.get('peer_ip'),
+                                               request.get('peer_port'), request.get('digest'),
+                                               swarm=request.get('swarm', True),
+                                               priority=int(request.get('priority', 0)))
+                    jobs.append(job.as_dict())
+                except EngineError as e:
+                    errors.append({'filename': request['filename'], 'error': str(e)})
+            return (201 if jobs else 502), {'downloads': jobs, 'errors': errors}
+        if method == 'POST' and parts == ['clear']:
+            downloads.remove_finished()
+            return 200, {'downloads': [job.as_dict() for job in downloads.jobs()]}
+
+        job = self.find_job(parts[0])
+        action = parts[1:]
+        if method == 'GET' and not action:
+            return 200, job.as_dict()
+        if method == 'POST' and action == ['pause']:
+            downloads.pause(job.id)
+        elif method == 'POST' and action == ['resume']:
+            downloads.resume(job.id)
+        elif method == 'POST' and action == ['cancel']:
+            downloads.cancel(job.id)
+        elif method == 'POST' and action == ['priority']:
+            downloads.set_priority(job.id, int(self.read_json()['priority']))
+        else:
+            raise LookupError(f"No such endpoint: {method} /downloads/{'/'.join(parts)}")
+        return 200, job.as_dict()
+
+
+def limits():
+    return {'upload': rate_limit.upload_limiter.rate,
+            'upload_per_peer': rate_limit.upload_limiter.per_peer_rate,
+            'download': rate_limit.download_limiter.rate,
+            'download_per_peer': rate_limit.download_limiter.per_peer_rate}
+
+
+def toggle_profiling(engine):
+    summary = engine.stop_profiling()
+    if summary is None:
+        engine.start_profiling()
+        print("Profiling started")
+        return
+    print(f"Profile of {summary['thread_samples']} samples written to {summary['path']}")
+    for entry in summary['top'][:10]:
+        print(f"  {entry['percent']:5.1f}%  {entry['frame']}")
+
+
+def serve_control_api(engine, port=CONTROL_PORT):
+    """Build the control API server for engine, listening on loopback only"""
+    handler = type('BoundControlHandler', (ControlHandler,), {'engine': engine})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a P2P peer without the GUI")
+    parser.add_argument('--server', default=SERVER_URL, help="Tracker URL")
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', default=os.environ.get('P2P_PASSWORD'))
+    parser.add_argument('--register', action='store_true', help="Create the account first")
+    parser.add_argument('--port', type=int, help="Port to serve files on (default: any free port)")
+    parser.add_argument('--control-port', type=int, default=CONTROL_PORT)
+    parser.add_argument('--threaded-server', action='store_true',
+                        help="Serve peers with a thread per connection instead of asyncio")
+    parser.add_argument('--stats-log', default=str(transfer_stats.TRANSFER_LOG),
+                        help="Per-transfer stats log ('' to turn it off)")
+    parser.add_argument('--profile', action='store_true',
+                        help="Start the sampling profiler right away")
+    args = parser.parse_args()
+    if not args.password:
+        parser.error("a password is required (--password or P2P_PASSWORD)")
+
+    transfer_stats.configure(args.stats_log or None)
+    engine = PeerEngine(args.server, listening_port=args.port,
+                        use_async_server=not args.threaded_server)
+    if args.profile:
+        engine.start_profiling()
+    try:
+        if args.register:
+            engine.register(args.username, args.password)
+        engine.login(args.username, args.password)
+    except EngineError as e:
+        engine.shutdown()
+        raise SystemExit(f"Error: {str(e)}")
+
+    server = serve_control_api(engine, args.control_port)
+    # SIGTERM shuts down like Ctrl+C, so partial downloads are kept for resuming
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, lambda *_: toggle_profiling(engine))
+    print(f"Logged in as {args.username}, serving on port {engine.listening_port}; "
+          f"control API on 127.0.0.1:{args.control_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Scheduling of downloads.
+
+Downloads are queued as ``DownloadJob`` items and started by a fixed pool
+of worker threads, highest priority first (FIFO among equals), with at most
+``max_active`` running in total and ``max_per_peer`` from any one peer, so
+a burst of clicks neither thrashes the disk nor piles onto a single seeder.
+
+Each job carries its own progress, which the transfer updates through
+``DownloadJob.progress``.  Running jobs can be paused, which stops the
+transfer but keeps its partial file so resuming continues where it
+stopped (see resume.py), or cancelled, which throws the partial file away.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+QUEUED = 'queued'
+RUNNING = 'running'
+PAUSED = 'paused'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class DownloadStopped(Exception):
+    """Raised inside a transfer when its job was paused or cancelled"""
+
+
+class DownloadJob:
+    def __init__(self, job_id, filename, peer_ip, peer_port, digest=None, swarm=False,
+                 priority=0):
+        self.id = job_id
+        self.filename = filename
+        self.peer_ip = peer_ip
+        self.peer_port = peer_port
+        self.digest = digest
+        self.swarm = swarm
+        self.priority = priority
+        self.state = QUEUED
+        self.error = None
+        self.received = 0
+        self.total = 0
+        self.speed = 0.0  # Bytes per second, over the last second or so
+        self.wire_speed = None  # Set when the transfer is compressed
+        self.stop_requested = None  # PAUSED or CANCELLED while stopping
+        self._stop_callbacks = []
+        self._rate_mark = (time.monotonic(), 0, 0)
+
+    @property
+    def peer(self):
+        return (self.peer_ip, self.peer_port)
+
+    def as_dict(self):
+        return {'id': self.id, 'filename': self.filename, 'peer_ip': self.peer_ip,
+                'peer_port': self.peer_port, 'digest': self.digest, 'swarm': self.swarm,
+                'priority': self.priority, 'state': self.state, 'error': self.error,
+                'received': self.received, 'total': self.total,
+                'speed': round(self.speed, 1),
+                'wire_speed': None if self.wire_speed is None else round(self.wire_speed, 1)}
+
+    def progress(self, received, total, wire_bytes=None):
+        """Record progress; called by the transfer from its own thread"""
+        self.received = received
+        self.total = total
+        now = time.monotonic()
+        mark_time, mark_received, mark_wire = self._rate_mark
+        if now - mark_time >= 1:
+            self.speed = (received - mark_received) / (now - mark_time)
+            if wire_bytes is not None:
+                self.wire_speed = (wire_bytes - mark_wire) / (now - mark_time)
+            self._rate_mark = (now, received, wire_bytes or 0)
+
+    def check(self):
+        """Raise DownloadStopped if the job has been paused or cancelled"""
+        if self.stop_requested:
+            raise DownloadStopped(self.stop_requested)
+
+    def on_stop(self, callback):
+        """Have callback() called when the job is paused or cancelled"""
+        self._stop_callbacks.append(callback)
+        if self.stop_requested:
+            callback()
+
+    def _request_stop(self, reason):
+        self.stop_requested = reason
+        for callback in self._stop_callbacks:
+            callback()
+
+
+class DownloadQueue:
+    def __init__(self, run_job, max_active=3, max_per_peer=2, discard_job=None):
+        """run_job(job) performs a download, raising if it fails; discard_job(job),
+        if given, throws away the partial file of a job cancelled while not running"""
+        self.run_job = run_job
+        self.discard_job = discard_job
+        self.max_active = max_active
+        self.max_per_peer = max_per_peer
+        self._cond = threading.Condition()
+        self._heap = []  # (-priority, seq, job); jobs no longer queued are skipped
+        self._seq = itertools.count()
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self._active_per_peer = {}
+        self._running = True
+        self._workers = [threading.Thread(target=self._worker, name=f"download-{i + 1}",
+                                          daemon=True)
+                         for i in range(max_active)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, filename, peer_ip, peer_port, digest=None, swarm=False, priority=0):
+        with self._cond:
+            job = DownloadJob(next(self._ids), filename, peer_ip, peer_port, digest, swarm,
+                              priority)
+            self._jobs[job.id] = job
+            self._push(job)
+            return job
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (-job.priority, next(self._seq), job))
+        self._cond.notify_all()
+
+    def jobs(self):
+        with self._cond:
+            return list(self._jobs.values())
+
+    def set_priority(self, job_id, priority):
+        with self._cond:
+            job = self._jobs[job_id]
+            job.priority = priority
+            if job.state == QUEUED:
+                self._push(job)  # The old heap entry no longer matches and is skipped
+
+    def pause(self, job_id):
+        with self._cond:
+            job = self._jobs[job_id]
+            if job.state == QUEUED:
+                job.state = PAUSED
+            elif job.state == RUNNING:
+                job._request_stop(PAUSED)
+
+    def resume(self, job_id):
+        with self._cond:
+            job = self._jobs[job_id]
+            if job.state in (PAUSED, FAILED):
+                job.state = QUEUED
+                job.error = None
+                self._push(job)
+
+    def cancel(self, job_id):
+        with self._cond:
+            job = self._jobs[job_id]
+            stopped = job.state in (QUEUED, PAUSED, FAILED)
+            if stopped:
+                job.state = CANCELLED
+            elif job.state == RUNNING:
+                job._request_stop(CANCELLED)  # run_job cleans up as it stops
+        # Deleting files is slow; the lock isn't needed once the job is CANCELLED
+        if stopped and self.discard_job is not None:
+            self.discard_job(job)
+
+    def remove_finished(self):
+        """Forget jobs that are done, failed or cancelled"""
+        with self._cond:
+            for job_id, job in list(self._jobs.items()):
+                if job.state in (DONE, FAILED, CANCELLED):
+                    del self._jobs[job_id]
+
+    def shutdown(self):
+        """Stop starting jobs and pause the running ones"""
+        with self._cond:
+            self._running = False
+            for job in self._jobs.values():
+                if job.state == RUNNING:
+                    job._request_stop(PAUSED)
+            self._cond.notify_all()
+
+    def _take(self):
+        """Highest-priority queued job whose peer is below its limit, or None"""
+        skipped = []
+        job = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            _, _, candidate = entry
+            if candidate.state != QUEUED or -entry[0] != candidate.priority:
+                continue  # Stale entry
+            if self._active_per_peer.get(candidate.peer, 0) >= self.max_per_peer:
+                skipped.append(entry)
+                continue
+            job = candidate
+            break
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return job
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._running:
+                        return
+                    job = self._take()
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                job.state = RUNNING
+                job.stop_requested = None
+                job._stop_callbacks = []
+                self._active_per_peer[job.peer] = self._active_per_peer.get(job.peer, 0) + 1
+
+            try:
+                self.run_job(job)
+                state, error = DONE, None
+            except Exception as e:
+                if job.stop_requested:
+                    state, error = job.stop_requested, None
+                else:
+                    state, error = FAILED, str(e)
+                    print(f"Download of '{job.filename}' failed: {error}")
+
+            with self._cond:
+                job.state = state
+                job.error = error
+                job.speed = 0.0
+                job.wire_speed = None
+                self._active_per_peer[job.peer] -= 1
+                if not self._active_per_peer[job.peer]:
+                    del self._active_per_peer[job.peer]
+                self._cond.notify_all()
@@ -0,0 +1,620 @@
+"""The peer's networking core, independent of any user interface.
+
+``PeerEngine`` talks to the tracker (accounts, heartbeats, sharing,
+listings), serves shared_files to other peers and runs the download
+queue.  It never touches a widget: failures in calls made by the UI are
+raised as ``EngineError``, and failures in its own background threads
+(such as the share watcher) are passed to ``on_error(message)``.
+
+The Tk app (peer.py) and the headless daemon (daemon.py) are both thin
+clients of this class.
+"""
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+import manifest
+import peer_protocol
+import rate_limit
+import share_import
+import transfer_stats
+from async_peer_server import AsyncPeerServer
+from download_queue import CANCELLED, DownloadQueue
+from profiler import SAMPLE_INTERVAL, SamplingProfiler
+from resume import DownloadState
+from share_watcher import ShareWatcher
+from shared_index import ShareIndex
+from swarm import SwarmDownload
+
+SERVER_URL = "http://10.38.12.8:5001"  # Update with your server's IP
+FILE_PAGE_SIZE = 1000  # Rows per /files request
+HEARTBEAT_INTERVAL = 30
+
+
+class EngineError(Exception):
+    """A request to the engine failed; the message is fit to show the user"""
+
+
+class PeerEngine:
+    def __init__(self, server_url=SERVER_URL, on_error=print, listening_port=None,
+                 use_async_server=True, max_peer_connections=1024, ip=None):
+        self.server_url = server_url
+        self.on_error = on_error
+        self.listening_port = listening_port or self.find_free_port()
+        self.ip = ip or self.get_local_ip()  # The address other peers are told to use
+        self.username = None
+        self.is_logged_in = False
+        self.is_running = True
+        self.announced = None  # What the server last acknowledged we share
+        self.share_lock = threading.Lock()
+        self.share_watcher = None
+        self.heartbeat_thread = None
+        self.server_thread = None
+        self.async_server = None
+        self.use_async_server = use_async_server  # False falls back to a thread per connection
+        self.max_peer_connections = max_peer_connections
+        self.profiler = None  # A SamplingProfiler while profiling is switched on
+
+        self.setup_directories()
+        self.share_index = ShareIndex("shared_files")
+        # At most 3 downloads at once, 2 from the same peer; the rest wait their turn
+        self.downloads = DownloadQueue(self.run_download, max_active=3, max_per_peer=2,
+                                       discard_job=self.discard_download)
+
+    def find_free_port(self):
+        """Find a free port to use for listening"""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('', 0))  # Bind to any available port
+            s.listen(1)
+            port = s.getsockname()[1]
+            return port
+
+    def get_local_ip(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(('8.8.8.8', 80))
+            ip = s.getsockname()[0]
+        except Exception:
+            ip = '127.0.0.1'
+        finally:
+            s.close()
+        return ip
+
+    def setup_directories(self):
+        Path("downloads").mkdir(exist_ok=True)
+        Path("shared_files").mkdir(exist_ok=True)
+
+    # Accounts and session
+
+    def register(self, username, password):
+        data = {
+            'username': username,
+            'password': password,
+            'ip': self.ip,
+            'port': self.listening_port
+        }
+        try:
+            response = requests.post(f"{self.server_url}/register", json=data)
+        except requests.RequestException as e:
+            raise EngineError(f"Connection error: {str(e)}")
+        if response.status_code != 200:
+            raise EngineError("Username already exists")
+
+    def login(self, username, password):
+        """Log in, then start serving, heartbeats and sharing"""
+        data = {
+            'username': username,
+            'password': password,
+            'ip': self.ip,
+            'port': self.listening_port
+        }
+        try:
+            response = requests.post(f"{self.server_url}/login", json=data)
+        except requests.RequestException as e:
+            raise EngineError(f"Connection error: {str(e)}")
+        if response.status_code != 200:
+            raise EngineError("Invalid credentials")
+
+        self.username = username
+        self.is_logged_in = True
+        self.announced = None  # Always start a session with a full sync
+        self.start_peer_server()
+        self.start_heartbeat()
+        try:
+            self.share_files(quick=True)
+        except EngineError as e:
+            self.on_error(str(e))
+        self.start_share_watcher()  # Picks up anything the quick scan skipped
+
+    def start_heartbeat(self):
+        """Start the heartbeat thread"""
+        if self.heartbeat_thread is None:
+            self.heartbeat_thread = threading.Thread(target=self.send_heartbeat)
+            self.heartbeat_thread.daemon = True
+            self.heartbeat_thread.start()
+
+    def send_heartbeat(self):
+        """Send periodic heartbeat to server"""
+        while self.is_running and self.is_logged_in:
+            try:
+                data = {
+                    'username': self.username,
+                    'ip': self.ip,
+                    'port': self.listening_port
+                }
+                response = requests.post(f"{self.server_url}/heartbeat", json=data)
+                if response.status_code != 200:
+                    print(f"Heartbeat failed: {response.status_code}")
+            except Exception as e:
+                print(f"Heartbeat error: {str(e)}")
+            time.sleep(HEARTBEAT_INTERVAL)
+        self.heartbeat_thread = None
+
+    def shutdown(self):
+        """Stop serving and downloading, and tell the server we're leaving"""
+        self.is_running = False
+        self.is_logged_in = False
+        if self.async_server:
+            self.async_server.stop()
+        if self.share_watcher:
+            self.share_watcher.stop()
+        # Running downloads are paused, so they resume from their partial files next time
+        self.downloads.shutdown()
+        peer_protocol.default_pool.close_all()
+        summary = self.stop_profiling()
+        if summary:
+            print(f"Profile written to {summary['path']}")
+
+        # Send one final request to let server know we're disconnecting
+        if self.username:
+            try:
+                data = {
+                    'username': self.username,
+                    'ip': self.ip,
+                    'port': self.listening_port
+                }
+                requests.post(f"{self.server_url}/disconnect", json=data)
+            except:
+                pass
+
+    # Listings
+
+    def fetch_file_pages(self, endpoint, params, etag=None):
+        """GET every page of a file listing.
+
+        Returns (status_code, files, etag); a 304 status means the listing
+        still matches etag and nothing was transferred.
+        """
+        files = []
+        cursor = None
+        first_etag = None
+        while True:
+            page_params = dict(params, limit=FILE_PAGE_SIZE)
+            headers = {}
+            if cursor:
+                page_params['cursor'] = cursor
+            elif etag:
+                headers['If-None-Match'] = etag
+            response = requests.get(f"{self.server_url}{endpoint}", params=page_params, headers=headers)
+            if response.status_code != 200:
+                return response.status_code, None, etag
+            body = response.json()
+            files.extend(body.get('files', []))
+            if cursor is None:
+                # If the catalog moves on mid-listing the next refresh sees a new ETag
+                first_etag = response.headers.get('ETag')
+            cursor = body.get('next_cursor')
+            if not cursor:
+                return 200, files, first_etag
+
+    def list_files(self, etag=None):
+        """Every file on offer as (files, etag); files is None if etag is still current"""
+        try:
+            status, files, etag = self.fetch_file_pages("/files", {}, etag)
+        except requests.RequestException as e:
+            raise EngineError(f"Failed to fetch files: {str(e)}")
+        if status == 304:
+            return None, etag
+        if status != 200:
+            raise EngineError("Failed to fetch files")
+        return files, etag
+
+    def search_files(self, filename=None, username=None):
+        params = {}
+        if filename:
+            params['filename'] = filename
+        if username:
+            params['username'] = username
+        try:
+            status, files, _ = self.fetch_file_pages("/search_files", params)
+        except requests.RequestException as e:
+            raise EngineError(f"Failed to search files: {str(e)}")
+        if status != 200:
+            raise EngineError("Failed to search files")
+        return files
+
+    # Sharing
+
+    def import_shared_file(self, filename, in_place=True, progress_callback=None):
+        """Place a file in shared_files, hash it and announce it (slow; run off the UI thread)"""
+        name = Path(filename).name
+        staged, dest, file_manifest, method = share_import.stage_shared_file(
+            filename, "shared_files", in_place, progress_callback)
+        print(f"Staged '{name}' for sharing via {method}")
+
+        with self.share_lock:
+            os.replace(staged, dest)
+            self.share_index.add(name, file_manifest)
+            self.announce_shared_files()
+        return name
+
+    def share_files(self, quick=False):
+        """Share files with the central server.
+
+        After the first full sync only the files added, removed or changed
+        since the last announcement are sent.  quick skips re-checking every
+        file when the shared directory itself hasn't changed (see ShareIndex).
+        """
+        shared_dir = Path("shared_files")
+        if not shared_dir.exists():
+            shared_dir.mkdir()
+
+        with self.share_lock:
+            try:
+                self.share_index.refresh(quick)
+            except OSError as e:
+                raise EngineError(f"Failed to scan shared files: {str(e)}")
+            self.announce_shared_files()
+
+    def announce_shared_files(self):
+        """Send the server the delta (or full list) of what the index holds"""
+        current = self.share_index.digests()
+        endpoint = (self.ip, self.listening_port)
+
+        try:
+            announced = self.announced
+            if announced and announced['endpoint'] == endpoint:
+                previous = announced['files']
+                changed = {name for name in current
+                           if name in previous and previous[name] != current[name]}
+                added = [name for name in current if name not in previous or name in changed]
+                removed = [name for name in previous if name not in current or name in changed]
+                if not added and not removed:
+                    return
+                data = {
+                    'username': self.username,
+                    'base_version': announced['version'],
+                    'added': added,
+                    'removed': removed,
+                    'manifests': self.share_index.manifests(added),
+                    'peer_ip': self.ip,
+                    'peer_port': self.listening_port
+                }
+                print(f"Sharing changes with server: +{len(added)} -{len(removed)}")
+                response = requests.post(f"{self.server_url}/share_files_delta", json=data)
+                if response.status_code == 200:
+                    self.announced = {'endpoint': endpoint, 'files': current,
+                                      'version': response.json().get('version')}
+                    return
+                if response.status_code != 409:
+                    raise EngineError("Failed to share files")
+                print("Server share state is out of date, resending all files")
+
+            data = {
+                'username': self.username,
+                'filename': list(current),
+                'manifests': self.share_index.manifests(),
+                'peer_ip': self.ip,
+                'peer_port': self.listening_port  # Send our listening port
+            }
+            print(f"Sharing files with server. Our listening port: {self.listening_port}")
+            response = requests.post(f"{self.server_url}/share_files", json=data)
+            if response.status_code == 200:
+                self.announced = {'endpoint': endpoint, 'files': current,
+                                  'version': response.json().get('version')}
+            else:
+                self.announced = None
+                raise EngineError("Failed to share files")
+        except requests.RequestException as e:
+            self.announced = None
+            raise EngineError(f"Failed to share files: {str(e)}")
+
+    def start_share_watcher(self):
+        """Announce files dropped into (or removed from) shared_files automatically"""
+        if self.share_watcher is None:
+            self.share_watcher = ShareWatcher(self.share_index, self.on_shared_files_changed)
+            self.share_watcher.start()
+
+    def on_shared_files_changed(self):
+        if self.is_logged_in:
+            try:
+                self.share_files()
+            except EngineError as e:
+                self.on_error(str(e))
+
+    # Downloads
+
+    def download(self, filename, peer_ip=None, peer_port=None, digest=None, swarm=True,
+                 priority=0):
+        """Queue a download, returning its DownloadJob.
+
+        Without a peer, the file is looked up on the server and fetched
+        from the first peer offering it under exactly this name.
+        """
+        if peer_ip is None or peer_port is None:
+            files = [file for file in self.search_files(filename=filename)
+                     if file[0] == filename and file[1] != self.username]
+            if not files:
+                raise EngineError(f"No peer is sharing '{filename}'")
+            peer_ip, peer_port = files[0][2], files[0][3]
+            digest = digest or (files[0][5] if len(files[0]) > 5 else None)
+        return self.downloads.submit(filename, peer_ip, int(peer_port), digest or None,
+                                     swarm=swarm, priority=priority)
+
+    def fetch_manifest(self, digest):
+        """Get a file's manifest from the server, or None if unavailable"""
+        if not digest:
+            return None
+        try:
+            response = requests.get(f"{self.server_url}/manifest/{digest}")
+            if response.status_code == 200:
+                file_manifest = response.json()
+                if manifest.is_valid(file_manifest) and file_manifest['digest'] == digest:
+                    return file_manifest
+                print(f"Ignoring inconsistent manifest for {digest}")
+        except requests.RequestException as e:
+            print(f"Manifest lookup failed: {str(e)}")
+        return None
+
+    def repair_pieces(self, peer_ip, peer_port, filename, save_path, file_manifest, bad, stats):
+        """Re-fetch only the pieces that failed verification, pipelined on one connection"""
+        piece_size = file_manifest['piece_size']
+        size = file_manifest['size']
+        with open(save_path, 'r+b') as f, \
+                peer_protocol.default_pool.connection(peer_ip, peer_port) as connection:
+            f.truncate(size)
+            for attempt in range(3):
+                ranges = [(filename, index * piece_size,
+                           min(piece_size, size - index * piece_size)) for index in bad]
+                stats.retries += len(bad)
+                still_bad = []
+                for index, (_, data) in zip(bad, stats.timed(
+                        'recv', connection.fetch_many(ranges), connection.meter)):
+                    with stats.timing('cpu'):
+                        good = (data is not None and
+                                manifest.piece_digest(data) == file_manifest['pieces'][index])
+                    if good:
+                        with stats.timing('disk'):
+                            f.seek(index * piece_size)
+                            f.write(data)
+                        stats.bytes += len(data)
+                    else:
+                        still_bad.append(index)
+                bad = still_bad
+                if not bad:
+                    return
+            raise EngineError(f"{len(bad)} piece(s) failed verification repeatedly")
+
+    def transfer_file(self, job):
+        """Download a file from one peer, resuming a partial download if there is one"""
+        peer_ip, peer_port, filename, digest = job.peer_ip, job.peer_port, job.filename, job.digest
+        file_manifest = self.fetch_manifest(digest)
+        hasher = manifest.PieceHasher(file_manifest['piece_size']) if file_manifest else None
+
+        print(f"Attempting to connect to {peer_ip}:{peer_port} for file '{filename}'")  # Debug print
+
+        save_path = Path('downloads') / filename
+        state = DownloadState(save_path)
+        offset = state.contiguous_bytes() if state.load() else 0
+
+        stats = transfer_stats.TransferStats('download', f"{peer_ip}:{peer_port}", filename,
+                                             offset, 'single')
+        try:
+            with stats.timing('recv'):
+                response = peer_protocol.RangeResponse(peer_ip, peer_port, filename, offset)
+                if offset and not state.matches(response.file_size, digest):
+                    # The peer's copy is not what we were downloading; start over
+                    response.close()
+                    offset = stats.offset = 0
+                    response = peer_protocol.RangeResponse(peer_ip, peer_port, filename)
+            meter = response.connection.meter
+            stats.watch(meter)
+            stats.extra['codec'] = response.connection.codec
+
+            with response:
+                file_size = response.file_size
+                state.start(file_size, digest,
+                            file_manifest['piece_size'] if file_manifest else None)
+                state.received = offset
+                received = offset
+                job.progress(received, file_size, 0)
+
+                with state.open_part() as f:
+                    if hasher and offset:
+                        # Verification covers the whole file, including what we already had
+                        while hasher.size < offset:
+                            with stats.timing('disk'):
+                                data = f.read(min(1024 * 1024, offset - hasher.size))
+                            with stats.timing('cpu'):
+                                hasher.update(data)
+                    f.seek(offset)
+                    try:
+                        for chunk in stats.timed('recv', response.iter_chunks(), meter):
+                            job.check()
+                            received += len(chunk)
+                            state.received = received
+                            with stats.timing('disk'):
+                                f.write(chunk)
+                                state.save(f)
+                            stats.bytes = received - offset
+                            if hasher:
+                                with stats.timing('cpu'):
+                                    hasher.update(chunk)
+                            job.progress(received, file_size,
+                                         response.wire_bytes if response.connection.codec else None)
+                    finally:
+                        # Whatever happened, remember how far we got
+                        state.save(f, force=True)
+
+                if response.wire_bytes < received - offset:
+                    print(f"Received {received - offset} bytes as {response.wire_bytes} "
+                          f"on the wire ({response.connection.codec})")
+
+                if hasher:
+                    bad = manifest.bad_pieces(file_manifest, hasher.manifest())
+                    if bad:
+                        print(f"Re-fetching {len(bad)} corrupt piece(s) of '{filename}'")
+                        self.repair_pieces(peer_ip, peer_port, filename, state.part_path,
+                                           file_manifest, bad, stats)
+
+                state.finish()
+        except Exception as e:
+            stats.result = job.stop_requested  # Paused or cancelled, if that is why
+            stats.finish(e)
+            raise
+        stats.finish()
+
+    def find_sources(self, filename, digest=None):
+        """Ask the server for every live peer sharing this file.
+
+        With a digest, peers sharing the same content under any name are
+        returned; otherwise peers sharing exactly this filename.
+        """
+        params = {'digest': digest} if digest else {'filename': filename}
+        response = requests.get(f"{self.server_url}/search_files", params=params)
+        if response.status_code != 200:
+            return []
+        return [(file[2], int(file[3]), file[0]) for file in response.json().get('files', [])
+                if (digest or file[0] == filename) and file[1] != self.username]
+
+    def swarm_transfer_file(self, job):
+        """Download a file in pieces from every peer sharing it"""
+        peer_ip, peer_port, filename, digest = job.peer_ip, job.peer_port, job.filename, job.digest
+        file_manifest = self.fetch_manifest(digest)
+        try:
+            sources = self.find_sources(filename, file_manifest and digest)
+        except requests.RequestException as e:
+            print(f"Source lookup failed, using selected peer only: {str(e)}")
+            sources = []
+        if (peer_ip, peer_port, filename) not in sources:
+            sources.insert(0, (peer_ip, peer_port, filename))
+
+        save_path = Path('downloads') / filename
+        stats = transfer_stats.TransferStats(
+            'download', [f"{source[0]}:{source[1]}" for source in sources], filename,
+            mode='swarm')
+        download = SwarmDownload(filename, sources, save_path, progress_callback=job.progress,
+                                 manifest=file_manifest, stats=stats)
+        job.on_stop(download.stop)
+        try:
+            download.run()
+        except Exception as e:
+            stats.result = job.stop_requested
+            stats.finish(e)
+            raise
+        stats.finish()
+
+    def run_download(self, job):
+        """Run a queued download; a cancelled one leaves no partial file behind"""
+        try:
+            if job.swarm:
+                self.swarm_transfer_file(job)
+            else:
+                self.transfer_file(job)
+        except Exception:
+            if job.stop_requested == CANCELLED:
+                self.discard_download(job)
+            raise
+
+    def discard_download(self, job):
+        """Delete a cancelled download's partial file and its state"""
+        try:
+            DownloadState(Path('downloads') / job.filename).discard()
+        except OSError as e:
+            print(f"Could not remove the partial download of '{job.filename}': {str(e)}")
+
+    # Diagnostics
+
+    def start_profiling(self, interval=SAMPLE_INTERVAL):
+        """Start sampling the peer server and transfer threads, if not already"""
+        if self.profiler is None:
+            self.profiler = SamplingProfiler(interval)
+            self.profiler.start()
+        return self.profiler.summary()
+
+    def stop_profiling(self):
+        """Stop the profiler; returns its summary, with where the stacks were
+        written, or None if it wasn't running"""
+        profiler, self.profiler = self.profiler, None
+        return profiler.stop() if profiler else None
+
+    # Serving
+
+    def start_peer_server(self):
+        if self.server_thread is not None:
+            return
+        if self.use_async_server:
+            self.async_server = AsyncPeerServer(self.ip, self.listening_port,
+                                                max_connections=self.max_peer_connections,
+                                                limiter=rate_limit.upload_limiter)
+            self.server_thread = threading.Thread(target=self.async_server.run,
+                                                  name='peer-server')
+        else:
+            self.server_thread = threading.Thread(target=self.run_peer_server,
+                                                  name='peer-server')
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def run_peer_server(self):
+        """Server thread to receive files"""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.bind((self.ip, self.listening_port))  # Use listening_port
+        server_socket.listen(5)
+        server_socket.settimeout(1)
+
+        print(f"Listening for incoming files on port {self.listening_port}")
+
+        while self.is_running:
+            try:
+                conn, addr = server_socket.accept()
+                print(f"Received connection from {addr}")
+                threading.Thread(target=self.handle_peer_connection, args=(conn, addr),
+                                 name=f"peer-upload-{addr[0]}:{addr[1]}").start()
+            except socket.timeout:
+                continue
+            except Exception as e:
+                print(f"Server error: {str(e)}")
+                break
+
+        server_socket.close()
+
+    def handle_peer_connection(self, conn, addr):
+        conn = rate_limit.ThrottledSocket(conn, rate_limit.upload_limiter, addr[0])
+        try:
+            if peer_protocol.is_framed(conn):
+                peer_protocol.serve_framed_session(conn, 'shared_files')
+                return
+
+            filename, offset, length, is_range = peer_protocol.read_request(conn)
+            file_path = peer_protocol.shared_path('shared_files', filename)
+
+            if file_path is None or not os.path.isfile(file_path):
+                conn.sendall(peer_protocol.not_found_response(is_range))
+                return
+
+            file_size = os.path.getsize(file_path)
+            offset, length = peer_protocol.clamp_range(file_size, offset, length)
+            with open(file_path, 'rb') as f, transfer_stats.TransferStats(
+                    'upload', addr[0], filename, offset, 'legacy', conn.meter) as stats:
+                with stats.timing('send', conn.meter):
+                    conn.sendall(peer_protocol.response_header(file_size, length, is_range))
+                    stats.bytes = peer_protocol.send_file_range(conn, f, offset, length)
+
+        except Exception as e:
+            print(f"Error in peer connection: {str(e)}")
+        finally:
+            conn.close()
@@ -0,0 +1,161 @@
+"""A Treeview that only materializes the rows on screen.
+
+The catalog can hold hundreds of thousands of files, and inserting each
+one into a ``ttk.Treeview`` makes Tk slow to fill, scroll and tear down.
+``VirtualFileList`` keeps the rows in a plain list and gives the tree
+just enough items to fill its height, rewriting their values as the list
+scrolls.  It draws its own scrollbar position and handles the wheel and
+arrow keys, since the tree itself only ever sees one screenful.
+
+``set_filter`` narrows the list to rows whose filename or owner contains
+the text.  Typing more of the same query only rescans the rows that still
+matched, so filtering keeps up with typing on large listings.
+"""
+import tkinter as tk
+from tkinter import ttk
+
+ROW_HEIGHT = 22  # Pixels; fixed by the tree's style so visible rows can be counted
+
+
+class VirtualFileList:
+    def __init__(self, parent, columns, widths):
+        """columns are displayed from each row's first values; extra values stay hidden"""
+        self.frame = ttk.Frame(parent)
+        self.rows = []
+        self._keys = []  # Lowercased "filename owner" per row, for filtering
+        self._matches = []  # Indexes of rows that pass the filter
+        self._filter = ""  # Normalized text _matches was computed for; None to rescan
+        self._filter_text = ""
+        self._offset = 0  # Index into _matches of the top visible row
+        self._visible = 1
+        self._selected = None  # Index into rows, kept across scrolling
+
+        # A style of its own, so the fixed row height doesn't leak into other trees
+        ttk.Style().configure('Files.Treeview', rowheight=ROW_HEIGHT)
+        self.tree = ttk.Treeview(self.frame, columns=columns, show='headings',
+                                 selectmode='browse', height=1, style='Files.Treeview')
+        for col, width in zip(columns, widths):
+            self.tree.heading(col, text=col)
+            self.tree.column(col, width=width, anchor='center')
+        self.tree.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+        self._columns = len(columns)
+
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        self.tree.bind('<Configure>', self._on_resize)
+        self.tree.bind('<<TreeviewSelect>>', self._on_select)
+        self.tree.bind('<MouseWheel>', lambda e: self.scroll(-1 if e.delta > 0 else 1, 'units'))
+        self.tree.bind('<Button-4>', lambda e: self.scroll(-1, 'units'))
+        self.tree.bind('<Button-5>', lambda e: self.scroll(1, 'units'))
+        self.tree.bind('<Up>', lambda e: self._move_selection(-1))
+        self.tree.bind('<Down>', lambda e: self._move_selection(1))
+        self.tree.bind('<Prior>', lambda e: self.scroll(-1, 'pages'))
+        self.tree.bind('<Next>', lambda e: self.scroll(1, 'pages'))
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def set_rows(self, rows):
+        """Replace the listing, keeping the current filter"""
+        self.rows = rows
+        self._keys = [f"{row[0]} {row[1]}".lower() for row in rows]
+        self._selected = None
+        self._filter = None
+        self.set_filter(self._filter_text)
+
+    def set_filter(self, text):
+        self._filter_text = text
+        text = text.strip().lower()
+        if self._filter is not None and text.startswith(self._filter):
+            candidates = self._matches  # Narrowing: only what matched before can match now
+        else:
+            candidates = range(len(self.rows))
+        keys = self._keys
+        self._matches = [i for i in candidates if text in keys[i]] if text else list(candidates)
+        self._filter = text
+        if self._selected is not None and self._selected not in set(self._matches):
+            self._selected = None
+        self._offset = 0
+        self._render()
+
+    def __len__(self):
+        return len(self._matches)
+
+    def selected(self):
+        """The selected row, or None"""
+        return None if self._selected is None else self.rows[self._selected]
+
+    def yview(self, *args):
+        """Scrollbar command: ('moveto', fraction) or ('scroll', n, 'units'|'pages')"""
+        if args[0] == 'moveto':
+            self._scroll_to(int(float(args[1]) * len(self._matches)))
+        elif args[0] == 'scroll':
+            self.scroll(int(args[1]), args[2])
+
+    def scroll(self, n, what='units'):
+        self._scroll_to(self._offset + n * (self._visible if what == 'pages' else 1))
+        return 'break'
+
+    def _scroll_to(self, offset):
+        offset = max(0, min(offset, len(self._matches) - self._visible))
+        if offset != self._offset:
+            self._offset = offset
+            self._render()
+
+    def _on_resize(self, event):
+        # The heading takes about one row
+        visible = max(1, event.height // ROW_HEIGHT - 1)
+        if visible != self._visible:
+            self._visible = visible
+            self._offset = max(0, min(self._offset, len(self._matches) - visible))
+            self._render()
+
+    def _on_select(self, event):
+        selection = self.tree.selection()
+        if selection:
+            position = self._offset + int(selection[0])
+            if position < len(self._matches):
+                self._selected = self._matches[position]
+
+    def _move_selection(self, step):
+        if not self._matches:
+            return 'break'
+        try:
+            position = self._matches.index(self._selected) + step
+        except ValueError:
+            position = self._offset
+        position = max(0, min(position, len(self._matches) - 1))
+        self._selected = self._matches[position]
+        if position < self._offset:
+            self._scroll_to(position)
+        elif position >= self._offset + self._visible:
+            self._scroll_to(position - self._visible + 1)
+        self._render()
+        return 'break'
+
+    def _render(self):
+        """Point the tree's items at the rows now in view"""
+        window = self._matches[self._offset:self._offset + self._visible]
+        items = self.tree.get_children()
+        for slot in range(len(window), len(items)):
+            self.tree.delete(str(slot))
+        selected_slot = None
+        for slot, index in enumerate(window):
+            values = self.rows[index][:self._columns]
+            if slot < len(items):
+                self.tree.item(str(slot), values=values)
+            else:
+                self.tree.insert('', tk.END, iid=str(slot), values=values)
+            if index == self._selected:
+                selected_slot = str(slot)
+        if selected_slot is not None:
+            self.tree.selection_set(selected_slot)
+        elif self.tree.selection():
+            self.tree.selection_remove(*self.tree.selection())
+
+        total = len(self._matches)
+        if total <= self._visible:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self._offset / total, (self._offset + len(window)) / total)
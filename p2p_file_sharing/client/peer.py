@@ -1,17 +1,19 @@
 import tkinter as tk
 from tkinter import messagebox, filedialog, ttk
-import requests
-import os
-import socket
 import threading
 from pathlib import Path
-import time
+
+import rate_limit
+from download_queue import DONE, FAILED, RUNNING
+from engine import EngineError, PeerEngine
+from file_list import VirtualFileList
+from ui_events import EventChannel
+
+DOWNLOADS_REFRESH_MS = 500  # How often the downloads list is redrawn
+FRAME_MS = 33  # How often updates from worker threads are applied (~30 per second)
 
 class PeerClient:
     def __init__(self, master):
-        self.heartbeat_thread = None
-        self.is_logged_in = False
-
         self.master = master
         master.title("P2P File Sharing")
         master.geometry("900x650")  # Increased window size for better layout
@@ -61,27 +63,21 @@ class PeerClient:
 
         self.server_url = "http://10.38.12.8:5001"  # Update with your server's IP
 
-        self.listening_port = self.find_free_port()
-        self.ip = self.get_local_ip()
-
-        self.setup_directories()
-        self.setup_ui()
-        self.username = None
+        # All networking happens in the engine's threads; this class only draws it
+        self.engine = PeerEngine(self.server_url, on_error=self.show_background_error)
+        self.downloads = self.engine.downloads
+        self.files_etag = None  # Catalog version the file list on screen reflects
+        self.download_states = {}  # job id -> state last shown
         self.is_running = True
-        self.server_thread = None
-        self.port = 60000
-
-    def find_free_port(self):
-        """Find a free port to use for listening"""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(('', 0))  # Bind to any available port
-            s.listen(1)
-            port = s.getsockname()[1]
-            return port
-
-    def setup_directories(self):
-        Path("downloads").mkdir(exist_ok=True)
-        Path("shared_files").mkdir(exist_ok=True)
+        # Worker threads report through this instead of touching widgets
+        self.events = EventChannel()
+        self.setup_ui()
+        self.event_handlers = {
+            'status': lambda text: self.status_label.config(text=text),
+            'progress': self.progress_var.set,
+        }
+        self.master.after(FRAME_MS, self.pump_events)
+        self.master.after(DOWNLOADS_REFRESH_MS, self.update_downloads_view)
 
     def setup_ui(self):
         self.master.configure(bg=self.colors['background'])
@@ -156,6 +152,25 @@ class PeerClient:
         download_button.pack(side=tk.LEFT, padx=10)
         self.create_tooltip(download_button, "Download the selected file")
 
+        bandwidth_button = ttk.Button(toolbar, text="Bandwidth", command=self.show_bandwidth_settings)
+        bandwidth_button.pack(side=tk.LEFT, padx=10)
+        self.create_tooltip(bandwidth_button, "Limit upload and download speeds")
+
+        self.profile_button = ttk.Button(toolbar, text="Profile", command=self.toggle_profiling)
+        self.profile_button.pack(side=tk.LEFT, padx=10)
+        self.create_tooltip(self.profile_button,
+                            "Sample where transfer threads spend their time")
+
+        self.swarm_var = tk.BooleanVar(value=True)
+        swarm_check = ttk.Checkbutton(toolbar, text="Swarm Download", variable=self.swarm_var)
+        swarm_check.pack(side=tk.LEFT, padx=10)
+        self.create_tooltip(swarm_check, "Download pieces from every peer sharing the file at once")
+
+        self.share_in_place_var = tk.BooleanVar(value=True)
+        in_place_check = ttk.Checkbutton(toolbar, text="Share In Place", variable=self.share_in_place_var)
+        in_place_check.pack(side=tk.LEFT, padx=10)
+        self.create_tooltip(in_place_check, "Link shared files instead of copying them into shared_files")
+
         # Search Frame
         search_frame = ttk.Frame(bg_frame)
         search_frame.pack(fill=tk.X, pady=15)
@@ -176,28 +191,48 @@ class PeerClient:
         clear_button.grid(row=0, column=5, padx=10, pady=10)
         self.create_tooltip(clear_button, "Clear search fields and refresh the file list")
 
-        # Treeview Frame
-        tree_frame = ttk.Frame(bg_frame)
-        tree_frame.pack(expand=True, fill=tk.BOTH, pady=10)
-
-        columns = ("Filename", "Shared By", "IP", "Port")
-        self.files_tree = ttk.Treeview(tree_frame, columns=columns, show='headings', selectmode='browse')
-        self.files_tree.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
-
-        # Define headings
-        for col in columns:
-            self.files_tree.heading(col, text=col)
-
-        # Configure columns
-        self.files_tree.column("Filename", width=300, anchor='center')
-        self.files_tree.column("Shared By", width=200, anchor='center')
-        self.files_tree.column("IP", width=200, anchor='center')
-        self.files_tree.column("Port", width=100, anchor='center')
-
-        # Add scrollbar
-        scrollbar = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=self.files_tree.yview)
-        self.files_tree.configure(yscrollcommand=scrollbar.set)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        ttk.Label(search_frame, text="Filter:", style='TLabel', background=self.colors['background']).grid(row=1, column=0, padx=10, pady=10, sticky='e')
+        self.filter_var = tk.StringVar()
+        filter_entry = ttk.Entry(search_frame, width=30, textvariable=self.filter_var)
+        filter_entry.grid(row=1, column=1, padx=10, pady=10)
+        self.create_tooltip(filter_entry, "Narrow the list below as you type, without asking the server")
+        self.file_count_label = ttk.Label(search_frame, text="", style='TLabel', background=self.colors['background'])
+        self.file_count_label.grid(row=1, column=2, columnspan=2, padx=10, pady=10, sticky='w')
+        self.filter_var.trace_add('write', lambda *args: self.apply_filter())
+
+        # Only the rows on screen exist as Treeview items, however long the catalog is;
+        # the content digest is kept on each row but not displayed
+        self.files_list = VirtualFileList(bg_frame, ("Filename", "Shared By", "IP", "Port"),
+                                          (300, 200, 200, 100))
+        self.files_list.pack(expand=True, fill=tk.BOTH, pady=10)
+
+        # Downloads Frame
+        downloads_frame = ttk.Frame(bg_frame)
+        downloads_frame.pack(fill=tk.X, pady=10)
+
+        download_columns = ("File", "Status", "Progress", "Speed", "Priority")
+        self.downloads_tree = ttk.Treeview(downloads_frame, columns=download_columns, show='headings',
+                                           height=5, selectmode='browse')
+        for col in download_columns:
+            self.downloads_tree.heading(col, text=col)
+        self.downloads_tree.column("File", width=300, anchor='w')
+        self.downloads_tree.column("Status", width=200, anchor='center')
+        self.downloads_tree.column("Progress", width=100, anchor='center')
+        self.downloads_tree.column("Speed", width=200, anchor='center')
+        self.downloads_tree.column("Priority", width=80, anchor='center')
+        self.downloads_tree.pack(side=tk.LEFT, expand=True, fill=tk.X)
+
+        download_buttons = ttk.Frame(downloads_frame)
+        download_buttons.pack(side=tk.RIGHT, padx=10)
+        for text, command, tip in (
+                ("Pause", self.pause_download, "Stop the selected download, keeping what has arrived"),
+                ("Resume", self.resume_download, "Queue the selected download again"),
+                ("Cancel", self.cancel_download, "Stop the selected download and delete its partial file"),
+                ("Raise Priority", self.raise_download_priority, "Start the selected download sooner"),
+                ("Clear Finished", self.clear_finished_downloads, "Remove finished downloads from the list")):
+            button = ttk.Button(download_buttons, text=text, command=command)
+            button.pack(fill=tk.X, pady=2)
+            self.create_tooltip(button, tip)
 
         # Progress and Status Frame
         status_frame = tk.Frame(bg_frame, bg=self.colors['background'])
@@ -217,17 +252,6 @@ class PeerClient:
         """Create a tooltip for a given widget."""
         tooltip = Tooltip(widget, text)
 
-    def get_local_ip(self):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(('8.8.8.8', 80))
-            ip = s.getsockname()[0]
-        except Exception:
-            ip = '127.0.0.1'
-        finally:
-            s.close()
-        return ip
-
     def login(self):
         username = self.username_entry.get()
         password = self.password_entry.get()
@@ -236,51 +260,15 @@ class PeerClient:
             messagebox.showerror("Error", "Please enter both username and password")
             return
 
-        data = {
-            'username': username,
-            'password': password,
-            'ip': self.ip,
-            'port': self.listening_port
-        }
-
         try:
-            response = requests.post(f"{self.server_url}/login", json=data)
-            if response.status_code == 200:
-                self.username = username
-                self.is_logged_in = True  # Set login status
-                messagebox.showinfo("Success", "Login successful!")
-                self.notebook.tab(1, state='normal')
-                self.notebook.select(1)
-                self.start_peer_server()
-                self.start_heartbeat()  # Start heartbeat after successful login
-                self.share_files()
-                self.refresh_files()
-            else:
-                messagebox.showerror("Error", "Invalid credentials")
-        except requests.RequestException as e:
-            messagebox.showerror("Error", f"Connection error: {str(e)}")
-
-    def start_heartbeat(self):
-        """Start the heartbeat thread"""
-        self.heartbeat_thread = threading.Thread(target=self.send_heartbeat)
-        self.heartbeat_thread.daemon = True
-        self.heartbeat_thread.start()
-
-    def send_heartbeat(self):
-        """Send periodic heartbeat to server"""
-        while self.is_running and self.is_logged_in:
-            try:
-                data = {
-                    'username': self.username,
-                    'ip': self.ip,
-                    'port': self.listening_port
-                }
-                response = requests.post(f"{self.server_url}/heartbeat", json=data)
-                if response.status_code != 200:
-                    print(f"Heartbeat failed: {response.status_code}")
-            except Exception as e:
-                print(f"Heartbeat error: {str(e)}")
-            time.sleep(30)  # Send heartbeat every 30 seconds
+            self.engine.login(username, password)
+        except EngineError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        messagebox.showinfo("Success", "Login successful!")
+        self.notebook.tab(1, state='normal')
+        self.notebook.select(1)
+        self.refresh_files()
 
     def signup(self):
         username = self.username_entry.get()
@@ -290,58 +278,63 @@ class PeerClient:
             messagebox.showerror("Error", "Please enter both username and password")
             return
 
-        data = {
-            'username': username,
-            'password': password,
-            'ip': self.ip,
-            'port': self.port
-        }
-
         try:
-            response = requests.post(f"{self.server_url}/register", json=data)
-            if response.status_code == 200:
-                messagebox.showinfo("Success", "Registration successful! Please login.")
-            else:
-                messagebox.showerror("Error", "Username already exists")
-        except requests.RequestException as e:
-            messagebox.showerror("Error", f"Connection error: {str(e)}")
+            self.engine.register(username, password)
+            messagebox.showinfo("Success", "Registration successful! Please login.")
+        except EngineError as e:
+            messagebox.showerror("Error", str(e))
+
+    def show_background_error(self, message):
+        """Report a failure from one of the engine's threads"""
+        self.events.call(messagebox.showerror, "Error", message)
+
+    def pump_events(self):
+        """Apply what worker threads reported since the last frame (runs on the Tk thread)"""
+        latest, calls = self.events.drain()
+        for key, value in latest.items():
+            self.event_handlers[key](value)
+        for func, args in calls:
+            func(*args)
+        if self.is_running:
+            self.master.after(FRAME_MS, self.pump_events)
+
+    def show_files(self, files):
+        self.files_list.set_rows([(file[0], file[1], file[2], file[3],
+                                   file[5] if len(file) > 5 and file[5] else '')
+                                  for file in files])
+        self.update_file_count()
+
+    def apply_filter(self):
+        self.files_list.set_filter(self.filter_var.get())
+        self.update_file_count()
+
+    def update_file_count(self):
+        shown, total = len(self.files_list), len(self.files_list.rows)
+        self.file_count_label.config(text=f"{shown} of {total} files" if shown != total
+                                     else f"{total} files")
 
     def refresh_files(self):
         try:
-            response = requests.get(f"{self.server_url}/files")
-            if response.status_code == 200:
-                files = response.json().get('files', [])
-                for i in self.files_tree.get_children():
-                    self.files_tree.delete(i)
-                for file in files:
-                    self.files_tree.insert('', 'end', values=(file[0], file[1], file[2], file[3]))
-            else:
-                messagebox.showerror("Error", "Failed to fetch files")
-        except requests.RequestException as e:
-            messagebox.showerror("Error", f"Failed to fetch files: {str(e)}")
+            files, etag = self.engine.list_files(self.files_etag)
+        except EngineError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        if files is None:
+            return  # The list on screen is already current
+        self.files_etag = etag
+        self.show_files(files)
 
     def search_files(self):
         filename_query = self.search_filename_entry.get().strip()
         username_query = self.search_username_entry.get().strip()
 
-        params = {}
-        if filename_query:
-            params['filename'] = filename_query
-        if username_query:
-            params['username'] = username_query
-
         try:
-            response = requests.get(f"{self.server_url}/search_files", params=params)
-            if response.status_code == 200:
-                files = response.json().get('files', [])
-                for i in self.files_tree.get_children():
-                    self.files_tree.delete(i)
-                for file in files:
-                    self.files_tree.insert('', 'end', values=(file[0], file[1], file[2], file[3]))
-            else:
-                messagebox.showerror("Error", "Failed to search files")
-        except requests.RequestException as e:
-            messagebox.showerror("Error", f"Failed to search files: {str(e)}")
+            files = self.engine.search_files(filename_query, username_query)
+        except EngineError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        self.files_etag = None  # The tree no longer shows the full listing
+        self.show_files(files)
 
     def clear_search(self):
         self.search_filename_entry.delete(0, tk.END)
@@ -351,199 +344,186 @@ class PeerClient:
     def add_shared_file(self):
         filename = filedialog.askopenfilename()
         if filename:
-            dest = Path("shared_files") / Path(filename).name
-            try:
-                with open(filename, 'rb') as src, open(dest, 'wb') as dst:
-                    dst.write(src.read())
-                self.share_files()
-                self.refresh_files()
-                messagebox.showinfo("Success", f"File '{Path(filename).name}' shared successfully!")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to share file: {str(e)}")
-
-    def share_files(self):
-        """Share files with the central server"""
-        shared_dir = Path("shared_files")
-        if not shared_dir.exists():
-            shared_dir.mkdir()
-
-        files = [f.name for f in shared_dir.glob('*') if f.is_file()]
-        if files:
-            data = {
-                'username': self.username,
-                'filename': files,
-                'peer_ip': self.ip,
-                'peer_port': self.listening_port  # Send our listening port
-            }
-            try:
-                print(f"Sharing files with server. Our listening port: {self.listening_port}")
-                response = requests.post(f"{self.server_url}/share_files", json=data)
-                if response.status_code != 200:
-                    messagebox.showerror("Error", "Failed to share files")
-            except requests.RequestException as e:
-                messagebox.showerror("Error", f"Failed to share files: {str(e)}")
+            # Linking/copying and hashing can take a while for big files
+            thread = threading.Thread(target=self.import_shared_file,
+                                      args=(filename, self.share_in_place_var.get()), daemon=True)
+            thread.start()
+
+    def import_shared_file(self, filename, in_place):
+        """Worker: place a file in shared_files, hash it and announce it"""
+        name = Path(filename).name
+        try:
+            self.events.post('status', f"Adding '{name}' to shared files...")
+
+            def on_progress(done, total):
+                self.events.post('progress', done / total * 100 if total else 100)
+
+            self.engine.import_shared_file(filename, in_place, on_progress)
+
+            self.events.call(self.refresh_files)
+            self.events.post('status', f"Shared '{name}'")
+            self.events.call(messagebox.showinfo, "Success", f"File '{name}' shared successfully!")
+        except Exception as e:
+            self.events.post('status', "Sharing failed!")
+            self.events.call(messagebox.showerror, "Error", f"Failed to share file: {str(e)}")
+        finally:
+            self.events.post('progress', 0)
 
     def download_file(self):
-        selected_item = self.files_tree.selection()
-        if not selected_item:
+        values = self.files_list.selected()
+        if not values:
             messagebox.showinfo("Info", "Please select a file to download")
             return
         try:
-            item = self.files_tree.item(selected_item)
-            values = item['values']
-            filename = values[0]
+            filename = str(values[0])
             peer_ip = values[2]
             peer_port = int(values[3])
+            digest = str(values[4]) if len(values) > 4 and values[4] else None
 
-            print(f"Attempting to connect to {peer_ip}:{peer_port} for file '{filename}'")  # Debug print
-
-            # Start download in a separate thread
-            thread = threading.Thread(target=self.transfer_file,
-                                      args=(peer_ip, peer_port, filename))
-            thread.start()
+            self.engine.download(filename, peer_ip, peer_port, digest, swarm=self.swarm_var.get())
+            self.status_label.config(text=f"Queued '{filename}'")
         except Exception as e:
             print(f"Error while parsing: {str(e)}")  # Debug print
             messagebox.showerror("Error", f"Failed to parse file information: {str(e)}")
 
-    def transfer_file(self, peer_ip, peer_port, filename):
-        """Download a file from another peer"""
-        try:
-            self.status_label.config(text="Connecting to peer...")
-            self.progress_var.set(0)
-            self.speed_label.config(text="Transfer Speed: 0 KB/s")  # Reset speed label
-
-            print(f"Attempting to connect to {peer_ip}:{peer_port} for file '{filename}'")  # Debug print
-
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(10)
-                s.connect((peer_ip, peer_port))
-                s.sendall(filename.encode())
-
-                response = s.recv(1024).decode()
-                if response == "FILE_NOT_FOUND":
-                    raise Exception("File not found on peer")
-
-                file_size = int(response)
-                self.status_label.config(text="Downloading...")
-
-                save_path = Path('downloads') / filename
-                received = 0
-
-                start_time = time.time()
-                last_update_time = start_time
-                bytes_since_last = 0
-
-                with open(save_path, 'wb') as f:
-                    while received < file_size:
-                        chunk = s.recv(8192)
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                        chunk_size = len(chunk)
-                        received += chunk_size
-                        bytes_since_last += chunk_size
-
-                        # Update progress
-                        progress = (received / file_size) * 100
-                        self.progress_var.set(progress)
-
-                        current_time = time.time()
-                        elapsed_since_last = current_time - last_update_time
-
-                        if elapsed_since_last >= 1:  # Update every second
-                            speed = bytes_since_last / elapsed_since_last  # Bytes per second
-                            speed_kb = speed / 1024  # Convert to KB/s
-                            speed_str = f"Transfer Speed: {speed_kb:.2f} KB/s"
-
-                            # Update the speed label in the main thread
-                            self.master.after(0, lambda s=speed_str: self.speed_label.config(text=s))
-
-                            # Reset counters
-                            last_update_time = current_time
-                            bytes_since_last = 0
-
-                        # Update the UI
-                        self.master.update_idletasks()
-
-                self.status_label.config(text="Download complete!")
-                self.speed_label.config(text="Transfer Speed: 0 KB/s")  # Reset speed after completion
-                messagebox.showinfo("Success", f"File '{filename}' downloaded successfully!")
-
-        except Exception as e:
-            self.status_label.config(text="Download failed!")
-            self.speed_label.config(text="Transfer Speed: 0 KB/s")  # Reset speed on failure
-            messagebox.showerror("Error", f"Failed to download file: {str(e)}")
-        finally:
-            self.progress_var.set(0)
-
-    def start_peer_server(self):
-        self.server_thread = threading.Thread(target=self.run_peer_server)
-        self.server_thread.daemon = True
-        self.server_thread.start()
-
-    def run_peer_server(self):
-        """Server thread to receive files"""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((self.ip, self.listening_port))  # Use listening_port
-        server_socket.listen(5)
-        server_socket.settimeout(1)
-
-        print(f"Listening for incoming files on port {self.listening_port}")
-
-        while self.is_running:
+    def selected_download(self):
+        selected = self.downloads_tree.selection()
+        if not selected:
+            messagebox.showinfo("Info", "Please select a download")
+            return None
+        return int(selected[0])
+
+    def pause_download(self):
+        job_id = self.selected_download()
+        if job_id is not None:
+            self.downloads.pause(job_id)
+
+    def resume_download(self):
+        job_id = self.selected_download()
+        if job_id is not None:
+            self.downloads.resume(job_id)
+
+    def cancel_download(self):
+        job_id = self.selected_download()
+        if job_id is not None:
+            self.downloads.cancel(job_id)
+
+    def raise_download_priority(self):
+        job_id = self.selected_download()
+        if job_id is not None:
+            job = next(job for job in self.downloads.jobs() if job.id == job_id)
+            self.downloads.set_priority(job_id, job.priority + 1)
+
+    def clear_finished_downloads(self):
+        self.downloads.remove_finished()
+
+    def update_downloads_view(self):
+        """Redraw the downloads list from the queue's jobs (runs on the Tk thread)"""
+        jobs = self.downloads.jobs()
+        total_speed = 0
+        for job in jobs:
+            if job.state == RUNNING:
+                total_speed += job.speed
+            status = f"Failed: {job.error}" if job.state == FAILED else job.state.capitalize()
+            progress = f"{job.received / job.total * 100:.1f}%" if job.total else ""
+            speed = f"{job.speed / 1024:.2f} KB/s" if job.state == RUNNING else ""
+            if job.wire_speed is not None and job.state == RUNNING:
+                speed += f" ({job.wire_speed / 1024:.2f} on wire)"
+            values = (job.filename, status, progress, speed, job.priority)
+            iid = str(job.id)
+            if self.downloads_tree.exists(iid):
+                self.downloads_tree.item(iid, values=values)
+            else:
+                self.downloads_tree.insert('', tk.END, iid=iid, values=values)
+
+            if self.download_states.get(job.id) != job.state:
+                self.download_states[job.id] = job.state
+                if job.state == DONE:
+                    self.status_label.config(text=f"Downloaded '{job.filename}'")
+                elif job.state == FAILED:
+                    self.status_label.config(text=f"Download of '{job.filename}' failed")
+
+        current = {str(job.id) for job in jobs}
+        for iid in self.downloads_tree.get_children():
+            if iid not in current:
+                self.downloads_tree.delete(iid)
+                self.download_states.pop(int(iid), None)
+        self.speed_label.config(text=f"Transfer Speed: {total_speed / 1024:.2f} KB/s")
+        if self.is_running:
+            self.master.after(DOWNLOADS_REFRESH_MS, self.update_downloads_view)
+
+    def show_bandwidth_settings(self):
+        """Dialog for changing the rate limits, showing current per-connection speeds"""
+        window = tk.Toplevel(self.master)
+        window.title("Bandwidth Limits")
+        window.configure(bg=self.colors['background'])
+
+        form = ttk.Frame(window)
+        form.pack(fill=tk.X, padx=15, pady=10)
+        ttk.Label(form, text="Limits in KB/s; leave blank for unlimited").grid(
+            row=0, column=0, columnspan=3, pady=5)
+        ttk.Label(form, text="Total").grid(row=1, column=1)
+        ttk.Label(form, text="Per Peer").grid(row=1, column=2)
+
+        entries = {}
+        for row, limiter in enumerate((rate_limit.upload_limiter, rate_limit.download_limiter), 2):
+            ttk.Label(form, text=f"{limiter.name}:").grid(row=row, column=0, padx=5, sticky='e')
+            for column, rate in ((1, limiter.rate), (2, limiter.per_peer_rate)):
+                entry = ttk.Entry(form, width=10)
+                if rate:
+                    entry.insert(0, str(rate // 1024))
+                entry.grid(row=row, column=column, padx=5, pady=5)
+                entries[limiter, column] = entry
+
+        stats_label = ttk.Label(window, text="", justify=tk.LEFT)
+
+        def kbps(entry):
+            text = entry.get().strip()
+            return int(float(text) * 1024) if text else None
+
+        def apply():
             try:
-                conn, addr = server_socket.accept()
-                print(f"Received connection from {addr}")
-                threading.Thread(target=self.handle_peer_connection,
-                                 args=(conn, addr)).start()
-            except socket.timeout:
-                continue
-            except Exception as e:
-                print(f"Server error: {str(e)}")
-                break
-
-        server_socket.close()
-
-    def handle_peer_connection(self, conn, addr):
-        try:
-            filename = conn.recv(1024).decode()
-            file_path = Path('shared_files') / filename
-
-            if not file_path.exists():
-                conn.sendall(b"FILE_NOT_FOUND")
+                limits = [(limiter, kbps(entries[limiter, 1]), kbps(entries[limiter, 2]))
+                          for limiter in (rate_limit.upload_limiter, rate_limit.download_limiter)]
+            except ValueError:
+                messagebox.showerror("Error", "Limits must be numbers of KB/s", parent=window)
                 return
+            for limiter, rate, per_peer_rate in limits:
+                limiter.set_limits(rate, per_peer_rate)
 
-            file_size = file_path.stat().st_size
-            conn.sendall(str(file_size).encode())
-
-            with open(file_path, 'rb') as f:
-                while True:
-                    chunk = f.read(8192)
-                    if not chunk:
-                        break
-                    conn.sendall(chunk)
-
-        except Exception as e:
-            print(f"Error in peer connection: {str(e)}")
-        finally:
-            conn.close()
+        def refresh_stats():
+            if not window.winfo_exists():
+                return
+            lines = []
+            for limiter in (rate_limit.upload_limiter, rate_limit.download_limiter):
+                for stat in limiter.stats():
+                    lines.append(f"{limiter.name} {stat['peer']}: "
+                                 f"{stat['bytes_per_sec'] / 1024:.1f} KB/s, {stat['bytes']} bytes")
+            stats_label.config(text="\n".join(lines) or "No open transfers")
+            window.after(1000, refresh_stats)
+
+        ttk.Button(window, text="Apply", command=apply).pack(pady=5)
+        stats_label.pack(fill=tk.X, padx=15, pady=10)
+        refresh_stats()
+
+    def toggle_profiling(self):
+        if self.engine.profiler is None:
+            self.engine.start_profiling()
+            self.profile_button.config(text="Stop Profiling")
+            return
+        summary = self.engine.stop_profiling()
+        self.profile_button.config(text="Profile")
+        lines = [f"{entry['percent']:5.1f}%  {entry['frame']}" for entry in summary['top'][:8]]
+        messagebox.showinfo(
+            "Profile",
+            f"{summary['thread_samples']} samples over {summary['seconds']} s\n\n"
+            + ("\n".join(lines) or "No transfer threads were running")
+            + f"\n\nStacks written to {summary['path']}")
 
     def cleanup(self):
         """Clean up resources before closing"""
         self.is_running = False
-        self.is_logged_in = False
-
-        # Send one final request to let server know we're disconnecting
-        if self.username:
-            try:
-                data = {
-                    'username': self.username,
-                    'ip': self.ip,
-                    'port': self.listening_port
-                }
-                requests.post(f"{self.server_url}/disconnect", json=data)
-            except:
-                pass
+        self.engine.shutdown()
 
 # Tooltip Class
 class Tooltip:
@@ -0,0 +1,716 @@
+"""Wire helpers for the peer-to-peer transfer protocol.
+
+Current clients open a framed session.  The client sends ``MAGIC``, a
+protocol version byte and a HELLO frame; the server answers the same way
+with the version both sides will use.  After that every message is a
+frame::
+
+    type (1 byte) | flags (1) | request id (4) | payload length (8) | payload
+
+A GET frame's payload is ``offset, length`` (signed 64-bit) followed by the
+UTF-8 filename.  The server answers each GET, in order, with a DATA frame
+whose payload is the file size (64-bit) followed by the requested bytes,
+or with NOT_FOUND or ERROR carrying the same request id.  Clients may send
+many GETs before reading any answers, so a batch of small files costs one
+connection and no round trip per file.  Sessions are kept open between
+downloads by ``PeerPool``, so the next file from the same peer skips the
+connection setup as well.
+
+The HELLOs also settle on a compression codec (see ``compression``).  When
+the server compresses a response, its DATA frame has FLAG_CHUNKED set and
+carries the file size and uncompressed length only; the body follows as
+CHUNK frames, each either a compressed block (FLAG_COMPRESSED) or raw
+bytes, until the uncompressed length is reached.
+
+Older peers send no MAGIC; their requests are still served.  A legacy
+request is the bare filename; the serving peer answers with the decimal
+file size (or FILE_NOT_FOUND) followed by the whole file.  A range request
+is a single line::
+
+    RANGE <offset> <length> <filename>\\n
+
+answered by ``OK <file_size> <length>\\n`` followed by exactly ``length``
+bytes, or by ``FILE_NOT_FOUND\\n``.  A requested length of ``-1`` means
+"until the end of the file".
+
+File bodies are served with the kernel's zero-copy sendfile where the
+platform has it, and otherwise with large buffered reads.
+"""
+import json
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+import compression
+import rate_limit
+import transfer_stats
+
+MAGIC = b"\x00P2P"  # Filenames never start with NUL, so legacy requests can't match
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('!BBIQ')  # type, flags, request id, payload length
+GET_HEADER = struct.Struct('!qq')  # offset, length
+DATA_HEADER = struct.Struct('!Q')  # file size
+CHUNKED_DATA_HEADER = struct.Struct('!QQ')  # file size, uncompressed length
+FRAME_HELLO = 0
+FRAME_GET = 1
+FRAME_DATA = 2
+FRAME_NOT_FOUND = 3
+FRAME_ERROR = 4
+FRAME_CHUNK = 5
+FLAG_CHUNKED = 0x01  # DATA: body follows as CHUNK frames
+FLAG_COMPRESSED = 0x02  # CHUNK: payload is a compressed block
+SESSION_IDLE_TIMEOUT = 60  # Seconds a server keeps an idle framed session open
+PIPELINE_WINDOW = 32  # Requests a client keeps in flight on one connection
+POOL_IDLE_TIMEOUT = 30  # Below SESSION_IDLE_TIMEOUT, so peers don't close under us
+POOL_MAX_PER_PEER = 4
+
+RANGE_PREFIX = b"RANGE "
+FILE_NOT_FOUND = b"FILE_NOT_FOUND"
+MAX_HEADER = 4096
+SEND_BUFFER_SIZE = 1024 * 1024  # Chunk size when sendfile is unavailable
+
+
+class PeerProtocolError(Exception):
+    """Raised when a peer sends something we cannot understand"""
+
+
+def build_range_request(filename, offset=0, length=-1):
+    return f"RANGE {offset} {length} {filename}\n".encode()
+
+
+def parse_range_request(line):
+    """Return (filename, offset, length) for a RANGE request line"""
+    try:
+        _, offset, length, filename = line.decode().rstrip("\n").split(" ", 3)
+        return filename, int(offset), int(length)
+    except ValueError:
+        raise PeerProtocolError(f"Malformed range request: {line[:80]!r}")
+
+
+def clamp_range(file_size, offset, length):
+    """Clamp a requested range to the file, returning (offset, length)"""
+    offset = max(0, min(offset, file_size))
+    if length < 0 or offset + length > file_size:
+        length = file_size - offset
+    return offset, length
+
+
+def parse_request(data):
+    """Decode a complete request into ``(filename, offset, length, is_range)``.
+
+    Legacy requests are reported as a range covering the whole file.
+    """
+    if not data.startswith(RANGE_PREFIX):
+        return data.decode(), 0, -1, False
+    filename, offset, length = parse_range_request(data)
+    return filename, offset, length, True
+
+
+def request_complete(data):
+    """Whether data holds a whole request (legacy requests are one recv)"""
+    if len(data) > MAX_HEADER:
+        raise PeerProtocolError("Range request header too long")
+    return not data.startswith(RANGE_PREFIX) or data.endswith(b"\n")
+
+
+def response_header(file_size, length, is_range):
+    if is_range:
+        return f"OK {file_size} {length}\n".encode()
+    return str(file_size).encode()
+
+
+def not_found_response(is_range):
+    return FILE_NOT_FOUND + (b"\n" if is_range else b"")
+
+
+def read_request(conn):
+    """Read one request from a connected peer socket"""
+    data = conn.recv(1024)
+    while not request_complete(data):
+        more = conn.recv(1024)
+        if not more:
+            break
+        data += more
+    return parse_request(data)
+
+
+def send_file_range(conn, f, offset, length):
+    """Send length bytes of the open file f starting at offset.
+
+    Returns the number of bytes sent, which is less than length only if
+    the file shrank underneath us.
+    """
+    if length <= 0:
+        return 0
+    if hasattr(os, 'sendfile'):
+        # Data goes straight from the page cache to the socket
+        return conn.sendfile(f, offset, length)
+    return send_file_buffered(conn, f, offset, length)
+
+
+def send_file_buffered(conn, f, offset, length):
+    f.seek(offset)
+    buffer = bytearray(min(SEND_BUFFER_SIZE, length))
+    view = memoryview(buffer)
+    sent = 0
+    while sent < length:
+        read = f.readinto(view[:min(len(buffer), length - sent)])
+        if not read:
+            break
+        conn.sendall(view[:read])
+        sent += read
+    return sent
+
+
+def pack_frame(frame_type, request_id, payload=b"", flags=0):
+    return FRAME_HEADER.pack(frame_type, flags, request_id, len(payload)) + payload
+
+
+def hello(options=None):
+    """Opening bytes of a framed session, for either side"""
+    payload = json.dumps(options or {}).encode()
+    return MAGIC + bytes([PROTOCOL_VERSION]) + pack_frame(FRAME_HELLO, 0, payload)
+
+
+def build_get(request_id, filename, offset=0, length=-1):
+    return pack_frame(FRAME_GET, request_id,
+                      GET_HEADER.pack(offset, length) + filename.encode())
+
+
+def parse_get(payload):
+    """Return (filename, offset, length) from a GET frame's payload"""
+    if len(payload) < GET_HEADER.size:
+        raise PeerProtocolError("Truncated GET frame")
+    offset, length = GET_HEADER.unpack_from(payload)
+    try:
+        return payload[GET_HEADER.size:].decode(), offset, length
+    except UnicodeDecodeError:
+        raise PeerProtocolError("GET frame filename is not UTF-8")
+
+
+def data_header(request_id, file_size, length):
+    """Frame header and file size preceding length bytes of file data"""
+    return (FRAME_HEADER.pack(FRAME_DATA, 0, request_id, DATA_HEADER.size + length)
+            + DATA_HEADER.pack(file_size))
+
+
+def chunked_data_header(request_id, file_size, length):
+    """DATA frame announcing a body of length bytes sent as CHUNK frames"""
+    return pack_frame(FRAME_DATA, request_id,
+                      CHUNKED_DATA_HEADER.pack(file_size, length), FLAG_CHUNKED)
+
+
+def unpack_frame_header(header):
+    """Return (frame_type, flags, request_id, length), checking control frames' size"""
+    frame_type, flags, request_id, length = FRAME_HEADER.unpack(header)
+    if frame_type not in (FRAME_DATA, FRAME_CHUNK) and length > MAX_HEADER:
+        raise PeerProtocolError(f"Oversized frame ({length} bytes)")
+    return frame_type, flags, request_id, length
+
+
+def unpack_request_header(header):
+    """unpack_frame_header for servers, which only take HELLO and GET frames.
+
+    Anything else is refused before its payload is read, so a client
+    can't make a server buffer a DATA or CHUNK frame of any size.
+    """
+    frame_type, flags, request_id, length = FRAME_HEADER.unpack(header)
+    if frame_type not in (FRAME_HELLO, FRAME_GET):
+        raise PeerProtocolError(f"Unexpected frame type {frame_type}")
+    if length > MAX_HEADER:
+        raise PeerProtocolError(f"Oversized frame ({length} bytes)")
+    return frame_type, flags, request_id, length
+
+
+def shared_path(shared_dir, filename):
+    """Path of filename in shared_dir, or None if it names something outside it.
+
+    Symlinks are not resolved: files shared in place are links to
+    elsewhere.  Absolute names and ".." are what gets refused.
+    """
+    root = os.path.abspath(shared_dir)
+    path = os.path.abspath(os.path.join(root, filename))
+    if path == root or os.path.commonpath([root, path]) != root:
+        return None
+    return path
+
+
+def read_exact(reader, n):
+    """Read exactly n bytes from a buffered reader"""
+    data = reader.read(n)
+    if len(data) != n:
+        raise ConnectionError(f"Peer closed connection with {n - len(data)} bytes outstanding")
+    return data
+
+
+def check_greeting(greeting):
+    """Return the version from the MAGIC + version bytes opening a session"""
+    if len(greeting) != len(MAGIC) + 1 or not greeting.startswith(MAGIC):
+        raise PeerProtocolError(f"Peer does not speak the framed protocol: {greeting[:80]!r}")
+    return min(greeting[-1], PROTOCOL_VERSION)
+
+
+def read_hello(reader, unpack=unpack_frame_header):
+    """Read the greeting and HELLO frame from the other side of a session.
+
+    Returns (version, options).
+    """
+    version = check_greeting(reader.read(len(MAGIC) + 1))
+    frame_type, _, _, length = unpack(read_exact(reader, FRAME_HEADER.size))
+    if frame_type != FRAME_HELLO:
+        raise PeerProtocolError(f"Expected HELLO, got frame type {frame_type}")
+    return version, json.loads(read_exact(reader, length) or b"{}")
+
+
+def is_framed(conn):
+    """Whether the client on conn opened a framed session (peeks, consumes nothing)"""
+    return conn.recv(1, socket.MSG_PEEK) == MAGIC[:1]
+
+
+def send_compressed(conn, f, request_id, offset, length, codec, stats, send=send_file_range):
+    """Send a range as CHUNK frames, compressed for as long as that pays off"""
+    for packed, raw_offset in stats.timed(
+            'cpu', compression.iter_blocks(f, offset, length, codec)):
+        if packed is not None:
+            with stats.timing('send', stats.meter):
+                conn.sendall(pack_frame(FRAME_CHUNK, request_id, packed, FLAG_COMPRESSED))
+            continue
+        rest = offset + length - raw_offset
+        with stats.timing('send', stats.meter):
+            conn.sendall(FRAME_HEADER.pack(FRAME_CHUNK, 0, request_id, rest))
+            sent = send(conn, f, raw_offset, rest)
+        if sent != rest:
+            raise ConnectionError("File shrank while being sent")
+
+
+def serve_framed_session(conn, shared_dir='shared_files', send=send_file_range, codecs=None):
+    """Answer framed requests on conn until the client hangs up.
+
+    The caller has already seen the leading NUL of MAGIC (without
+    consuming it); send(conn, f, offset, length) writes file data.  codecs
+    limits the compression codecs offered (default: all available).  Each
+    request served is recorded in transfer_stats.
+    """
+    conn.settimeout(SESSION_IDLE_TIMEOUT)
+    # Frame headers are small writes; don't let Nagle hold them back
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = conn.makefile('rb')
+    meter = getattr(conn, 'meter', None)
+    try:
+        peer = conn.getpeername()[0]
+        _, options = read_hello(reader, unpack_request_header)
+        codec = compression.choose(options.get('codecs', []), codecs)
+        conn.sendall(hello({'codec': codec}))
+        while True:
+            header = reader.read(FRAME_HEADER.size)
+            if not header:
+                return  # Client is done
+            if len(header) != FRAME_HEADER.size:
+                raise ConnectionError("Peer closed connection mid-frame")
+            frame_type, _, request_id, length = unpack_request_header(header)
+            payload = read_exact(reader, length)
+            if frame_type != FRAME_GET:
+                conn.sendall(pack_frame(FRAME_ERROR, request_id,
+                                        f"Unexpected frame type {frame_type}".encode()))
+                continue
+
+            filename, offset, length = parse_get(payload)
+            file_path = shared_path(shared_dir, filename)
+            if file_path is None or not os.path.isfile(file_path):
+                conn.sendall(pack_frame(FRAME_NOT_FOUND, request_id))
+                continue
+            with open(file_path, 'rb') as f, transfer_stats.TransferStats(
+                    'upload', peer, filename, offset, 'framed', meter) as stats:
+                file_size = os.fstat(f.fileno()).st_size
+                offset, length = clamp_range(file_size, offset, length)
+                if codec and compression.worth_compressing(filename, length):
+                    with stats.timing('send', meter):
+                        conn.sendall(chunked_data_header(request_id, file_size, length))
+                    send_compressed(conn, f, request_id, offset, length, codec, stats, send)
+                    stats.bytes = length
+                    continue
+                with stats.timing('send', meter):
+                    conn.sendall(data_header(request_id, file_size, length))
+                    stats.bytes = send(conn, f, offset, length)
+                if stats.bytes != length:
+                    # The frame promised more than the file now holds
+                    raise ConnectionError(f"'{filename}' shrank while being sent")
+    finally:
+        reader.close()
+
+
+class PeerConnection:
+    """Client side of a framed session with one peer.
+
+    Requests are sent with ``send_request`` and answered strictly in order;
+    ``read_response`` returns the next answer's (request_id, file_size,
+    length), after which exactly ``length`` body bytes must be consumed with
+    ``iter_body`` or ``read_body`` before reading the next response.
+
+    codecs are the compression codecs to offer (default: all available, an
+    empty list for none).  ``wire_bytes`` and ``logical_bytes`` count body
+    bytes as received and after decompression.  With a limiter, reading
+    is paced to its download limits, which the peer feels as backpressure.
+    """
+
+    def __init__(self, peer_ip, peer_port, timeout=10, codecs=None, limiter=None):
+        self.peer = (peer_ip, peer_port)
+        self.sock = socket.create_connection(self.peer, timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.reader = None
+        self.closed = False
+        self.idle_since = None
+        self.wire_bytes = 0
+        self.logical_bytes = 0
+        self.limiter = limiter or rate_limit.RateLimiter("Download")
+        self.meter = self.limiter.open(peer_ip)
+        codecs = compression.available() if codecs is None else codecs
+        try:
+            self.sock.sendall(hello({'codecs': codecs}))
+            self.reader = self.sock.makefile('rb')
+            self.version, self.options = read_hello(self.reader)
+        except Exception:
+            self.close()
+            raise
+        self.codec = self.options.get('codec')
+        if self.codec is not None and self.codec not in codecs:
+            self.close()
+            raise PeerProtocolError(f"Peer chose codec {self.codec!r}, which we didn't offer")
+        self._next_id = 1
+        self._pending = deque()  # request ids sent but not yet answered
+        self._unread = 0  # Body bytes of the current response not yet consumed
+        self._decoder = None  # Codec state while reading a chunked body
+        self._raw_left = 0  # Bytes left in the current raw CHUNK
+
+    def send_request(self, filename, offset=0, length=-1):
+        request_id = self._next_id
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+        try:
+            self.sock.sendall(build_get(request_id, filename, offset, length))
+        except Exception:
+            self.close()  # A partly sent frame leaves the session unusable
+            raise
+        self._pending.append((request_id, filename))
+        return request_id
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def read_response(self):
+        """Header of the answer to the oldest outstanding request.
+
+        Raises FileNotFoundError if the peer doesn't have the file.  Any
+        other failure leaves the session out of step, so it is closed.
+        """
+        expected_id, filename = self._pending.popleft()
+        try:
+            return self._read_response(expected_id, filename)
+        except FileNotFoundError:
+            raise
+        except Exception:
+            self.close()
+            raise
+
+    def _read_response(self, expected_id, filename):
+        frame_type, flags, request_id, length = unpack_frame_header(
+            read_exact(self.reader, FRAME_HEADER.size))
+        if request_id != expected_id:
+            raise PeerProtocolError(f"Response for request {request_id}, expected {expected_id}")
+        if frame_type == FRAME_DATA and flags & FLAG_CHUNKED:
+            if length != CHUNKED_DATA_HEADER.size or self.codec is None:
+                raise PeerProtocolError("Malformed chunked DATA frame")
+            file_size, self._unread = CHUNKED_DATA_HEADER.unpack(
+                read_exact(self.reader, length))
+            self._decoder = compression.codec(self.codec)
+            self._raw_left = 0
+            return request_id, file_size, self._unread
+        if frame_type == FRAME_DATA:
+            self._decoder = None
+            if length < DATA_HEADER.size:
+                raise PeerProtocolError("Truncated DATA frame")
+            file_size, = DATA_HEADER.unpack(read_exact(self.reader, DATA_HEADER.size))
+            self._unread = length - DATA_HEADER.size
+            return request_id, file_size, self._unread
+        payload = read_exact(self.reader, length)
+        if frame_type == FRAME_NOT_FOUND:
+            raise FileNotFoundError(f"File '{filename}' not found on peer")
+        if frame_type == FRAME_ERROR:
+            raise PeerProtocolError(f"Peer error: {payload.decode(errors='replace')}")
+        raise PeerProtocolError(f"Unexpected frame type {frame_type}")
+
+    def _read_raw(self, n):
+        chunk = self.reader.read(min(n, self.limiter.slice_size() or n))
+        if not chunk:
+            raise ConnectionError(f"Peer closed connection with {self._unread} bytes outstanding")
+        self.wire_bytes += len(chunk)
+        self.limiter.throttle(self.meter, len(chunk))
+        return chunk
+
+    def _read_chunk(self):
+        """Read the next CHUNK frame; returns its data, or b'' if it is raw"""
+        header = read_exact(self.reader, FRAME_HEADER.size)
+        frame_type, flags, _, length = unpack_frame_header(header)
+        if frame_type != FRAME_CHUNK:
+            raise PeerProtocolError(f"Expected CHUNK, got frame type {frame_type}")
+        self.wire_bytes += len(header)
+        if not flags & FLAG_COMPRESSED:
+            self._raw_left = length  # Read by the caller in chunk_size pieces
+            return b""
+        # Blocks only go out compressed when they shrink, so both sides are below BLOCK_SIZE
+        if length > compression.BLOCK_SIZE:
+            raise PeerProtocolError(f"Oversized compressed block ({length} bytes)")
+        payload = read_exact(self.reader, length)
+        self.wire_bytes += length
+        self.limiter.throttle(self.meter, len(header) + length)
+        try:
+            return self._decoder.decompress(payload, min(compression.BLOCK_SIZE, self._unread))
+        except compression.DecompressionError as e:
+            raise PeerProtocolError(f"Bad compressed block: {str(e)}")
+
+    def iter_body(self, length, chunk_size=65536):
+        """Yield a response body, decompressed, raising if the peer hangs up early"""
+        remaining = length
+        while remaining > 0:
+            if self._decoder is None:
+                chunk = self._read_raw(min(chunk_size, remaining))
+            elif self._raw_left:
+                chunk = self._read_raw(min(chunk_size, remaining, self._raw_left))
+                self._raw_left -= len(chunk)
+            else:
+                chunk = self._read_chunk()
+                if not chunk:
+                    continue
+            if len(chunk) > remaining:
+                raise PeerProtocolError("Peer sent more data than it announced")
+            remaining -= len(chunk)
+            self._unread -= len(chunk)
+            self.logical_bytes += len(chunk)
+            yield chunk
+
+    def read_body(self, length):
+        return b"".join(self.iter_body(length, max(length, 1)))
+
+    def is_reusable(self):
+        """Whether the session is idle and in step, and the peer hasn't hung up"""
+        if self.closed or self._pending or self._unread:
+            return False
+        try:
+            # An idle session has nothing to read; EOF or stray bytes mean it's unusable
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def fetch_many(self, requests, window=PIPELINE_WINDOW):
+        """Pipeline (filename, offset, length) requests, keeping up to window in flight.
+
+        Yields (file_size, data) for each request in order, or (None, None)
+        for files the peer doesn't have.
+        """
+        requests = iter(requests)
+        exhausted = False
+        while True:
+            while not exhausted and self.pending < window:
+                request = next(requests, None)
+                if request is None:
+                    exhausted = True
+                else:
+                    self.send_request(*request)
+            if not self.pending:
+                return
+            try:
+                _, file_size, length = self.read_response()
+            except FileNotFoundError:
+                yield None, None
+                continue
+            yield file_size, self.read_body(length)
+
+    def close(self):
+        if not self.closed:
+            self.limiter.close(self.meter)
+        self.closed = True
+        if self.reader is not None:
+            self.reader.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PeerPool:
+    """Framed sessions kept open per (peer_ip, peer_port) for reuse.
+
+    ``acquire`` hands out an idle session that passes a health check, or
+    opens a new one while the peer has fewer than max_per_peer; otherwise
+    it waits for one to be released.  Sessions idle for longer than
+    idle_timeout are closed.  Sessions are opened with limiter, if given.
+    """
+
+    def __init__(self, max_per_peer=POOL_MAX_PER_PEER, idle_timeout=POOL_IDLE_TIMEOUT,
+                 codecs=None, limiter=None):
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.codecs = codecs
+        self.limiter = limiter
+        self._lock = threading.Condition()
+        self._idle = {}  # peer -> [PeerConnection], most recently used last
+        self._open = {}  # peer -> number of sessions, idle or in use
+
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for peer, idle in list(self._idle.items()):
+            while idle and idle[0].idle_since < deadline:
+                self._close(idle.pop(0))
+            if not idle:
+                del self._idle[peer]
+
+    def _close(self, connection):
+        connection.close()
+        self._open[connection.peer] -= 1
+        if not self._open[connection.peer]:
+            del self._open[connection.peer]
+        self._lock.notify_all()
+
+    def acquire(self, peer_ip, peer_port, timeout=10):
+        peer = (peer_ip, peer_port)
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                self._evict_idle()
+                idle = self._idle.get(peer)
+                while idle:
+                    connection = idle.pop()
+                    if connection.is_reusable():
+                        connection.sock.settimeout(timeout)
+                        return connection
+                    self._close(connection)
+                if self._open.get(peer, 0) < self.max_per_peer:
+                    self._open[peer] = self._open.get(peer, 0) + 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No free connection to {peer_ip}:{peer_port}")
+                self._lock.wait(remaining)
+
+        try:
+            return PeerConnection(peer_ip, peer_port, timeout, self.codecs, self.limiter)
+        except Exception:
+            with self._lock:
+                self._open[peer] -= 1
+                if not self._open[peer]:
+                    del self._open[peer]
+                self._lock.notify_all()
+            raise
+
+    def release(self, connection):
+        """Return a session to the pool, or close it if it isn't reusable"""
+        with self._lock:
+            if connection.is_reusable():
+                connection.idle_since = time.monotonic()
+                self._idle.setdefault(connection.peer, []).append(connection)
+                self._lock.notify_all()
+            else:
+                self._close(connection)
+            self._evict_idle()
+
+    def discard(self, connection):
+        with self._lock:
+            self._close(connection)
+
+    @contextmanager
+    def connection(self, peer_ip, peer_port, timeout=10):
+        """Borrow a session, dropping it instead of returning it on error"""
+        connection = self.acquire(peer_ip, peer_port, timeout)
+        try:
+            yield connection
+        except BaseException:
+            self.discard(connection)
+            raise
+        self.release(connection)
+
+    def close_all(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    self._close(connection)
+            self._idle = {}
+
+
+default_pool = PeerPool(limiter=rate_limit.download_limiter)
+
+
+class RangeResponse:
+    """Client side of a single range request.
+
+    Use as a context manager; ``file_size`` and ``length`` are available
+    once the peer has accepted the request.
+    """
+
+    def __init__(self, peer_ip, peer_port, filename, offset=0, length=-1, timeout=10,
+                 pool=default_pool):
+        self.filename = filename
+        self.offset = offset
+        self.pool = pool
+        self.connection = pool.acquire(peer_ip, peer_port, timeout)
+        self._wire_start = self.connection.wire_bytes
+        try:
+            self.connection.send_request(filename, offset, length)
+            _, self.file_size, self.length = self.connection.read_response()
+        except Exception:
+            self.close()
+            raise
+
+    def iter_chunks(self, chunk_size=65536):
+        """Yield the body of the response, raising if the peer hangs up early"""
+        return self.connection.iter_body(self.length, chunk_size)
+
+    @property
+    def wire_bytes(self):
+        """Bytes of this response received so far, before decompression"""
+        return self.connection.wire_bytes - self._wire_start
+
+    def close(self):
+        """Give the session back to the pool; it is only reused if the body was read"""
+        if self.connection is not None:
+            self.pool.release(self.connection)
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def probe_file_size(peer_ip, peer_port, filename, timeout=10):
+    """Ask a peer for the size of a file without transferring any of it"""
+    with RangeResponse(peer_ip, peer_port, filename, 0, 0, timeout) as response:
+        return response.file_size
+
+
+def fetch_range(peer_ip, peer_port, filename, offset, length, timeout=10, stats=None):
+    """Download ``length`` bytes starting at ``offset`` and return them.
+
+    With stats (a TransferStats), the time spent waiting on the peer is
+    added to its recv time.
+    """
+    with stats.timing('recv') if stats else nullcontext():
+        response = RangeResponse(peer_ip, peer_port, filename, offset, length, timeout)
+    with response:
+        if response.length != length:
+            raise PeerProtocolError(
+                f"Peer returned {response.length} bytes, expected {length}")
+        chunks = response.iter_chunks()
+        if stats:
+            chunks = stats.timed('recv', chunks, response.connection.meter)
+        return b"".join(chunks)
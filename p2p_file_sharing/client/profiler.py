@@ -0,0 +1,138 @@
+"""Opt-in sampling profiler for the peer server and transfer threads.
+
+While running, a background thread looks at every thread's Python stack
+``interval`` times a second (``sys._current_frames``) and counts the
+stacks of the threads it was asked to watch, by name prefix.  Nothing is
+traced and nothing is added to the watched threads, so it can be switched
+on for a slow download in progress and off again without restarting.
+
+Frames are labelled by function, except the innermost one, which keeps
+its line: a thread blocked in a socket read and one writing to disk show
+up on different lines of the same transfer loop.  Samples of threads
+parked waiting for work (an idle download worker, the accept loop, the
+event loop in select) are left out, so they don't drown the busy ones.
+``stop()`` writes the counts as collapsed stacks (one ``frame;frame;...
+count`` line per stack, as read by flamegraph.pl and speedscope) and
+returns a summary of the lines where the watched threads spent most of
+their samples.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+SAMPLE_INTERVAL = 0.005  # Seconds between samples
+PROFILE_DIR = Path('logs')
+# Download workers, swarm workers, the peer server and its compression threads
+PROFILED_THREADS = ('download', 'swarm', 'peer-')
+NAME_REFRESH = 200  # Samples between re-reading thread names, as idents get reused
+# A thread whose innermost frame outside these modules is one of IDLE_FRAMES
+# is waiting for work rather than doing it
+WAIT_MODULES = {'threading.py', 'queue.py', 'socket.py', 'selectors.py'}
+IDLE_FRAMES = {('_worker', 'download_queue.py'), ('run_peer_server', 'engine.py'),
+               ('_worker', 'thread.py'),
+               # The asyncio server's loop between callbacks
+               ('_run_once', 'base_events.py')}
+
+
+def _is_idle(frame):
+    while frame is not None:
+        code = frame.f_code
+        module = os.path.basename(code.co_filename)
+        if module not in WAIT_MODULES:
+            return (code.co_name, module) in IDLE_FRAMES
+        frame = frame.f_back
+    return False
+
+
+def _label(frame, leaf):
+    code = frame.f_code
+    where = frame.f_lineno if leaf else code.co_firstlineno
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{where})"
+
+
+class SamplingProfiler:
+    def __init__(self, interval=SAMPLE_INTERVAL, threads=PROFILED_THREADS):
+        """threads are name prefixes of the threads to sample"""
+        self.interval = interval
+        self.threads = tuple(threads)
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle = 0  # Samples of watched threads that were waiting for work
+        self.started = None
+        self.stopped = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self.started = time.time()
+        self.stopped = None
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self, path=None):
+        """Stop sampling, write the collapsed stacks to path and return a summary.
+
+        path defaults to a timestamped file in PROFILE_DIR.
+        """
+        if self._thread is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.stopped = time.time()
+        if path is None:
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            path = PROFILE_DIR / time.strftime('profile-%Y%m%d-%H%M%S.folded')
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        summary = self.summary()
+        summary['path'] = str(path)
+        return summary
+
+    def summary(self, top=15):
+        """Sample counts, and the innermost lines with the most samples"""
+        leaves = Counter()
+        for stack, count in list(self.stacks.items()):
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(leaves.values())
+        return {'running': self.running, 'interval': self.interval,
+                'seconds': round((self.stopped or time.time()) - self.started, 1)
+                if self.started else 0,
+                'samples': self.samples, 'thread_samples': total, 'idle_samples': self.idle,
+                'top': [{'frame': frame, 'samples': count,
+                         'percent': round(100 * count / total, 1)}
+                        for frame, count in leaves.most_common(top)]}
+
+    def _run(self):
+        names = {}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if frames.keys() - names.keys() or not self.samples % NAME_REFRESH:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                name = names.get(ident, '')
+                if not name.startswith(self.threads):
+                    continue
+                if _is_idle(frame):
+                    self.idle += 1
+                    continue
+                stack = []
+                leaf = True
+                while frame is not None:
+                    stack.append(_label(frame, leaf))
+                    leaf = False
+                    frame = frame.f_back
+                stack.append(name)
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
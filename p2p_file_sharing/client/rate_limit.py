@@ -0,0 +1,206 @@
+"""Token-bucket bandwidth limits for serving and downloading.
+
+A ``RateLimiter`` holds one bucket for all traffic in its direction and
+one per peer; a transfer spends tokens from both before moving each slice
+of data, sleeping while either is in debt.  Slices are small compared to
+the rate, and each caller queues behind the debt already taken on, so
+concurrent connections share the bandwidth roughly equally instead of the
+fastest one taking it all.
+
+Limits can be changed at any time with ``set_limits``; ``None`` means
+unlimited, in which case no slicing or sleeping happens at all.  Every
+open connection has a ``Meter`` counting what it moved, which
+``stats()`` reports so the limits can be checked under load.
+"""
+import itertools
+import threading
+import time
+
+BURST_SECONDS = 0.25  # Tokens a bucket can bank, in seconds of its rate
+MIN_SLICE = 4 * 1024
+MAX_SLICE = 256 * 1024
+PEER_BUCKET_IDLE = 60  # Seconds before an unused per-peer bucket is dropped
+
+
+class TokenBucket:
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate or None
+            self.burst = max(self.rate * BURST_SECONDS, MIN_SLICE) if self.rate else 0
+            self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, n):
+        """Take n tokens, returning how many seconds to wait before using them"""
+        with self._lock:
+            now = time.monotonic()
+            if not self.rate:
+                self.stamp = now
+                return 0.0
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, n):
+        """Give back n reserved tokens that were never used"""
+        with self._lock:
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + n)
+
+
+class Meter:
+    """Bytes moved over one connection, and seconds it was told to wait"""
+
+    def __init__(self, meter_id, peer):
+        self.id = meter_id
+        self.peer = peer
+        self.bytes = 0
+        self.waited = 0.0
+        self.started = time.monotonic()
+
+    def rate(self):
+        return self.bytes / max(time.monotonic() - self.started, 1e-6)
+
+
+class RateLimiter:
+    def __init__(self, name, rate=None, per_peer_rate=None):
+        """rate and per_peer_rate are in bytes per second; None for no limit"""
+        self.name = name
+        self._lock = threading.Lock()
+        self._global = TokenBucket(rate)
+        self.per_peer_rate = per_peer_rate or None
+        self._peers = {}  # peer -> (TokenBucket, last used)
+        self._meters = {}
+        self._ids = itertools.count(1)
+
+    @property
+    def rate(self):
+        return self._global.rate
+
+    @property
+    def limited(self):
+        return bool(self._global.rate or self.per_peer_rate)
+
+    def set_limits(self, rate=None, per_peer_rate=None):
+        """Change both limits; takes effect for the next slice of every transfer"""
+        self._global.set_rate(rate)
+        with self._lock:
+            self.per_peer_rate = per_peer_rate or None
+            for bucket, _ in self._peers.values():
+                bucket.set_rate(self.per_peer_rate)
+
+    def slice_size(self):
+        """How much to move between waits: about a tenth of a second's worth"""
+        rates = [rate for rate in (self._global.rate, self.per_peer_rate) if rate]
+        if not rates:
+            return None
+        return int(min(max(min(rates) / 10, MIN_SLICE), MAX_SLICE))
+
+    def _peer_bucket(self, peer):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._peers.get(peer)
+            bucket = entry[0] if entry else TokenBucket(self.per_peer_rate)
+            self._peers[peer] = (bucket, now)
+            if len(self._peers) > 256:
+                for key, (_, used) in list(self._peers.items()):
+                    if now - used > PEER_BUCKET_IDLE:
+                        del self._peers[key]
+            return bucket
+
+    def open(self, peer):
+        meter = Meter(next(self._ids), peer)
+        with self._lock:
+            self._meters[meter.id] = meter
+        return meter
+
+    def close(self, meter):
+        with self._lock:
+            self._meters.pop(meter.id, None)
+        if meter.bytes and self.limited:
+            print(f"{self.name}: {meter.bytes} bytes with {meter.peer} "
+                  f"at {meter.rate() / 1024:.1f} KB/s")
+
+    def delay(self, meter, n):
+        """Account n bytes to meter, returning how long to wait before moving them"""
+        meter.bytes += n
+        if not self.limited:
+            return 0.0
+        wait = max(self._global.reserve(n), self._peer_bucket(meter.peer).reserve(n))
+        meter.waited += wait
+        return wait
+
+    def refund(self, meter, n):
+        """Take back n bytes accounted with delay() that were not moved after all"""
+        meter.bytes -= n
+        if self.limited:
+            self._global.refund(n)
+            self._peer_bucket(meter.peer).refund(n)
+
+    def throttle(self, meter, n):
+        wait = self.delay(meter, n)
+        if wait > 0:
+            time.sleep(wait)
+
+    def stats(self):
+        """Per-connection throughput of the transfers currently open"""
+        with self._lock:
+            meters = list(self._meters.values())
+        return [{'peer': meter.peer, 'bytes': meter.bytes,
+                 'seconds': round(time.monotonic() - meter.started, 3),
+                 'bytes_per_sec': round(meter.rate(), 1),
+                 'waited': round(meter.waited, 3)} for meter in meters]
+
+
+class ThrottledSocket:
+    """A socket whose sends are metered, and paced by a RateLimiter"""
+
+    def __init__(self, sock, limiter, peer):
+        self._sock = sock
+        self.limiter = limiter
+        self.meter = limiter.open(peer)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        step = self.limiter.slice_size() or len(view) or 1
+        for start in range(0, len(view), step):
+            piece = view[start:start + step]
+            self.limiter.throttle(self.meter, len(piece))
+            self._sock.sendall(piece)
+
+    def sendfile(self, f, offset=0, count=None):
+        step = self.limiter.slice_size()
+        if not step:
+            sent = self._sock.sendfile(f, offset, count)
+            self.meter.bytes += sent
+            return sent
+        sent = 0
+        while sent < count:
+            n = min(step, count - sent)
+            self.limiter.throttle(self.meter, n)
+            just_sent = self._sock.sendfile(f, offset + sent, n)
+            if just_sent < n:
+                # The file ended early; only what went out counts
+                self.limiter.refund(self.meter, n - just_sent)
+            if not just_sent:
+                break
+            sent += just_sent
+        return sent
+
+    def close(self):
+        self.limiter.close(self.meter)
+        self._sock.close()
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+upload_limiter = RateLimiter("Upload")
+download_limiter = RateLimiter("Download")
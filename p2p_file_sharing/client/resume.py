@@ -0,0 +1,126 @@
+"""Sidecar state for resumable downloads.
+
+While a download is in progress its data lives in ``<name>.part`` next to
+the final path, and ``<name>.part.json`` records what has been written:
+
+    {"size": ..., "digest": ... or null, "piece_size": ...,
+     "received": <bytes received contiguously from the start>,
+     "pieces": [<indices of complete pieces>]}
+
+Single-peer downloads advance ``received``; swarm downloads fill in
+``pieces``.  Either kind of download can resume from either kind of state.
+The data file is always flushed before the state that describes it is
+written, and the state is replaced atomically, so after a crash the state
+never claims more than is on disk.
+"""
+import json
+import os
+import time
+from pathlib import Path
+
+CHECKPOINT_INTERVAL = 1.0  # Seconds between state file writes
+
+
+class DownloadState:
+    def __init__(self, save_path):
+        self.save_path = Path(save_path)
+        self.part_path = self.save_path.with_name(self.save_path.name + '.part')
+        self.state_path = self.save_path.with_name(self.save_path.name + '.part.json')
+        self.size = None
+        self.digest = None
+        self.piece_size = None
+        self.received = 0
+        self.pieces = set()
+        self._last_save = 0.0
+
+    def load(self):
+        """Read any existing state, returning True if there is something to resume"""
+        if not self.part_path.exists() or not self.state_path.exists():
+            return False
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self.size = state['size']
+            self.digest = state.get('digest')
+            self.piece_size = state.get('piece_size')
+            self.received = state.get('received', 0)
+            self.pieces = set(state.get('pieces', []))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable download state {self.state_path}: {str(e)}")
+            return False
+        return True
+
+    def matches(self, size, digest=None):
+        """Whether the saved partial download is of this file"""
+        if self.size != size:
+            return False
+        return not (digest and self.digest and digest != self.digest)
+
+    def start(self, size, digest=None, piece_size=None):
+        """Begin tracking a download, keeping saved progress if it still applies"""
+        if not (self.load() and self.matches(size, digest)):
+            self.discard()
+        elif piece_size and self.piece_size and piece_size != self.piece_size:
+            # Piece numbering changed; only the contiguous prefix carries over
+            self.received = self.contiguous_bytes()
+            self.pieces = set()
+        self.size = size
+        self.digest = digest or self.digest
+        self.piece_size = piece_size or self.piece_size
+
+    def _piece_length(self, index):
+        return min(self.piece_size, self.size - index * self.piece_size)
+
+    def contiguous_bytes(self):
+        """Bytes known to be on disk from the start of the file"""
+        received = self.received
+        if self.piece_size:
+            index = 0
+            while index in self.pieces:
+                index += 1
+            received = max(received, min(index * self.piece_size, self.size))
+        return min(received, self.size)
+
+    def done_pieces(self):
+        """Indices of pieces (of piece_size) already on disk"""
+        done = set(self.pieces)
+        if self.piece_size:
+            done.update(range(self.received // self.piece_size))
+            if self.received >= self.size and self.size:
+                done.add((self.size - 1) // self.piece_size)
+        return done
+
+    def open_part(self):
+        """Open the partial file for writing without discarding its contents"""
+        mode = 'r+b' if self.part_path.exists() else 'w+b'
+        f = open(self.part_path, mode)
+        f.truncate(self.size)
+        return f
+
+    def save(self, f=None, force=False):
+        """Checkpoint progress, at most once per CHECKPOINT_INTERVAL unless forced"""
+        now = time.time()
+        if not force and now - self._last_save < CHECKPOINT_INTERVAL:
+            return
+        if f is not None:
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path = self.state_path.with_name(self.state_path.name + '.tmp')
+        with open(tmp_path, 'w') as out:
+            json.dump({'size': self.size, 'digest': self.digest, 'piece_size': self.piece_size,
+                       'received': self.received, 'pieces': sorted(self.pieces)}, out)
+        os.replace(tmp_path, self.state_path)
+        self._last_save = now
+
+    def finish(self):
+        """Move the completed file into place and drop the sidecar"""
+        os.replace(self.part_path, self.save_path)
+        if self.state_path.exists():
+            self.state_path.unlink()
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            if path.exists():
+                path.unlink()
+        self.received = 0
+        self.pieces = set()
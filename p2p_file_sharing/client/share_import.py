@@ -0,0 +1,111 @@
+"""Adding a file from elsewhere on disk to the shared directory.
+
+Files are placed without copying where possible:
+
+* in place: a hard link (same filesystem), else a symbolic link, so the
+  data is never duplicated;
+* as a copy: a reflink (copy-on-write clone, Linux FICLONE) where the
+  filesystem supports it, else a streamed copy in 1 MB chunks.
+
+Either way the file's manifest is built in the same single pass over the
+data that the streamed copy (or, for links, a plain read) already makes.
+The new entry first appears under a hidden ``.<name>.partial`` name and is
+renamed into place once complete, so the share never exposes half a file.
+"""
+import os
+from pathlib import Path
+
+import manifest
+
+CHUNK_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # Linux ioctl to clone a file's extents
+
+
+def _reflink(src_path, dst_path):
+    """Try a copy-on-write clone, returning False if unsupported"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.unlink(dst_path)
+    return False
+
+
+def _hash_file(path, progress_callback):
+    hasher = manifest.PieceHasher()
+    total = os.path.getsize(path)
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            hasher.update(view[:read])
+            if progress_callback:
+                progress_callback(hasher.size, total)
+    return hasher.manifest()
+
+
+def _copy_and_hash(src_path, dst_path, progress_callback):
+    hasher = manifest.PieceHasher()
+    total = os.path.getsize(src_path)
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        while True:
+            read = src.readinto(buffer)
+            if not read:
+                break
+            dst.write(view[:read])
+            hasher.update(view[:read])
+            if progress_callback:
+                progress_callback(hasher.size, total)
+    return hasher.manifest()
+
+
+def stage_shared_file(src_path, shared_dir='shared_files', in_place=True,
+                      progress_callback=None):
+    """Prepare src_path for sharing under its own name.
+
+    Returns (staged_path, final_path, manifest, method).  The caller
+    renames the staged file to final_path once it is ready to announce it.
+    progress_callback(done, total) is called as the data is read.
+    """
+    src_path = Path(src_path)
+    final_path = Path(shared_dir) / src_path.name
+    staged_path = Path(shared_dir) / f".{src_path.name}.partial"
+    if staged_path.exists() or staged_path.is_symlink():
+        staged_path.unlink()
+
+    method = None
+    if in_place:
+        try:
+            os.link(src_path, staged_path)
+            method = 'hardlink'
+        except OSError:
+            try:
+                os.symlink(src_path.resolve(), staged_path)
+                method = 'symlink'
+            except (OSError, NotImplementedError):
+                pass
+    if method is None and _reflink(src_path, staged_path):
+        method = 'reflink'
+
+    try:
+        if method is None:
+            method = 'copy'
+            file_manifest = _copy_and_hash(src_path, staged_path, progress_callback)
+        else:
+            file_manifest = _hash_file(staged_path, progress_callback)
+    except Exception:
+        if staged_path.exists() or staged_path.is_symlink():
+            staged_path.unlink()
+        raise
+    return staged_path, final_path, file_manifest, method
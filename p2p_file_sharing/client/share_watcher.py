@@ -0,0 +1,102 @@
+"""Background watcher for the shared files directory.
+
+On Linux the directory is watched with inotify (through ctypes, so no
+extra dependency); elsewhere, or if inotify is unavailable, the directory
+is polled by comparing file sizes and mtimes against the share index.
+Bursts of events are debounced and then reported with one ``on_change()``
+call from the watcher thread.  ``on_change()`` is also called once when the
+watcher starts, as a full reconciliation after a quick startup scan.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import threading
+
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_DELETE = 0x200
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+
+def _inotify_fd(path):
+    """Return an inotify fd watching path, or None if inotify is unavailable"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+class ShareWatcher:
+    def __init__(self, index, on_change, poll_interval=10, debounce=1.0):
+        """
+        index is the ShareIndex for the directory; on_change() is called
+        with no arguments whenever the directory may have changed.
+        """
+        self.index = index
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _notify(self):
+        try:
+            self.on_change()
+        except Exception as e:
+            print(f"Share watcher error: {str(e)}")
+
+    def _run(self):
+        fd = _inotify_fd(self.index.shared_dir)
+        self._notify()
+        if fd is None:
+            print("inotify unavailable, polling shared files for changes")
+            self._run_polling()
+        else:
+            try:
+                self._run_inotify(fd)
+            finally:
+                os.close(fd)
+
+    def _run_inotify(self, fd):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([fd], [], [], 1.0)
+            if not ready:
+                continue
+            # Drain this burst of events; which files changed is worked out by the index
+            while ready:
+                os.read(fd, 65536)
+                if self._stop.wait(self.debounce):
+                    return
+                ready, _, _ = select.select([fd], [], [], 0)
+            self._notify()
+
+    def _run_polling(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                changed = self.index.has_changes()
+            except OSError as e:
+                print(f"Share watcher error: {str(e)}")
+                continue
+            if changed:
+                self._notify()
@@ -0,0 +1,132 @@
+"""Persistent index of the files in the shared directory.
+
+Every shared file is remembered in a small SQLite database together with
+the size and mtime it had when its manifest was built, so after a restart
+only files that were added, removed or touched since the last run need to
+be hashed again.  A scan is then one ``os.scandir`` pass plus a dictionary
+comparison.
+
+Startup can go further with ``refresh(quick=True)``: if the directory's own
+mtime is unchanged no file was added, removed or renamed, so the per-file
+stats are skipped.  Edits made in place to existing files don't touch the
+directory mtime, which is why the share watcher follows up with a full
+pass in the background.
+
+Hidden (dot) files are left out, which is where files being added to the
+share are staged until they are complete.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+import manifest
+
+
+class ShareIndex:
+    def __init__(self, shared_dir='shared_files', db_path='shared_index.db'):
+        self.shared_dir = shared_dir
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS entries
+                            (name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+                             digest TEXT, manifest TEXT)''')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS meta
+                            (key TEXT PRIMARY KEY, value INTEGER)''')
+        self._conn.commit()
+
+        # name -> (size, mtime_ns, digest); manifests stay on disk until needed
+        self._entries = {row[0]: row[1:] for row in self._conn.execute(
+            'SELECT name, size, mtime_ns, digest FROM entries')}
+        result = self._conn.execute("SELECT value FROM meta WHERE key = 'dir_mtime_ns'").fetchone()
+        self._dir_mtime_ns = result[0] if result else None
+
+    def _stat_dir(self):
+        """Return {name: (size, mtime_ns, path)} for regular files in the share"""
+        found = {}
+        with os.scandir(self.shared_dir) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    st = entry.stat()
+                    found[entry.name] = (st.st_size, st.st_mtime_ns, entry.path)
+        return found
+
+    def has_changes(self):
+        """Cheap check (stat only, no hashing) for differences from the index"""
+        found = self._stat_dir()
+        with self._lock:
+            if found.keys() != self._entries.keys():
+                return True
+            return any(self._entries[name][:2] != stat[:2] for name, stat in found.items())
+
+    def refresh(self, quick=False):
+        """Bring the index up to date with the directory.
+
+        Returns (added, changed, removed) lists of filenames.  With quick,
+        trust the index entirely if the directory mtime hasn't moved.
+        """
+        dir_mtime_ns = os.stat(self.shared_dir).st_mtime_ns
+        if quick and self._entries and dir_mtime_ns == self._dir_mtime_ns:
+            return [], [], []
+
+        found = self._stat_dir()
+        with self._lock:
+            removed = [name for name in self._entries if name not in found]
+            stale = {name: stat for name, stat in found.items()
+                     if name not in self._entries or self._entries[name][:2] != stat[:2]}
+
+        if stale:
+            print(f"Hashing {len(stale)} shared file(s)...")
+            built = manifest.build_manifests([stat[2] for stat in stale.values()])
+        else:
+            built = {}
+
+        added, changed = [], []
+        with self._lock:
+            rows = []
+            for name, (size, mtime_ns, path) in stale.items():
+                file_manifest = built[path]
+                (changed if name in self._entries else added).append(name)
+                self._entries[name] = (size, mtime_ns, file_manifest['digest'])
+                rows.append((name, size, mtime_ns, file_manifest['digest'],
+                             json.dumps(file_manifest)))
+            for name in removed:
+                del self._entries[name]
+
+            self._conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+            self._conn.executemany('DELETE FROM entries WHERE name = ?',
+                                   [(name,) for name in removed])
+            # Taken before the scan, so a change racing with it is seen next time
+            self._dir_mtime_ns = dir_mtime_ns
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('dir_mtime_ns', ?)",
+                               (dir_mtime_ns,))
+            self._conn.commit()
+        return added, changed, removed
+
+    def add(self, name, file_manifest):
+        """Record a file whose manifest was built while adding it to the share"""
+        st = os.stat(os.path.join(self.shared_dir, name))
+        with self._lock:
+            self._entries[name] = (st.st_size, st.st_mtime_ns, file_manifest['digest'])
+            self._conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                               (name, st.st_size, st.st_mtime_ns, file_manifest['digest'],
+                                json.dumps(file_manifest)))
+            self._conn.commit()
+
+    def digests(self):
+        with self._lock:
+            return {name: entry[2] for name, entry in self._entries.items()}
+
+    def manifests(self, names=None):
+        with self._lock:
+            if names is None:
+                rows = self._conn.execute('SELECT name, manifest FROM entries').fetchall()
+            else:
+                rows = [(name, self._conn.execute('SELECT manifest FROM entries WHERE name = ?',
+                                                  (name,)).fetchone()[0])
+                        for name in names]
+        return {name: json.loads(text) for name, text in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
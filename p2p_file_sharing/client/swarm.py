@@ -0,0 +1,303 @@
+"""Multi-source ("swarm") downloads.
+
+A file is split into fixed-size pieces and every peer that shares it gets
+its own worker thread pulling pieces off a common queue with range
+requests.  Fast peers therefore naturally take more pieces than slow ones.
+Once the queue is empty, idle workers re-request pieces still in flight
+elsewhere (end-game mode), so a single slow or stalled peer cannot hold up
+the tail of the download.  Peers that fail repeatedly are dropped and
+their pieces go back on the queue.  A piece that can't be written (a full
+disk, say) stops the whole download with that error, since no other
+source can do better.
+
+When a manifest is supplied every piece is checked against its hash as it
+arrives; a corrupt piece counts as a failure for the peer that sent it and
+only that piece is fetched again.  Since the manifest identifies content,
+peers sharing the same data under different names can be mixed freely.
+
+Completed pieces are checkpointed to a resume sidecar (see resume.py), so
+an interrupted swarm download only fetches the pieces it is missing.
+
+With ``stats`` (a transfer_stats.TransferStats), the workers add their
+recv, disk and hashing time to it, count failed pieces as retries and
+report the bytes fetched, per-source figures included.
+"""
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import manifest as manifest_mod
+import peer_protocol
+import transfer_stats
+from resume import DownloadState
+
+PIECE_SIZE = manifest_mod.PIECE_SIZE
+MAX_FAILURES = 3  # Drop a source after this many failed pieces
+
+
+class SwarmError(Exception):
+    """Raised when a swarm download cannot be completed"""
+
+
+class SwarmDownload:
+    def __init__(self, filename, sources, save_path, piece_size=PIECE_SIZE,
+                 timeout=10, progress_callback=None, manifest=None, stats=None):
+        """
+        sources is a list of (peer_ip, peer_port) tuples that share filename,
+        or (peer_ip, peer_port, remote_filename) for peers sharing the same
+        content under another name.  progress_callback, if given, is called
+        as callback(received, total) from worker threads.
+        """
+        self.filename = filename
+        self.sources = list(dict.fromkeys(
+            tuple(source) if len(source) == 3 else (source[0], source[1], filename)
+            for source in sources))
+        self.save_path = save_path
+        self.manifest = manifest
+        self.piece_size = manifest['piece_size'] if manifest else piece_size
+        self.timeout = timeout
+        self.progress_callback = progress_callback
+        self.stats = stats or transfer_stats.TransferStats('download', None, filename,
+                                                           mode='swarm')
+
+        self.file_size = 0
+        self.received = 0
+        self.source_stats = {}
+
+        self._cond = threading.Condition()
+        self._file_lock = threading.Lock()
+        self._pending = deque()
+        self._in_flight = {}  # piece index -> set of sources fetching it
+        self._writing = set()
+        self._done = set()
+        self._live_workers = 0
+        self._stopped = False  # Set by stop(), and once run() is done with the file
+        self._error = None  # The OSError that stopped the download, if writing failed
+
+    def stop(self):
+        """Abandon the download; run() saves what it has and raises SwarmError"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def run(self):
+        """Download the file, blocking until it is complete or has failed"""
+        sources = self._probe_sources()
+        state = self.state = DownloadState(self.save_path)
+        state.start(self.file_size, self.manifest['digest'] if self.manifest else None,
+                    self.piece_size)
+        if self.file_size == 0:
+            state.discard()
+            open(self.save_path, 'wb').close()
+            return self.save_path
+
+        piece_count = (self.file_size + self.piece_size - 1) // self.piece_size
+
+        with state.open_part() as f:
+            self._file = f
+            self._done = self._resumed_pieces(f, piece_count)
+            self.received = sum(self._piece_length(index) for index in self._done)
+            self.stats.offset = self.received  # Already on disk, not fetched this time
+            self._pending.extend(index for index in range(piece_count) if index not in self._done)
+            if self._done:
+                print(f"Swarm: resuming '{self.filename}' with {len(self._done)}/{piece_count} pieces")
+                if self.progress_callback:
+                    self.progress_callback(self.received, self.file_size)
+
+            self._live_workers = len(sources)
+            for source in sources:
+                threading.Thread(target=self._worker, args=(source,), daemon=True,
+                                 name=f"swarm-{source[0]}:{source[1]}").start()
+
+            # Don't wait for stragglers still fetching pieces someone else finished
+            with self._cond:
+                while (len(self._done) < piece_count and self._live_workers
+                       and not self._stopped):
+                    self._cond.wait()
+                stopped = self._stopped
+
+            with self._file_lock:
+                self._stopped = True  # Workers still fetching must not write any more
+                try:
+                    state.save(f, force=True)
+                except OSError:
+                    if self._error is None:
+                        raise
+                    # Likely the same full disk; the pieces saved before still resume
+
+        if self._error is not None:
+            raise SwarmError(f"Could not write '{self.filename}': {str(self._error)}")
+        if stopped and len(self._done) != piece_count:
+            raise SwarmError("Download stopped")
+        if len(self._done) != piece_count:
+            raise SwarmError(
+                f"All sources failed with {piece_count - len(self._done)} pieces missing")
+        state.finish()
+        return self.save_path
+
+    def _piece_length(self, index):
+        return min(self.piece_size, self.file_size - index * self.piece_size)
+
+    def _resumed_pieces(self, f, piece_count):
+        """Pieces already on disk from an earlier attempt, re-checked if we can"""
+        done = {index for index in self.state.done_pieces() if index < piece_count}
+        if not self.manifest:
+            return done
+        verified = set()
+        for index in sorted(done):
+            f.seek(index * self.piece_size)
+            data = f.read(self._piece_length(index))
+            if manifest_mod.piece_digest(data) == self.manifest['pieces'][index]:
+                verified.add(index)
+        self.state.pieces = verified
+        self.state.received = 0
+        return verified
+
+    def _probe_sources(self):
+        """Ask every source for the file size and keep those that agree"""
+        def probe(source):
+            try:
+                return source, peer_protocol.probe_file_size(*source, timeout=self.timeout)
+            except Exception as e:
+                print(f"Swarm: dropping source {source[0]}:{source[1]}: {str(e)}")
+                return source, None
+
+        if not self.sources:
+            raise SwarmError("No sources to download from")
+
+        with ThreadPoolExecutor(max_workers=len(self.sources),
+                                thread_name_prefix='swarm-probe') as pool:
+            sizes = [(source, size) for source, size in pool.map(probe, self.sources)
+                     if size is not None]
+        if not sizes:
+            raise SwarmError("No source responded")
+
+        # Peers disagreeing about the size are sharing a different file
+        if self.manifest:
+            self.file_size = self.manifest['size']
+        else:
+            self.file_size = Counter(size for _, size in sizes).most_common(1)[0][0]
+        sources = [source for source, size in sizes if size == self.file_size]
+        if not sources:
+            raise SwarmError("No source has the expected file size")
+        return sources
+
+    def _next_piece(self, source):
+        """Pick the next piece for source, or None when there is nothing left"""
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                if self._pending:
+                    index = self._pending.popleft()
+                else:
+                    # End-game: help with the piece that has the fewest fetchers
+                    candidates = [(len(holders), index)
+                                  for index, holders in self._in_flight.items()
+                                  if source not in holders and index not in self._writing]
+                    if not candidates:
+                        if not self._in_flight:
+                            return None
+                        self._cond.wait()
+                        continue
+                    index = min(candidates)[1]
+                self._in_flight.setdefault(index, set()).add(source)
+                return index
+
+    def _release_piece(self, source, index, failed):
+        with self._cond:
+            holders = self._in_flight.get(index)
+            if holders is not None:
+                holders.discard(source)
+                if not holders:
+                    del self._in_flight[index]
+                    if failed and index not in self._done:
+                        self._pending.appendleft(index)
+            if failed:
+                self.stats.retries += 1
+            self._cond.notify_all()
+
+    def _store_piece(self, index, data):
+        with self._cond:
+            if index in self._done or index in self._writing:
+                return False  # Another source won the race in end-game
+            self._writing.add(index)
+
+        with self._file_lock:
+            if self._stopped:
+                with self._cond:
+                    self._writing.discard(index)
+                return False
+            try:
+                with self.stats.timing('disk'):
+                    self._file.seek(index * self.piece_size)
+                    self._file.write(data)
+                    self.state.pieces.add(index)
+                    self.state.save(self._file)
+            except OSError as e:
+                self.state.pieces.discard(index)
+                with self._cond:
+                    self._writing.discard(index)
+                    self._error = e
+                    self._stopped = True
+                    self._cond.notify_all()
+                raise
+
+        with self._cond:
+            self._writing.discard(index)
+            self._done.add(index)
+            self.received += len(data)
+            self.stats.bytes += len(data)
+            received = self.received
+            # Nobody else needs to keep fetching this piece
+            self._in_flight.pop(index, None)
+            self._cond.notify_all()
+
+        if self.progress_callback:
+            self.progress_callback(received, self.file_size)
+        return True
+
+    def _worker(self, source):
+        stats = self.source_stats.setdefault(source, {'bytes': 0, 'seconds': 0.0, 'failures': 0})
+        self.stats.extra.setdefault('sources', {})[f"{source[0]}:{source[1]}"] = stats
+        peer_ip, peer_port, remote_filename = source
+        try:
+            while True:
+                index = self._next_piece(source)
+                if index is None:
+                    return
+                offset = index * self.piece_size
+                length = self._piece_length(index)
+                start = time.time()
+                try:
+                    data = peer_protocol.fetch_range(peer_ip, peer_port, remote_filename,
+                                                     offset, length, self.timeout, self.stats)
+                    if self.manifest:
+                        with self.stats.timing('cpu'):
+                            good = manifest_mod.piece_digest(data) == self.manifest['pieces'][index]
+                        if not good:
+                            raise ValueError("piece hash mismatch")
+                except Exception as e:
+                    stats['failures'] += 1
+                    self._release_piece(source, index, failed=True)
+                    print(f"Swarm: piece {index} from {peer_ip}:{peer_port} failed: {str(e)}")
+                    if stats['failures'] >= MAX_FAILURES:
+                        print(f"Swarm: giving up on source {peer_ip}:{peer_port}")
+                        return
+                    continue
+
+                stats['bytes'] += len(data)
+                stats['seconds'] += time.time() - start
+                try:
+                    self._store_piece(index, data)
+                except OSError as e:
+                    # _store_piece has stopped the download; run() reports the error
+                    self._release_piece(source, index, failed=True)
+                    print(f"Swarm: writing piece {index} failed: {str(e)}")
+                    return
+                self._release_piece(source, index, failed=False)
+        finally:
+            with self._cond:
+                self._live_workers -= 1
+                self._cond.notify_all()
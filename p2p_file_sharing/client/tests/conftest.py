@@ -0,0 +1,109 @@
+"""Fixtures shared by the client tests.
+
+The client modules import each other as siblings, so the client
+directory goes on sys.path, as it is when peer.py is run from there.
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import peer_protocol  # noqa: E402
+import transfer_stats  # noqa: E402
+from async_peer_server import AsyncPeerServer  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def no_transfer_log():
+    """Keep transfers made by the tests out of logs/ in the working directory"""
+    transfer_stats.configure(None)
+
+
+def _answer(conn, directory):
+    """What PeerEngine.handle_peer_connection does, serving from directory"""
+    try:
+        if peer_protocol.is_framed(conn):
+            peer_protocol.serve_framed_session(conn, directory)
+            return
+        filename, offset, length, is_range = peer_protocol.read_request(conn)
+        path = peer_protocol.shared_path(directory, filename)
+        if path is None or not os.path.isfile(path):
+            conn.sendall(peer_protocol.not_found_response(is_range))
+            return
+        file_size = os.path.getsize(path)
+        offset, length = peer_protocol.clamp_range(file_size, offset, length)
+        conn.sendall(peer_protocol.response_header(file_size, length, is_range))
+        with open(path, 'rb') as f:
+            peer_protocol.send_file_range(conn, f, offset, length)
+    except Exception as e:
+        print(f"Error in peer connection: {str(e)}")
+    finally:
+        conn.close()
+
+
+def _serve(listener, directory):
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return  # Closed at teardown
+        threading.Thread(target=_answer, args=(conn, directory), daemon=True).start()
+
+
+@pytest.fixture
+def range_server():
+    """start(directory) runs a peer serving the files in directory, returning
+    its port"""
+    listeners = []
+
+    def start(directory):
+        listener = socket.create_server(('127.0.0.1', 0))
+        listeners.append(listener)
+        threading.Thread(target=_serve, args=(listener, str(directory)), daemon=True).start()
+        return listener.getsockname()[1]
+
+    yield start
+    peer_protocol.default_pool.close_all()  # Kept-alive sessions must not outlive the peer
+    for listener in listeners:
+        listener.close()
+
+
+@pytest.fixture
+def async_server(closed_port):
+    """start(directory, **options) runs an AsyncPeerServer serving directory,
+    returning its port"""
+    servers = []
+
+    def start(directory, **options):
+        server = AsyncPeerServer('127.0.0.1', closed_port, directory, **options)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        servers.append((server, thread))
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', closed_port)).close()
+                return closed_port
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.02)
+
+    yield start
+    peer_protocol.default_pool.close_all()
+    for server, thread in servers:
+        server.stop()
+        thread.join(5)
+
+
+@pytest.fixture
+def closed_port():
+    """A local port nothing is listening on"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
@@ -0,0 +1,59 @@
+import socket
+
+import pytest
+
+import peer_protocol
+
+
+@pytest.fixture
+def serve(tmp_path, async_server):
+    """serve(**options) runs an AsyncPeerServer over tmp_path/'shared' and
+    returns its port"""
+    directory = tmp_path / 'shared'
+    directory.mkdir()
+    (directory / 'f.bin').write_bytes(bytes(range(256)) * 1000)
+    return lambda **options: async_server(directory, **options)
+
+
+def exchange(port, request):
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(request)
+        sock.shutdown(socket.SHUT_WR)
+        reply = b''
+        while chunk := sock.recv(65536):
+            reply += chunk
+        return reply
+
+
+def test_legacy_request_gets_size_then_whole_file(serve, tmp_path):
+    data = (tmp_path / 'shared' / 'f.bin').read_bytes()
+    port = serve()
+
+    reply = exchange(port, b'f.bin')
+
+    assert reply == str(len(data)).encode() + data
+
+
+def test_range_request_gets_exactly_the_range(serve, tmp_path):
+    data = (tmp_path / 'shared' / 'f.bin').read_bytes()
+    port = serve()
+
+    reply = exchange(port, peer_protocol.build_range_request('f.bin', 1000, 5000))
+
+    assert reply == f"OK {len(data)} 5000\n".encode() + data[1000:6000]
+
+
+@pytest.mark.parametrize('request_line, expected', [
+    (b'missing.bin', peer_protocol.FILE_NOT_FOUND),
+    (peer_protocol.build_range_request('missing.bin'), peer_protocol.FILE_NOT_FOUND + b"\n"),
+])
+def test_missing_file(serve, request_line, expected):
+    assert exchange(serve(), request_line) == expected
+
+
+def test_silent_peer_is_dropped_after_request_timeout(serve):
+    port = serve(request_timeout=0.2)
+
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(b'RANGE 0 ')  # Never finishes the line
+        assert sock.recv(1024) == b''
@@ -0,0 +1,147 @@
+import io
+import os
+import socket
+import threading
+import zlib
+
+import pytest
+
+import compression
+import peer_protocol
+from compression import BLOCK_SIZE, DecompressionError
+from peer_protocol import FLAG_COMPRESSED, FRAME_CHUNK, PeerConnection, PeerProtocolError
+
+TEXT = b"".join(b"line %d of a very compressible log file\n" % i for i in range(40000))
+
+
+def test_codecs_are_negotiated_in_the_offered_order():
+    assert 'zlib' in compression.available()
+    assert compression.choose(['zstd', 'zlib'], ['zlib']) == 'zlib'
+    assert compression.choose(['brotli'], ['zlib']) is None
+
+
+@pytest.mark.parametrize('filename, length, expected', [
+    ('log.txt', 100000, True),
+    ('log.txt', compression.MIN_COMPRESS_SIZE - 1, False),
+    ('movie.MP4', 100000, False),
+])
+def test_worth_compressing(filename, length, expected):
+    assert compression.worth_compressing(filename, length) == expected
+
+
+def test_blocks_decode_back_to_the_file():
+    blocks = list(compression.iter_blocks(io.BytesIO(TEXT), 100, len(TEXT) - 100, 'zlib'))
+    decoder = compression.codec('zlib')
+
+    assert all(raw_offset is None for _, raw_offset in blocks)
+    assert len(blocks) == -(-(len(TEXT) - 100) // BLOCK_SIZE)
+    assert b"".join(decoder.decompress(packed, BLOCK_SIZE) for packed, _ in blocks) == TEXT[100:]
+
+
+def test_incompressible_data_switches_to_raw():
+    data = os.urandom(BLOCK_SIZE * 2)
+    assert list(compression.iter_blocks(io.BytesIO(data), 0, len(data), 'zlib')) == [(None, 0)]
+
+
+def deflate(data):
+    compressor = zlib.compressobj(1)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def test_a_block_of_exactly_the_limit_is_accepted():
+    block = deflate(bytes(BLOCK_SIZE))
+    assert compression.codec('zlib').decompress(block, BLOCK_SIZE) == bytes(BLOCK_SIZE)
+
+
+def test_a_block_expanding_past_its_limit_is_refused():
+    bomb = deflate(bytes(BLOCK_SIZE * 64))
+    assert len(bomb) < BLOCK_SIZE
+
+    with pytest.raises(DecompressionError, match="more than"):
+        compression.codec('zlib').decompress(bomb, BLOCK_SIZE)
+
+
+def test_a_block_longer_than_what_is_left_is_refused():
+    with pytest.raises(DecompressionError):
+        compression.codec('zlib').decompress(deflate(bytes(1000)), 999)
+
+
+def test_corrupt_block():
+    with pytest.raises(DecompressionError):
+        compression.codec('zlib').decompress(b"\xff" * 100, BLOCK_SIZE)
+
+
+@pytest.fixture
+def text_share(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    (shared / 'log.txt').write_bytes(TEXT)
+    (shared / 'noise.bin').write_bytes(os.urandom(100000))
+    return shared
+
+
+@pytest.mark.parametrize('kind', ['threaded', 'asyncio'])
+def test_transfers_are_compressed_when_both_sides_agree(kind, text_share, range_server,
+                                                        async_server):
+    port = (range_server if kind == 'threaded' else async_server)(text_share)
+
+    with PeerConnection('127.0.0.1', port, codecs=['zlib']) as connection:
+        assert connection.codec == 'zlib'
+        (size, data), = connection.fetch_many([('log.txt', 0, -1)])
+        assert (size, data) == (len(TEXT), TEXT)
+        assert connection.wire_bytes < len(TEXT) / 4
+
+        (_, noise), = connection.fetch_many([('noise.bin', 0, -1)])
+        assert noise == (text_share / 'noise.bin').read_bytes()
+
+    with PeerConnection('127.0.0.1', port, codecs=[]) as connection:
+        assert connection.codec is None
+        assert list(connection.fetch_many([('log.txt', 0, 1000)])) == [(len(TEXT), TEXT[:1000])]
+
+
+@pytest.fixture
+def lying_peer():
+    """start(length, chunks) runs a zlib peer that answers any GET with a
+    chunked DATA frame announcing length bytes, then the given CHUNK payloads"""
+    listener = socket.create_server(('127.0.0.1', 0))
+
+    def start(length, chunks):
+        def answer():
+            conn, _ = listener.accept()
+            with conn:
+                reader = conn.makefile('rb')
+                peer_protocol.read_hello(reader)
+                conn.sendall(peer_protocol.hello({'codec': 'zlib'}))
+                header = peer_protocol.read_exact(reader, peer_protocol.FRAME_HEADER.size)
+                _, _, request_id, size = peer_protocol.unpack_request_header(header)
+                peer_protocol.read_exact(reader, size)
+                conn.sendall(peer_protocol.chunked_data_header(request_id, length, length))
+                for payload in chunks:
+                    conn.sendall(peer_protocol.pack_frame(FRAME_CHUNK, request_id, payload,
+                                                          FLAG_COMPRESSED))
+                try:
+                    reader.read()  # Until the client hangs up
+                except ConnectionError:
+                    pass
+
+        threading.Thread(target=answer, daemon=True).start()
+        return listener.getsockname()[1]
+
+    yield start
+    listener.close()
+
+
+def test_client_refuses_a_block_expanding_past_the_announced_length(lying_peer):
+    port = lying_peer(1000, [deflate(bytes(BLOCK_SIZE))])
+
+    with PeerConnection('127.0.0.1', port, codecs=['zlib']) as connection:
+        with pytest.raises(PeerProtocolError, match="Bad compressed block"):
+            list(connection.fetch_many([('f', 0, -1)]))
+
+
+def test_client_refuses_an_oversized_compressed_chunk(lying_peer):
+    port = lying_peer(BLOCK_SIZE * 2, [os.urandom(BLOCK_SIZE + 1)])
+
+    with PeerConnection('127.0.0.1', port, codecs=['zlib']) as connection:
+        with pytest.raises(PeerProtocolError, match="Oversized compressed block"):
+            list(connection.fetch_many([('f', 0, -1)]))
@@ -0,0 +1,137 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import rate_limit
+from daemon import serve_control_api
+from download_queue import DONE
+from engine import PeerEngine
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch, closed_port):
+    """A logged-out engine in tmp_path whose tracker is unreachable"""
+    monkeypatch.chdir(tmp_path)
+    engine = PeerEngine(f"http://127.0.0.1:{closed_port}")
+    yield engine
+    engine.shutdown()
+
+
+def test_engine_announces_the_given_ip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    engine = PeerEngine('http://127.0.0.1:1', ip='127.0.0.2')
+    try:
+        assert engine.ip == '127.0.0.2'
+    finally:
+        engine.shutdown()
+
+
+@pytest.fixture
+def remote(tmp_path, range_server):
+    """A peer sharing f.bin, as (port, data)"""
+    directory = tmp_path / 'remote'
+    directory.mkdir()
+    data = bytes(range(256)) * 2000
+    (directory / 'f.bin').write_bytes(data)
+    return range_server(directory), data
+
+
+def test_engine_downloads_from_a_peer_without_the_tracker(engine, remote, tmp_path):
+    port, data = remote
+
+    job = engine.download('f.bin', '127.0.0.1', port, swarm=False)
+
+    wait_for(lambda: job.state == DONE)
+    assert (tmp_path / 'downloads' / 'f.bin').read_bytes() == data
+
+
+@pytest.fixture
+def api(engine):
+    """call(method, path, body=None) -> (status, json) against the control API"""
+    server = serve_control_api(engine, 0)
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def call(method, path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(base + path, data=data, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    yield call
+    server.shutdown()
+    server.server_close()
+    rate_limit.upload_limiter.set_limits()
+    rate_limit.download_limiter.set_limits()
+
+
+def test_status(api, engine):
+    status, body = api('GET', '/status')
+
+    assert status == 200
+    assert body['port'] == engine.listening_port
+    assert body['logged_in'] is False
+
+
+def test_limits_can_be_changed_one_at_a_time(api):
+    status, body = api('POST', '/limits', {'download': 100000})
+    assert (status, body['download'], body['upload']) == (200, 100000, None)
+
+    api('POST', '/limits', {'upload_per_peer': 5000})
+    _, body = api('GET', '/limits')
+    assert body == {'upload': None, 'upload_per_peer': 5000,
+                    'download': 100000, 'download_per_peer': None}
+
+
+@pytest.mark.parametrize('method, path', [
+    ('GET', '/nothing'), ('GET', '/downloads/999'), ('POST', '/downloads/999/pause'),
+])
+def test_unknown_paths_are_not_found(api, method, path):
+    status, body = api(method, path, {} if method == 'POST' else None)
+    assert status == 404
+    assert 'error' in body
+
+
+def test_bad_download_request(api):
+    status, body = api('POST', '/downloads', {'peer_ip': '127.0.0.1'})
+    assert status == 400
+    assert 'filename' in body['error']
+
+
+def test_tracker_failures_are_reported_per_file(api):
+    status, body = api('POST', '/downloads', [{'filename': 'a'}, {'filename': 'b'}])
+
+    assert status == 502
+    assert [error['filename'] for error in body['errors']] == ['a', 'b']
+
+
+def test_queue_and_cancel_a_download(api, remote, tmp_path):
+    port, data = remote
+
+    status, body = api('POST', '/downloads',
+                       {'filename': 'f.bin', 'peer_ip': '127.0.0.1', 'peer_port': port,
+                        'swarm': False})
+    assert status == 201
+    job_id = body['downloads'][0]['id']
+    wait_for(lambda: api('GET', f'/downloads/{job_id}')[1]['state'] == DONE)
+    assert (tmp_path / 'downloads' / 'f.bin').read_bytes() == data
+
+    _, body = api('POST', f'/downloads/{job_id}/cancel', {})
+    assert body['state'] == DONE  # Finished downloads stay finished
+
+    _, body = api('POST', '/downloads/clear', {})
+    assert body['downloads'] == []
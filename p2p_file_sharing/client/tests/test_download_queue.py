@@ -0,0 +1,149 @@
+import threading
+import time
+
+import pytest
+
+from download_queue import (CANCELLED, DONE, FAILED, PAUSED, QUEUED, RUNNING, DownloadQueue,
+                            DownloadStopped)
+
+
+class Transfers:
+    """run_job for the queue: each job blocks until finish() or until stopped"""
+
+    def __init__(self):
+        self.started = []
+        self.discarded = []
+        self._release = {}
+        self._lock = threading.Lock()
+
+    def run(self, job):
+        release = threading.Event()
+        with self._lock:
+            self._release[job.filename] = release
+            self.started.append(job.filename)
+        job.on_stop(release.set)
+        release.wait(5)
+        job.check()
+        if job.filename.startswith('bad'):
+            raise OSError("peer went away")
+
+    def discard(self, job):
+        self.discarded.append(job.filename)
+
+    def finish(self, filename):
+        wait_for(lambda: filename in self._release)
+        self._release[filename].set()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def transfers():
+    return Transfers()
+
+
+@pytest.fixture
+def make_queue(transfers):
+    queues = []
+
+    def make(**limits):
+        queue = DownloadQueue(transfers.run, discard_job=transfers.discard, **limits)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.shutdown()
+
+
+def test_highest_priority_runs_first(make_queue, transfers):
+    queue = make_queue(max_active=1)
+    first = queue.submit('first', '10.0.0.1', 1)
+    wait_for(lambda: first.state == RUNNING)
+    queue.submit('low', '10.0.0.2', 1)
+    queue.submit('high', '10.0.0.3', 1, priority=5)
+    later = queue.submit('later', '10.0.0.4', 1)
+    queue.set_priority(later.id, 10)
+
+    for filename in ('first', 'later', 'high', 'low'):
+        transfers.finish(filename)
+
+    wait_for(lambda: all(job.state == DONE for job in queue.jobs()))
+    assert transfers.started == ['first', 'later', 'high', 'low']
+
+
+def test_one_peer_only_gets_max_per_peer_slots(make_queue, transfers):
+    queue = make_queue(max_active=3, max_per_peer=2)
+    jobs = [queue.submit(f'f{i}', '10.0.0.1', 1) for i in range(3)]
+    other = queue.submit('other', '10.0.0.2', 1)
+
+    wait_for(lambda: other.state == RUNNING)
+    time.sleep(0.05)
+    assert [job.state for job in jobs] == [RUNNING, RUNNING, QUEUED]
+
+    transfers.finish('f0')
+    wait_for(lambda: jobs[2].state == RUNNING)
+
+
+def test_failures_are_reported(make_queue, transfers):
+    queue = make_queue()
+    job = queue.submit('bad.bin', '10.0.0.1', 1)
+    transfers.finish('bad.bin')
+
+    wait_for(lambda: job.state == FAILED)
+    assert job.error == "peer went away"
+
+
+def test_pause_and_resume(make_queue, transfers):
+    queue = make_queue()
+    job = queue.submit('f', '10.0.0.1', 1)
+    wait_for(lambda: job.state == RUNNING)
+
+    queue.pause(job.id)
+    wait_for(lambda: job.state == PAUSED)
+    queue.resume(job.id)
+    wait_for(lambda: transfers.started == ['f', 'f'])
+    transfers.finish('f')
+
+    wait_for(lambda: job.state == DONE)
+    assert transfers.discarded == []
+
+
+def test_cancelling_a_running_job_leaves_cleanup_to_the_transfer(make_queue, transfers):
+    queue = make_queue()
+    job = queue.submit('f', '10.0.0.1', 1)
+    wait_for(lambda: job.state == RUNNING)
+
+    queue.cancel(job.id)
+
+    wait_for(lambda: job.state == CANCELLED)
+    with pytest.raises(DownloadStopped):
+        job.check()
+    assert transfers.discarded == []
+
+
+@pytest.mark.parametrize('stop', ['queued', 'paused', 'failed'])
+def test_cancelling_a_stopped_job_discards_its_partial_file(make_queue, transfers, stop):
+    queue = make_queue(max_active=1)
+    blocker = queue.submit('blocker', '10.0.0.1', 1)
+    wait_for(lambda: blocker.state == RUNNING)
+    filename = 'bad.bin' if stop == 'failed' else 'f'
+    job = queue.submit(filename, '10.0.0.2', 1)
+    if stop == 'paused':
+        queue.pause(job.id)
+    elif stop == 'failed':
+        transfers.finish('blocker')
+        transfers.finish(filename)
+        wait_for(lambda: job.state == FAILED)
+
+    queue.cancel(job.id)
+
+    assert job.state == CANCELLED
+    assert transfers.discarded == [filename]
+    queue.remove_finished()
+    assert job not in queue.jobs()
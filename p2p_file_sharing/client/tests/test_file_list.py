@@ -0,0 +1,73 @@
+import tkinter as tk
+from types import SimpleNamespace
+
+import pytest
+
+from file_list import ROW_HEIGHT, VirtualFileList
+
+ROWS = [('a.txt', 'alice', '10.0.0.1', 1), ('b.txt', 'bob', '10.0.0.2', 2),
+        ('ab.log', 'alice', '10.0.0.1', 3), ('c.bin', 'carol', '10.0.0.3', 4)]
+
+
+@pytest.fixture
+def files():
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        pytest.skip("no display")
+    files = VirtualFileList(root, ('Filename', 'Owner'), (200, 100))
+    files.pack()
+    files.set_rows(list(ROWS))
+    yield files
+    root.destroy()
+
+
+def show_rows(files, n):
+    """Resize the tree to fit n rows below its heading"""
+    files._on_resize(SimpleNamespace(height=(n + 1) * ROW_HEIGHT))
+
+
+def test_uses_its_own_style(files):
+    assert files.tree.cget('style') == 'Files.Treeview'
+
+
+def test_only_visible_rows_become_items(files):
+    show_rows(files, 2)
+
+    assert len(files.tree.get_children()) == 2
+    files.scroll(1, 'pages')
+    assert [files.tree.item(iid, 'values')[0] for iid in files.tree.get_children()] == \
+        ['ab.log', 'c.bin']
+
+
+@pytest.mark.parametrize('queries, expected', [
+    (['a'], ['a.txt', 'ab.log', 'c.bin']),
+    (['al', 'ali'], ['a.txt', 'ab.log']),
+    (['ab.', 'ab', 'b'], ['b.txt', 'ab.log']),
+    (['zzz', ''], ['a.txt', 'b.txt', 'ab.log', 'c.bin']),
+    (['  BOB '], ['b.txt']),
+])
+def test_filter(files, queries, expected):
+    show_rows(files, 10)
+    for query in queries:
+        files.set_filter(query)
+
+    assert len(files) == len(expected)
+    assert [files.tree.item(iid, 'values')[0] for iid in files.tree.get_children()] == expected
+
+
+def test_new_rows_keep_the_filter(files):
+    files.set_filter('alice')
+    files.set_rows(list(ROWS) + [('d.txt', 'alice', '10.0.0.1', 5)])
+    assert len(files) == 3
+
+
+def test_selection_survives_scrolling(files):
+    show_rows(files, 1)
+    for _ in range(3):  # The first press selects the top row
+        files._move_selection(1)
+
+    assert files.selected() == ROWS[2]
+    files.scroll(-1, 'pages')
+    assert files.selected() == ROWS[2]
+    assert files.tree.selection() == ()
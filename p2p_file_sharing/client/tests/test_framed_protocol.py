@@ -0,0 +1,155 @@
+import os
+import socket
+
+import pytest
+
+import peer_protocol
+from peer_protocol import (FRAME_DATA, FRAME_ERROR, FRAME_GET, FRAME_HEADER, FRAME_HELLO,
+                           MAX_HEADER, PeerConnection, PeerProtocolError)
+
+
+def test_frame_header_round_trip():
+    frame = peer_protocol.pack_frame(FRAME_ERROR, 7, b"boom")
+
+    assert peer_protocol.unpack_frame_header(frame[:FRAME_HEADER.size]) == (FRAME_ERROR, 0, 7, 4)
+    assert frame[FRAME_HEADER.size:] == b"boom"
+
+
+def test_get_round_trip():
+    frame = peer_protocol.build_get(3, 'dir/naïve.txt', 100, 50)
+    frame_type, _, request_id, length = peer_protocol.unpack_request_header(
+        frame[:FRAME_HEADER.size])
+
+    assert (frame_type, request_id) == (FRAME_GET, 3)
+    assert peer_protocol.parse_get(frame[FRAME_HEADER.size:]) == ('dir/naïve.txt', 100, 50)
+
+
+@pytest.mark.parametrize('payload', [b"short", peer_protocol.GET_HEADER.pack(0, -1) + b"\xff"])
+def test_malformed_get(payload):
+    with pytest.raises(PeerProtocolError):
+        peer_protocol.parse_get(payload)
+
+
+def test_only_data_frames_may_be_large():
+    big = MAX_HEADER + 1
+    assert peer_protocol.unpack_frame_header(FRAME_HEADER.pack(FRAME_DATA, 0, 1, big))[3] == big
+    with pytest.raises(PeerProtocolError, match="Oversized"):
+        peer_protocol.unpack_frame_header(FRAME_HEADER.pack(FRAME_ERROR, 0, 1, big))
+
+
+@pytest.mark.parametrize('frame_type, length', [
+    (FRAME_GET, MAX_HEADER + 1),
+    (FRAME_HELLO, 2 ** 40),
+    (FRAME_DATA, 10),
+    (FRAME_ERROR, 0),
+])
+def test_servers_refuse_anything_but_small_hello_and_get(frame_type, length):
+    with pytest.raises(PeerProtocolError):
+        peer_protocol.unpack_request_header(FRAME_HEADER.pack(frame_type, 0, 1, length))
+
+
+def test_greeting_must_start_with_magic():
+    assert peer_protocol.check_greeting(peer_protocol.MAGIC + bytes([99])) == \
+        peer_protocol.PROTOCOL_VERSION
+    with pytest.raises(PeerProtocolError):
+        peer_protocol.check_greeting(b"hello")
+
+
+@pytest.mark.parametrize('filename', [
+    '../secret.txt', 'sub/../../secret.txt', '..', '', '.', '/etc/passwd',
+])
+def test_shared_path_refuses_names_outside_the_share(tmp_path, filename):
+    assert peer_protocol.shared_path(tmp_path / 'shared', filename) is None
+
+
+def test_shared_path_keeps_links_to_elsewhere(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    (tmp_path / 'movie.bin').write_bytes(b"data")
+    os.symlink(tmp_path / 'movie.bin', shared / 'movie.bin')
+
+    path = peer_protocol.shared_path(shared, 'movie.bin')
+
+    assert path == str(shared / 'movie.bin')
+    assert open(path, 'rb').read() == b"data"
+
+
+@pytest.fixture
+def share(tmp_path):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    files = {f'f{i}.txt': os.urandom(1000 + i) for i in range(5)}
+    for name, data in files.items():
+        (shared / name).write_bytes(data)
+    (tmp_path / 'secret.txt').write_bytes(b"not shared")
+    return shared, files
+
+
+@pytest.fixture(params=['threaded', 'asyncio'])
+def port(request, share, range_server, async_server):
+    """A peer serving share, from each of the two server implementations"""
+    start = range_server if request.param == 'threaded' else async_server
+    return start(share[0])
+
+
+def test_pipelined_gets_are_answered_in_order(port, share):
+    _, files = share
+    names = list(files) + ['missing.txt']
+
+    with PeerConnection('127.0.0.1', port) as connection:
+        results = list(connection.fetch_many([(name, 0, -1) for name in names], window=2))
+
+    assert results[:-1] == [(len(data), data) for data in files.values()]
+    assert results[-1] == (None, None)
+
+
+def test_get_of_a_range(port, share):
+    data = share[1]['f1.txt']
+    assert peer_protocol.fetch_range('127.0.0.1', port, 'f1.txt', 10, 20) == data[10:30]
+
+
+@pytest.mark.parametrize('filename', ['../secret.txt', 'f0.txt/../../secret.txt'])
+def test_get_outside_the_share_is_not_found(port, share, filename):
+    with pytest.raises(FileNotFoundError):
+        peer_protocol.probe_file_size('127.0.0.1', port, filename)
+
+
+def test_get_of_an_absolute_path_is_not_found(port, share):
+    secret = share[0].parent / 'secret.txt'
+    with pytest.raises(FileNotFoundError):
+        peer_protocol.probe_file_size('127.0.0.1', port, str(secret))
+
+
+@pytest.mark.parametrize('frame_type, length', [(FRAME_GET, MAX_HEADER + 1), (FRAME_DATA, 2 ** 40)])
+def test_server_hangs_up_on_frames_it_would_have_to_buffer(port, frame_type, length):
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(peer_protocol.hello())
+        reader = sock.makefile('rb')
+        peer_protocol.read_hello(reader)
+
+        sock.sendall(FRAME_HEADER.pack(frame_type, 0, 1, length))
+
+        assert reader.read() == b""
+
+
+def legacy_exchange(port, request):
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(request)
+        sock.shutdown(socket.SHUT_WR)
+        return sock.makefile('rb').read()
+
+
+def test_bare_filename_requests_still_work(port, share):
+    data = share[1]['f0.txt']
+    assert legacy_exchange(port, b'f0.txt') == str(len(data)).encode() + data
+    assert legacy_exchange(port, b'../secret.txt') == peer_protocol.FILE_NOT_FOUND
+
+
+def test_range_requests_still_work(port, share):
+    data = share[1]['f2.txt']
+
+    reply = legacy_exchange(port, peer_protocol.build_range_request('f2.txt', 5, 10))
+
+    assert reply == f"OK {len(data)} 10\n".encode() + data[5:15]
+    assert legacy_exchange(port, peer_protocol.build_range_request('../secret.txt')) == \
+        peer_protocol.FILE_NOT_FOUND + b"\n"
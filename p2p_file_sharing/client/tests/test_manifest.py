@@ -0,0 +1,40 @@
+import os
+
+import manifest
+
+PIECE = 1024
+
+
+def test_manifest_describes_content_not_name(tmp_path):
+    data = os.urandom(PIECE * 3 + 10)
+    (tmp_path / 'a').write_bytes(data)
+    (tmp_path / 'b').write_bytes(data)
+    (tmp_path / 'c').write_bytes(data[:-1] + b'x')
+
+    manifests = manifest.build_manifests([tmp_path / 'a', tmp_path / 'b', tmp_path / 'c'],
+                                         piece_size=PIECE)
+    a, b, c = (manifests[tmp_path / name] for name in 'abc')
+
+    assert a['size'] == len(data) and len(a['pieces']) == 4
+    assert a['pieces'][0] == manifest.piece_digest(data[:PIECE])
+    assert a == b
+    assert c['digest'] != a['digest']
+    assert manifest.bad_pieces(a, c) == [3]
+    assert manifest.is_valid(a)
+
+
+def test_tampered_manifest_is_invalid(tmp_path):
+    (tmp_path / 'a').write_bytes(os.urandom(PIECE * 2))
+    built = manifest.build_manifest(tmp_path / 'a', piece_size=PIECE)
+    built['pieces'] = built['pieces'][::-1]
+    assert not manifest.is_valid(built)
+    assert not manifest.is_valid({'size': 1})
+
+
+def test_streamed_hash_matches_file_hash(tmp_path):
+    data = os.urandom(PIECE * 2 + 1)
+    (tmp_path / 'a').write_bytes(data)
+    hasher = manifest.PieceHasher(PIECE)
+    for start in range(0, len(data), 700):
+        hasher.update(data[start:start + 700])
+    assert hasher.manifest() == manifest.build_manifest(tmp_path / 'a', piece_size=PIECE)
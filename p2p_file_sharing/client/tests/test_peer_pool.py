@@ -0,0 +1,99 @@
+import time
+
+import pytest
+
+import peer_protocol
+from peer_protocol import PeerPool, RangeResponse
+
+
+@pytest.fixture
+def peer(tmp_path, range_server):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    (shared / 'f.bin').write_bytes(bytes(range(256)) * 400)
+    return '127.0.0.1', range_server(shared)
+
+
+@pytest.fixture
+def pool():
+    pool = PeerPool(max_per_peer=2)
+    yield pool
+    pool.close_all()
+
+
+def test_released_sessions_are_reused(pool, peer):
+    with pool.connection(*peer) as first:
+        pass
+    with pool.connection(*peer) as second:
+        assert second is first
+        assert list(second.fetch_many([('f.bin', 0, 10)])) == [(102400, bytes(range(10)))]
+
+
+def test_sequential_range_requests_share_one_session(pool, peer):
+    data = bytes(range(256)) * 400
+    for offset in range(0, 1000, 100):
+        with RangeResponse(*peer, 'f.bin', offset, 100, pool=pool) as response:
+            assert b"".join(response.iter_chunks()) == data[offset:offset + 100]
+    assert pool._open == {peer: 1}
+
+
+def test_unread_body_closes_the_session(pool, peer):
+    response = RangeResponse(*peer, 'f.bin', pool=pool)
+    connection = response.connection
+    response.close()
+
+    assert connection.closed
+    assert pool._open == {}
+
+
+def test_missing_file_keeps_the_session(pool, peer):
+    with pytest.raises(FileNotFoundError):
+        RangeResponse(*peer, 'missing.bin', pool=pool)
+    assert pool._open == {peer: 1}
+
+
+def test_sessions_the_peer_closed_are_not_reused(pool, peer):
+    with pool.connection(*peer) as first:
+        pass
+    first.sock.shutdown(2)  # As if the peer had gone away
+
+    with pool.connection(*peer) as second:
+        assert second is not first
+    assert pool._open == {peer: 1}
+
+
+def test_callers_wait_at_the_per_peer_cap(pool, peer):
+    a = pool.acquire(*peer)
+    b = pool.acquire(*peer)
+    with pytest.raises(TimeoutError):
+        pool.acquire(*peer, timeout=0.1)
+
+    pool.release(a)
+    assert pool.acquire(*peer, timeout=0.1) is a
+    pool.release(a)
+    pool.release(b)
+
+
+def test_idle_sessions_are_evicted(peer):
+    pool = PeerPool(idle_timeout=0.05)
+    with pool.connection(*peer) as connection:
+        pass
+    time.sleep(0.1)
+
+    with pool.connection(*peer) as fresh:
+        assert fresh is not connection
+    assert connection.closed
+    pool.close_all()
+
+
+def test_errors_inside_a_borrow_discard_the_session(pool, peer):
+    with pytest.raises(RuntimeError):
+        with pool.connection(*peer) as connection:
+            raise RuntimeError
+    assert connection.closed and pool._open == {}
+
+
+def test_default_pool_is_used_by_fetch_range(peer):
+    data = peer_protocol.fetch_range(*peer, 'f.bin', 0, 256)
+    assert data == bytes(range(256))
+    assert peer_protocol.default_pool._open == {peer: 1}
@@ -0,0 +1,45 @@
+import os
+import socket
+import threading
+
+import pytest
+
+import peer_protocol
+
+
+def receive_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+@pytest.mark.parametrize('send', [peer_protocol.send_file_range,
+                                  peer_protocol.send_file_buffered])
+def test_sends_exactly_the_range(send, tmp_path):
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    path = tmp_path / 'f.bin'
+    path.write_bytes(data)
+    ours, theirs = socket.socketpair()
+    received = []
+    reader = threading.Thread(target=lambda: received.append(receive_all(theirs)))
+    reader.start()
+    with ours, open(path, 'rb') as f:
+        sent = send(ours, f, 1000, len(data) - 2000)
+    reader.join()
+    theirs.close()
+
+    assert sent == len(data) - 2000
+    assert received[0] == data[1000:-1000]
+
+
+def test_short_file_sends_what_is_there(tmp_path):
+    path = tmp_path / 'f.bin'
+    path.write_bytes(b"abc")
+    ours, theirs = socket.socketpair()
+    with ours, theirs, open(path, 'rb') as f:
+        assert peer_protocol.send_file_buffered(ours, f, 1, 10) == 2
+        assert peer_protocol.send_file_range(ours, f, 0, 0) == 0
+        assert theirs.recv(10) == b"bc"
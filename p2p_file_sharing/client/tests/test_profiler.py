@@ -0,0 +1,86 @@
+import asyncio
+import sys
+import threading
+import time
+
+import pytest
+
+from profiler import SamplingProfiler, _is_idle
+
+
+@pytest.fixture
+def run_thread():
+    """run_thread(target, name) starts a thread and returns its current frame
+    once it has had time to settle; the thread is stopped on teardown"""
+    stop = threading.Event()
+    threads = []
+
+    def run(target, name='download-test'):
+        thread = threading.Thread(target=target, args=(stop,), name=name, daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.1)
+        return sys._current_frames()[thread.ident]
+
+    yield run
+    stop.set()
+    for thread in threads:
+        thread.join(5)
+
+
+def spin(stop):
+    total = 0
+    while not stop.is_set():
+        for i in range(10000):
+            total += i
+
+
+def blocked_mid_transfer(stop):
+    stop.wait()
+
+
+def idle_event_loop(stop):
+    loop = asyncio.new_event_loop()
+
+    async def watch():
+        while not stop.is_set():
+            await asyncio.sleep(0.01)
+
+    try:
+        loop.run_until_complete(watch())
+    finally:
+        loop.close()
+
+
+def test_busy_thread_is_not_idle(run_thread):
+    assert not _is_idle(run_thread(spin))
+
+
+def test_waiting_inside_a_transfer_is_not_idle(run_thread):
+    assert not _is_idle(run_thread(blocked_mid_transfer))
+
+
+def test_event_loop_waiting_in_select_is_idle(run_thread):
+    assert _is_idle(run_thread(idle_event_loop))
+
+
+def test_profile_counts_busy_stacks_and_skips_idle_ones(run_thread, tmp_path):
+    run_thread(spin, 'download-busy')
+    run_thread(idle_event_loop, 'peer-server')
+    run_thread(spin, 'unwatched')
+    profiler = SamplingProfiler(interval=0.002)
+    profiler.start()
+    time.sleep(0.2)
+
+    summary = profiler.stop(tmp_path / 'profile.folded')
+
+    assert summary['running'] is False
+    assert summary['idle_samples'] > 0
+    assert any(entry['frame'].startswith('spin (test_profiler.py:') for entry in summary['top'])
+    lines = (tmp_path / 'profile.folded').read_text().splitlines()
+    assert lines and all(line.startswith('download-busy;') for line in lines)
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == summary['thread_samples']
+
+
+def test_stop_without_start():
+    assert SamplingProfiler().stop() is None
@@ -0,0 +1,119 @@
+import socket
+import time
+
+import pytest
+
+import peer_protocol
+from rate_limit import MAX_SLICE, MIN_SLICE, RateLimiter, ThrottledSocket, TokenBucket
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket()
+    assert bucket.reserve(10 ** 9) == 0.0
+
+
+def test_bucket_waits_off_its_debt():
+    bucket = TokenBucket(100000)
+    assert bucket.reserve(50000) == pytest.approx(0.5, abs=0.05)
+
+
+def test_refund_pays_back_the_debt():
+    bucket = TokenBucket(100000)
+    bucket.reserve(50000)
+
+    bucket.refund(50000)
+
+    assert bucket.reserve(0) == 0.0
+
+
+def test_refund_never_banks_more_than_the_burst():
+    bucket = TokenBucket(100000)
+    bucket.refund(10 ** 9)
+    assert bucket.tokens == bucket.burst
+
+
+@pytest.mark.parametrize('rate, per_peer_rate, expected', [
+    (None, None, None),
+    (1000, None, MIN_SLICE),
+    (10 ** 9, None, MAX_SLICE),
+    (10 ** 6, 200000, 20000),
+])
+def test_slice_size(rate, per_peer_rate, expected):
+    assert RateLimiter('test', rate, per_peer_rate).slice_size() == expected
+
+
+def test_set_limits_reaches_existing_peer_buckets():
+    limiter = RateLimiter('test', per_peer_rate=1000)
+    meter = limiter.open('10.0.0.1')
+    limiter.delay(meter, 1)
+
+    limiter.set_limits(per_peer_rate=None)
+
+    assert not limiter.limited
+    assert limiter.delay(meter, 10 ** 9) == 0.0
+
+
+def test_stats_lists_open_meters():
+    limiter = RateLimiter('test')
+    meter = limiter.open('10.0.0.1')
+    limiter.delay(meter, 1234)
+
+    (stats,) = limiter.stats()
+    assert (stats['peer'], stats['bytes']) == ('10.0.0.1', 1234)
+
+    limiter.close(meter)
+    assert limiter.stats() == []
+
+
+@pytest.fixture
+def sockets():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+@pytest.mark.parametrize('rate', [None, 10 ** 7])
+def test_sendfile_meters_only_what_was_sent(tmp_path, sockets, rate):
+    left, right = sockets
+    path = tmp_path / 'short.bin'
+    path.write_bytes(bytes(range(256)) * 100)
+    limiter = RateLimiter('test', rate)
+    throttled = ThrottledSocket(left, limiter, 'peer')
+
+    with open(path, 'rb') as f:
+        # Ask for more than the file holds, as a peer with a stale size would
+        sent = throttled.sendfile(f, 1000, 100000)
+    left.shutdown(socket.SHUT_WR)
+    received = right.makefile('rb').read()
+
+    assert sent == len(received) == 25600 - 1000
+    assert throttled.meter.bytes == sent
+
+
+def test_sendall_is_paced(sockets):
+    left, right = sockets
+    limiter = RateLimiter('test', 200000)
+    throttled = ThrottledSocket(left, limiter, 'peer')
+    data = bytes(100000)
+
+    started = time.monotonic()
+    throttled.sendall(data)
+    elapsed = time.monotonic() - started
+
+    left.shutdown(socket.SHUT_WR)
+    assert right.makefile('rb').read() == data
+    assert throttled.meter.bytes == len(data)
+    # Half a second's worth, less the last slice that needs no wait after it
+    assert elapsed >= 0.4
+
+
+def test_limited_async_server_serves_whole_ranges(tmp_path, async_server):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    data = bytes(range(256)) * 400
+    (shared / 'f.bin').write_bytes(data)
+    port = async_server(shared, limiter=RateLimiter('test', 10 ** 7, 10 ** 6))
+
+    assert peer_protocol.fetch_range('127.0.0.1', port, 'f.bin', 100, len(data) - 100) == \
+        data[100:]
@@ -0,0 +1,83 @@
+import pytest
+
+import peer_protocol
+from resume import DownloadState
+
+
+def test_state_survives_a_restart(tmp_path):
+    state = DownloadState(tmp_path / 'f.bin')
+    state.start(100, digest='abc', piece_size=10)
+    with state.open_part() as f:
+        f.write(b"x" * 25)
+        state.received = 25
+        state.pieces = {5}
+        state.save(f, force=True)
+
+    again = DownloadState(tmp_path / 'f.bin')
+    assert again.load()
+    assert again.matches(100, 'abc') and not again.matches(100, 'other') and not again.matches(99)
+    assert again.contiguous_bytes() == 25
+    assert again.done_pieces() == {0, 1, 5}
+
+
+def test_contiguous_bytes_follow_complete_pieces(tmp_path):
+    state = DownloadState(tmp_path / 'f.bin')
+    state.start(25, piece_size=10)
+    state.pieces = {0, 1, 2}
+    assert state.contiguous_bytes() == 25
+
+
+def test_a_different_file_starts_over(tmp_path):
+    state = DownloadState(tmp_path / 'f.bin')
+    state.start(100, digest='abc', piece_size=10)
+    with state.open_part() as f:
+        state.received = 50
+        state.save(f, force=True)
+
+    again = DownloadState(tmp_path / 'f.bin')
+    again.start(100, digest='def', piece_size=10)
+    assert again.received == 0 and not again.part_path.exists()
+
+
+def test_unreadable_state_is_ignored(tmp_path):
+    state = DownloadState(tmp_path / 'f.bin')
+    state.part_path.write_bytes(b"x")
+    state.state_path.write_text("{not json")
+    assert not state.load()
+
+
+def test_finish_moves_the_file_into_place(tmp_path):
+    state = DownloadState(tmp_path / 'f.bin')
+    state.start(3)
+    with state.open_part() as f:
+        f.write(b"abc")
+        state.save(f, force=True)
+    state.finish()
+    assert (tmp_path / 'f.bin').read_bytes() == b"abc"
+    assert not state.part_path.exists() and not state.state_path.exists()
+
+
+def test_range_requests_round_trip():
+    line = peer_protocol.build_range_request("my file.txt", 10, -1)
+    assert peer_protocol.parse_range_request(line) == ("my file.txt", 10, -1)
+    with pytest.raises(peer_protocol.PeerProtocolError):
+        peer_protocol.parse_range_request(b"RANGE ten 5 f\n")
+
+
+@pytest.mark.parametrize('offset, length, expected', [
+    (0, -1, (0, 100)),
+    (90, 50, (90, 10)),
+    (200, 5, (100, 0)),
+    (-5, 10, (0, 10)),
+])
+def test_ranges_are_clamped_to_the_file(offset, length, expected):
+    assert peer_protocol.clamp_range(100, offset, length) == expected
+
+
+def test_range_fetch_from_a_peer(range_server, tmp_path):
+    (tmp_path / 'f.bin').write_bytes(bytes(range(256)))
+    port = range_server(tmp_path)
+    assert peer_protocol.probe_file_size('127.0.0.1', port, 'f.bin') == 256
+    assert peer_protocol.fetch_range('127.0.0.1', port, 'f.bin', 250, 6) == bytes(range(250, 256))
+    with pytest.raises(FileNotFoundError):
+        peer_protocol.fetch_range('127.0.0.1', port, 'missing', 0, 1)
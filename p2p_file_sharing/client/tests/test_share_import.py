@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import manifest
+from share_import import stage_shared_file
+from shared_index import ShareIndex
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'elsewhere' / 'movie.bin'
+    path.parent.mkdir()
+    path.write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+    return path
+
+
+@pytest.fixture
+def shared_dir(tmp_path):
+    directory = tmp_path / 'shared'
+    directory.mkdir()
+    return directory
+
+
+@pytest.mark.parametrize('in_place', [True, False])
+def test_staged_file_has_the_right_content_and_manifest(source, shared_dir, in_place):
+    progress = []
+
+    staged, final, file_manifest, method = stage_shared_file(
+        source, shared_dir, in_place, lambda done, total: progress.append((done, total)))
+
+    assert staged.name == '.movie.bin.partial' and final == shared_dir / 'movie.bin'
+    assert staged.read_bytes() == source.read_bytes()
+    assert file_manifest == manifest.build_manifest(source)
+    assert progress[-1] == (source.stat().st_size, source.stat().st_size)
+    if in_place:
+        assert method in ('hardlink', 'symlink')
+    else:
+        assert method in ('reflink', 'copy')
+        assert not os.path.samefile(staged, source)
+
+
+def test_leftover_staging_file_is_replaced(source, shared_dir):
+    (shared_dir / '.movie.bin.partial').write_bytes(b'stale')
+
+    staged, _, _, _ = stage_shared_file(source, shared_dir, in_place=False)
+
+    assert staged.read_bytes() == source.read_bytes()
+
+
+def test_staged_files_are_not_shared_until_renamed(source, shared_dir, tmp_path):
+    index = ShareIndex(str(shared_dir), str(tmp_path / 'index.db'))
+    staged, final, file_manifest, _ = stage_shared_file(source, shared_dir)
+
+    assert index.refresh() == ([], [], [])
+
+    os.replace(staged, final)
+    index.add(final.name, file_manifest)
+    assert index.digests() == {'movie.bin': file_manifest['digest']}
+    assert not index.has_changes()
@@ -0,0 +1,97 @@
+import os
+import threading
+
+import pytest
+
+import manifest
+from share_watcher import ShareWatcher
+from shared_index import ShareIndex
+
+
+@pytest.fixture
+def share(tmp_path):
+    directory = tmp_path / 'shared'
+    directory.mkdir()
+    (directory / 'a.txt').write_bytes(b'alpha')
+    (directory / 'b.txt').write_bytes(b'bravo')
+    return directory
+
+
+def open_index(share):
+    return ShareIndex(str(share), str(share.parent / 'index.db'))
+
+
+def touch_later(path, data):
+    """Rewrite path so its mtime is guaranteed to differ from before"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    path.write_bytes(data)
+    os.utime(path, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+
+
+def test_first_scan_indexes_everything(share):
+    index = open_index(share)
+
+    added, changed, removed = index.refresh()
+
+    assert sorted(added) == ['a.txt', 'b.txt'] and changed == [] and removed == []
+    assert index.digests()['a.txt'] == manifest.build_manifest(share / 'a.txt')['digest']
+    assert index.manifests(['b.txt'])['b.txt'] == manifest.build_manifest(share / 'b.txt')
+
+
+def test_reports_added_changed_and_removed(share):
+    index = open_index(share)
+    index.refresh()
+    touch_later(share / 'a.txt', b'ALPHA')
+    (share / 'b.txt').unlink()
+    (share / 'c.txt').write_bytes(b'charlie')
+
+    assert index.has_changes()
+    assert index.refresh() == (['c.txt'], ['a.txt'], ['b.txt'])
+    assert not index.has_changes()
+
+
+def test_restart_only_hashes_what_changed(share, monkeypatch):
+    open_index(share).refresh()
+    touch_later(share / 'a.txt', b'ALPHA')
+    hashed = []
+    build = manifest.build_manifests
+    monkeypatch.setattr(manifest, 'build_manifests',
+                        lambda paths: hashed.extend(paths) or build(paths))
+
+    index = open_index(share)
+
+    assert index.refresh() == ([], ['a.txt'], [])
+    assert [os.path.basename(path) for path in hashed] == ['a.txt']
+
+
+def test_quick_scan_trusts_an_unchanged_directory(share):
+    open_index(share).refresh()
+    touch_later(share / 'a.txt', b'ALPHA')  # In-place edit: directory mtime is unchanged
+
+    index = open_index(share)
+
+    assert index.refresh(quick=True) == ([], [], [])
+    assert index.refresh() == ([], ['a.txt'], [])
+
+
+def test_watcher_reports_changes(share):
+    index = open_index(share)
+    index.refresh()
+    calls = []
+    started, changed = threading.Event(), threading.Event()
+
+    def on_change():
+        calls.append(index.refresh())
+        (changed if started.is_set() else started).set()
+
+    watcher = ShareWatcher(index, on_change, poll_interval=0.05, debounce=0.05)
+    watcher.start()
+    try:
+        assert started.wait(5)
+        (share / 'c.txt').write_bytes(b'charlie')
+        assert changed.wait(5)
+    finally:
+        watcher.stop()
+
+    assert calls[0] == ([], [], [])  # The reconciliation at startup
+    assert (['c.txt'], [], []) in calls[1:]
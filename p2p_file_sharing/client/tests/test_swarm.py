@@ -0,0 +1,137 @@
+import errno
+import os
+
+import pytest
+
+import manifest
+from resume import DownloadState
+from swarm import SwarmDownload, SwarmError
+
+PIECE = 64 * 1024
+
+
+@pytest.fixture
+def shared(tmp_path):
+    directory = tmp_path / 'shared'
+    directory.mkdir()
+    data = os.urandom(PIECE * 5 + 123)
+    (directory / 'f.bin').write_bytes(data)
+    return directory, data
+
+
+def test_pieces_come_from_every_source(shared, range_server, tmp_path):
+    directory, data = shared
+    sources = [('127.0.0.1', range_server(directory)), ('127.0.0.1', range_server(directory))]
+    save_path = tmp_path / 'out.bin'
+    progress = []
+
+    download = SwarmDownload('f.bin', sources, save_path, piece_size=PIECE,
+                             progress_callback=lambda received, total: progress.append(received))
+    download.run()
+
+    assert save_path.read_bytes() == data
+    assert sum(stats['bytes'] for stats in download.source_stats.values()) >= len(data)
+    assert progress[-1] == len(data)
+
+
+def test_unreachable_source_is_dropped(shared, range_server, closed_port, tmp_path):
+    directory, data = shared
+    sources = [('127.0.0.1', closed_port), ('127.0.0.1', range_server(directory))]
+    save_path = tmp_path / 'out.bin'
+
+    SwarmDownload('f.bin', sources, save_path, piece_size=PIECE).run()
+
+    assert save_path.read_bytes() == data
+
+
+def test_no_responding_source(closed_port, tmp_path):
+    with pytest.raises(SwarmError):
+        SwarmDownload('f.bin', [('127.0.0.1', closed_port)], tmp_path / 'out.bin').run()
+
+
+class FullDisk:
+    """A file whose writes fail once the first piece is on disk"""
+
+    def __init__(self, f):
+        self.f = f
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        if self.writes > 1:
+            raise OSError(errno.ENOSPC, "No space left on device")
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+
+def test_write_error_stops_the_download(shared, range_server, tmp_path, monkeypatch):
+    directory, _ = shared
+    sources = [('127.0.0.1', range_server(directory)), ('127.0.0.1', range_server(directory))]
+    open_part = DownloadState.open_part
+    monkeypatch.setattr(DownloadState, 'open_part', lambda state: FullDisk(open_part(state)))
+
+    with pytest.raises(SwarmError, match="No space left"):
+        SwarmDownload('f.bin', sources, tmp_path / 'out.bin', piece_size=PIECE,
+                      timeout=2).run()
+
+
+def test_corrupt_pieces_are_refetched_from_good_sources(shared, range_server, tmp_path):
+    directory, data = shared
+    corrupt = tmp_path / 'corrupt'
+    corrupt.mkdir()
+    (corrupt / 'other-name.bin').write_bytes(bytes(len(data)))
+    (directory / 'copy.bin').write_bytes(data)
+    file_manifest = manifest.build_manifest(directory / 'f.bin', piece_size=PIECE)
+    sources = [('127.0.0.1', range_server(corrupt), 'other-name.bin'),
+               ('127.0.0.1', range_server(directory), 'copy.bin')]
+    save_path = tmp_path / 'out.bin'
+
+    download = SwarmDownload('f.bin', sources, save_path, manifest=file_manifest)
+    download.run()
+
+    assert save_path.read_bytes() == data
+    assert download.source_stats[sources[0]]['failures'] > 0
+
+
+def test_resumes_with_only_the_missing_pieces(shared, range_server, tmp_path):
+    directory, data = shared
+    save_path = tmp_path / 'out.bin'
+    state = DownloadState(save_path)
+    state.start(len(data), piece_size=PIECE)
+    with state.open_part() as f:
+        for index in (0, 2):
+            f.seek(index * PIECE)
+            f.write(data[index * PIECE:(index + 1) * PIECE])
+            state.pieces.add(index)
+        state.save(f, force=True)
+
+    download = SwarmDownload('f.bin', [('127.0.0.1', range_server(directory))], save_path,
+                             piece_size=PIECE)
+    download.run()
+
+    assert save_path.read_bytes() == data
+    assert sum(stats['bytes'] for stats in download.source_stats.values()) == len(data) - 2 * PIECE
+    assert not state.part_path.exists() and not state.state_path.exists()
+
+
+def test_stop_keeps_the_pieces_for_resuming(shared, range_server, tmp_path):
+    directory, data = shared
+    save_path = tmp_path / 'out.bin'
+    download = SwarmDownload('f.bin', [('127.0.0.1', range_server(directory))], save_path,
+                             piece_size=PIECE,
+                             progress_callback=lambda received, total: download.stop())
+
+    with pytest.raises(SwarmError, match="stopped"):
+        download.run()
+
+    state = DownloadState(save_path)
+    assert state.load()
+    assert 0 < len(state.done_pieces()) < 6
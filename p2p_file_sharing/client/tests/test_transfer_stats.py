@@ -0,0 +1,71 @@
+import json
+import time
+
+import pytest
+
+import transfer_stats
+from rate_limit import RateLimiter
+from transfer_stats import TransferStats
+
+
+@pytest.fixture
+def log(tmp_path):
+    path = tmp_path / 'transfers.jsonl'
+    transfer_stats.configure(path)
+    yield lambda: [json.loads(line) for line in path.read_text().splitlines()]
+    transfer_stats.configure(None)
+
+
+def test_finished_transfer_is_logged(log):
+    with TransferStats('download', '10.0.0.1:5000', 'f.bin', offset=10, mode='single') as stats:
+        with stats.timing('disk'):
+            time.sleep(0.01)
+        stats.bytes = 100
+
+    (record,) = log()
+    assert (record['direction'], record['filename'], record['offset'], record['bytes']) == \
+        ('download', 'f.bin', 10, 100)
+    assert record['result'] == 'ok'
+    assert record['disk'] >= 0.01
+    # Each is rounded to the microsecond
+    assert record['duration'] == pytest.approx(record['disk'] + record['other'], abs=1e-5)
+    assert transfer_stats.recent(1) == [record]
+
+
+def test_failures_are_logged_with_the_error(log):
+    with pytest.raises(OSError):
+        with TransferStats('upload', '10.0.0.1', 'f.bin'):
+            raise OSError("disk full")
+
+    (record,) = log()
+    assert (record['result'], record['error']) == ('error', 'disk full')
+
+
+def test_size_probes_are_not_logged(log):
+    TransferStats('upload', '10.0.0.1', 'f.bin').finish()
+    assert log() == []
+
+
+def test_limiter_sleeps_count_as_throttle():
+    limiter = RateLimiter('test', 100000)
+    meter = limiter.open('peer')
+    stats = TransferStats('upload', 'peer', 'f.bin', meter=meter)
+
+    with stats.timing('send', meter):
+        limiter.throttle(meter, 20000)
+
+    assert stats.seconds['throttle'] == pytest.approx(0.2, abs=0.05)
+    assert stats.seconds['send'] < 0.05
+    assert stats.finish()['wire_bytes'] == 20000
+
+
+def test_timed_iteration():
+    stats = TransferStats('download', 'peer', 'f.bin')
+
+    def slow():
+        for item in (b'a', b'b'):
+            time.sleep(0.01)
+            yield item
+
+    assert list(stats.timed('recv', slow())) == [b'a', b'b']
+    assert stats.seconds['recv'] >= 0.02
@@ -0,0 +1,51 @@
+import threading
+
+from ui_events import EventChannel
+
+
+def test_newer_posts_replace_older_ones():
+    channel = EventChannel()
+    for received in range(1000):
+        channel.post(('progress', 1), received)
+    channel.post(('progress', 2), 5)
+
+    latest, calls = channel.drain()
+
+    assert latest == {('progress', 1): 999, ('progress', 2): 5}
+    assert calls == []
+
+
+def test_calls_are_kept_in_order():
+    channel = EventChannel()
+    channel.call(print, 'a')
+    channel.call(len, 'bc')
+
+    assert channel.drain()[1] == [(print, ('a',)), (len, ('bc',))]
+
+
+def test_drain_takes_everything_once():
+    channel = EventChannel()
+    channel.post('k', 1)
+    channel.call(print)
+    channel.drain()
+
+    assert channel.drain() == ({}, [])
+
+
+def test_posts_from_many_threads():
+    channel = EventChannel()
+
+    def worker(n):
+        for i in range(1000):
+            channel.post(n, i)
+            channel.call(print, n)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latest, calls = channel.drain()
+    assert latest == {n: 999 for n in range(4)}
+    assert len(calls) == 4000
@@ -0,0 +1,174 @@
+"""Per-transfer statistics, written one JSON object per line to a rotating log.
+
+Every download and every file served gets a ``TransferStats`` record.
+Besides bytes and duration it splits the time into where the transfer
+was stalled, so a slow transfer can be pinned on the network, the disk or
+the peer itself:
+
+- ``recv``: waiting on the socket for data (including decompression)
+- ``send``: waiting for the socket to take data; ``sendfile`` reads the
+  file in the kernel, so served disk reads land here too
+- ``disk``: reading or writing the file and its resume checkpoint
+- ``cpu``: hashing pieces, and reading plus compressing blocks to serve
+- ``throttle``: sleeping for the bandwidth limits
+
+Whatever is left of ``duration`` is Python overhead between those.  In a
+swarm download several workers stall at once, so there the stall times
+add up across workers and can exceed ``duration``.
+
+The log is rotated by size; ``configure(None)`` turns writing it off.
+The last records are also kept in memory for ``recent()``.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+TRANSFER_LOG = Path('logs') / 'transfers.jsonl'
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+RECENT = 100  # Records kept for recent()
+KINDS = ('recv', 'send', 'disk', 'cpu', 'throttle')
+
+_logger = logging.getLogger('p2p.transfers')
+_logger.propagate = False
+_logger.setLevel(logging.INFO)
+_config_lock = threading.Lock()
+_log_path = TRANSFER_LOG
+_handler = None
+_recent = deque(maxlen=RECENT)
+
+
+def configure(path=TRANSFER_LOG, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+    """Write records to path from now on, or nowhere if path is None"""
+    global _log_path, _handler
+    with _config_lock:
+        if _handler is not None:
+            _logger.removeHandler(_handler)
+            _handler.close()
+            _handler = None
+        _log_path = Path(path) if path else None
+        if _log_path is not None:
+            _log_path.parent.mkdir(parents=True, exist_ok=True)
+            _handler = RotatingFileHandler(_log_path, maxBytes=max_bytes,
+                                           backupCount=backups, encoding='utf-8')
+            _handler.setFormatter(logging.Formatter('%(message)s'))
+            _logger.addHandler(_handler)
+
+
+def _write(record):
+    _recent.append(record)
+    if _handler is None:
+        if _log_path is None:
+            return
+        configure(_log_path)  # First record: open the default log
+    _logger.info(json.dumps(record, separators=(',', ':')))
+
+
+def recent(n=RECENT):
+    """The last n records, oldest first"""
+    return list(_recent)[-n:]
+
+
+class _Timing:
+    """Adds the time its body takes to one kind, and rate-limiter sleeps to throttle"""
+
+    def __init__(self, stats, kind, meter):
+        self.stats = stats
+        self.kind = kind
+        self.meter = meter
+
+    def __enter__(self):
+        self.waited = self.meter.waited if self.meter else 0.0
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        waited = self.meter.waited - self.waited if self.meter else 0.0
+        self.stats.add(self.kind, elapsed - waited)
+        if waited:
+            self.stats.add('throttle', waited)
+
+
+class TransferStats:
+    def __init__(self, direction, peer, filename, offset=0, mode=None, meter=None):
+        """direction is 'download' or 'upload'; meter, if given, is the
+        rate_limit.Meter of the connection, used for wire bytes and for
+        telling throttling apart from socket time"""
+        self.direction = direction
+        self.peer = peer
+        self.filename = filename
+        self.offset = offset
+        self.mode = mode
+        self.meter = None
+        self.bytes = 0
+        self.retries = 0
+        self.result = None  # 'ok', 'error', or why the transfer was stopped
+        self.extra = {}
+        self.seconds = dict.fromkeys(KINDS, 0.0)
+        self._lock = threading.Lock()
+        self._wire_start = None
+        self._started_at = time.time()
+        self._started = time.perf_counter()
+        if meter is not None:
+            self.watch(meter)
+
+    def watch(self, meter):
+        """Count the bytes meter moves from now on as this transfer's wire bytes"""
+        self.meter = meter
+        self._wire_start = meter.bytes
+
+    def add(self, kind, seconds):
+        with self._lock:
+            self.seconds[kind] += seconds
+
+    def timing(self, kind, meter=None):
+        """Context manager timing its body as kind.
+
+        Pass the connection's meter when the body may sleep in the rate
+        limiter, so that time is counted as throttle instead.
+        """
+        return _Timing(self, kind, meter)
+
+    def timed(self, kind, iterable, meter=None):
+        """Iterate over iterable, timing each step as kind"""
+        it = iter(iterable)
+        while True:
+            with self.timing(kind, meter):
+                item = next(it, None)
+            if item is None:
+                return
+            yield item
+
+    def finish(self, error=None):
+        """Record the transfer as done (or failed with error) and log it"""
+        duration = time.perf_counter() - self._started
+        if self.result is None:
+            self.result = 'error' if error else 'ok'
+        record = {'time': round(self._started_at, 3), 'direction': self.direction,
+                  'peer': self.peer, 'filename': self.filename, 'mode': self.mode,
+                  'offset': self.offset, 'bytes': self.bytes,
+                  'wire_bytes': self.meter.bytes - self._wire_start if self.meter else None,
+                  'duration': round(duration, 6),
+                  'bytes_per_sec': round(self.bytes / duration, 1) if duration else None}
+        with self._lock:
+            record.update((kind, round(seconds, 6)) for kind, seconds in self.seconds.items())
+        record['other'] = round(max(duration - sum(self.seconds.values()), 0.0), 6)
+        record['retries'] = self.retries
+        record['result'] = self.result
+        if error:
+            record['error'] = str(error)
+        record.update(self.extra)
+        if self.bytes or self.retries or self.result != 'ok':
+            _write(record)  # Requests for no data only probe the size; not worth a line
+        return record
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc)
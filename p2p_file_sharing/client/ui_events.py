@@ -0,0 +1,31 @@
+"""Hand-off of updates from worker threads to the Tk main loop.
+
+Workers never touch widgets.  They ``post`` state under a key, where a
+newer value replaces any not yet shown (so a transfer reporting progress
+thousands of times a second costs one redraw per frame), or ``call`` a
+function that must run on the Tk thread exactly once, in order.  The UI
+drains the channel from a timer at a fixed frame rate.
+"""
+import threading
+
+
+class EventChannel:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}  # key -> newest value not yet drained
+        self._calls = []
+
+    def post(self, key, value):
+        with self._lock:
+            self._latest[key] = value
+
+    def call(self, func, *args):
+        with self._lock:
+            self._calls.append((func, args))
+
+    def drain(self):
+        """Return ({key: latest value}, [(func, args)]) posted since the last drain"""
+        with self._lock:
+            latest, self._latest = self._latest, {}
+            calls, self._calls = self._calls, []
+        return latest, calls
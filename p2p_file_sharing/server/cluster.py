@@ -0,0 +1,225 @@
+"""Running the tracker as a cluster of nodes, each holding a shard of the catalog.
+
+Every node is a whole tracker (started with ``serve.py --node-url``) with
+its own database.  The catalog is split between them by consistent
+hashing: a ``files`` row lives on the node owning its filename on the
+ring, and a manifest on the node owning its digest.  Each node has
+VNODES points on the ring, so a node that joins takes a roughly equal
+slice from every other node and only the rows in those slices move.
+
+Peers are not sharded.  Accounts are copied to every node when they
+register, and each node pushes the heartbeats it hears to the others in
+batches every REPLICATION_INTERVAL seconds, so every node hides and
+expires peers' files itself, with the same tables and cleanup as a
+single tracker.  A peer's share version is kept by the node owning its
+username; requests that change it are forwarded there, so they are
+applied one at a time.  The password is the exception: it stays on the
+node the peer registered with, its home (``peers.home`` on the others),
+and a login anywhere else is forwarded there.
+
+Any node answers any request: writes are forwarded to or fanned out
+over the nodes concerned, and searches are sent to every node and the
+results merged.  The membership is a list of node URLs kept in each
+node's database, where all of its worker processes read it.  A node
+joins by asking any member, which adds it and tells the others; lists
+are merged by union, so joins at different members converge.  Nodes are
+only ever added.
+
+Node-to-node requests go to the /cluster/ routes with the shared secret
+in X-Cluster-Secret.  Those routes copy accounts and write the catalog
+directly, so a node won't run without a secret.
+"""
+import bisect
+import hashlib
+import hmac
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+
+VNODES = 64  # Ring points per node
+REPLICATION_INTERVAL = 2  # Seconds between pushes of heartbeats to the other nodes
+REFRESH_INTERVAL = 5  # Seconds between re-reading the membership
+NODE_TIMEOUT = 5  # Seconds to wait for another node
+MAX_CONCURRENT_CALLS = 16
+SECRET_HEADER = 'X-Cluster-Secret'
+FORWARDED_HEADER = 'X-Cluster-Forwarded'
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=VNODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted((_hash(f"{node}#{i}"), node)
+                        for node in self.nodes for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+    def partition(self, items, key=lambda item: item):
+        """{node: [items it owns]}, with an entry for every node"""
+        parts = {node: [] for node in self.nodes}
+        for item in items:
+            parts[self.owner(key(item))].append(item)
+        return parts
+
+
+class Cluster:
+    def __init__(self, url, secret):
+        """url is this node's base URL, as the other nodes reach it; secret
+        is shared by all the nodes"""
+        if not secret:
+            raise ValueError("A cluster node needs a secret shared by the nodes")
+        self.url = url.rstrip('/')
+        self.secret = secret
+        self.version = None  # Of the membership last read
+        self.members = [self.url]
+        self.ring = HashRing(self.members)
+        self.changed_at = time.monotonic()  # When the membership last changed
+        self.on_call = None  # on_call(site, seconds, ok) after every request to a node, if set
+        self._lock = threading.Lock()
+        self._beats = {}  # username -> (ip, port, when) not pushed to the others yet
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(MAX_CONCURRENT_CALLS, thread_name_prefix='cluster')
+
+    # Membership
+
+    def init(self, c):
+        """Create the membership table, starting as a cluster of one"""
+        c.execute('CREATE TABLE IF NOT EXISTS cluster_state (version INTEGER, members TEXT)')
+        c.execute('''INSERT INTO cluster_state SELECT 1, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM cluster_state)''',
+                  (json.dumps([self.url]),))
+
+    def refresh(self, conn):
+        """Pick up membership changes made by this node's other processes"""
+        version, members = conn.execute('SELECT version, members FROM cluster_state').fetchone()
+        if version != self.version:
+            members = json.loads(members)
+            self.members = members
+            self.ring = HashRing(members)
+            self.version = version
+            self.changed_at = time.monotonic()
+
+    def add_members(self, conn, members, begin=None):
+        """Add members to the stored membership.
+
+        Returns the whole new list if that added anyone, else None.
+        begin(conn), if given, opens the write transaction.
+        """
+        if begin is not None:
+            begin(conn)
+        try:
+            version, current = conn.execute(
+                'SELECT version, members FROM cluster_state').fetchone()
+            current = json.loads(current)
+            merged = sorted(set(current) | set(members))
+            if merged == sorted(current):
+                conn.rollback()
+                return None
+            conn.execute('UPDATE cluster_state SET version = ?, members = ?',
+                         (version + 1, json.dumps(merged)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        self.refresh(conn)
+        return merged
+
+    def others(self):
+        return [node for node in self.members if node != self.url]
+
+    def run_refresher(self, db, interval=REFRESH_INTERVAL):
+        while True:
+            time.sleep(interval)
+            try:
+                with db.connection() as conn:
+                    self.refresh(conn)
+            except Exception as e:
+                print(f"Cluster refresh error: {str(e)}")
+
+    # Talking to other nodes
+
+    def authorized(self, headers):
+        return hmac.compare_digest(headers.get(SECRET_HEADER, '').encode(),
+                                   self.secret.encode())
+
+    def _session(self):
+        # One per thread, so connections to the other nodes are kept alive
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers[SECRET_HEADER] = self.secret
+        return session
+
+    def call(self, node, method, path, site=None, **kwargs):
+        """Send a request to another node; raises requests.RequestException.
+
+        site labels the call for on_call, defaulting to path.
+        """
+        kwargs.setdefault('timeout', NODE_TIMEOUT)
+        started = time.perf_counter()
+        ok = False
+        try:
+            response = self._session().request(method, node + path, **kwargs)
+            ok = response.status_code < 500
+            return response
+        finally:
+            if self.on_call is not None:
+                self.on_call(site or path, time.perf_counter() - started, ok)
+
+    def gather(self, calls):
+        """Run {key: function} concurrently; returns {key: result or the exception raised}"""
+        futures = {key: self._pool.submit(function) for key, function in calls.items()}
+        results = {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                results[key] = e
+        return results
+
+    def post_all(self, nodes, path, payload):
+        """POST payload to each node, returning the nodes that didn't take it"""
+        results = self.gather({node: partial(self.call, node, 'POST', path, json=payload)
+                               for node in nodes})
+        return [node for node, result in results.items()
+                if isinstance(result, Exception) or result.status_code != 200]
+
+    def join(self, via):
+        """Ask member via to add this node; returns the membership it sent back"""
+        response = self.call(via.rstrip('/'), 'POST', '/cluster/join', json={'url': self.url},
+                             timeout=NODE_TIMEOUT * 3)
+        response.raise_for_status()
+        return response.json()['members']
+
+    # Heartbeats
+
+    def queue_beat(self, username, ip, port, when):
+        with self._lock:
+            self._beats[username] = (ip, port, when)
+
+    def run_replicator(self, interval=REPLICATION_INTERVAL):
+        """Background loop pushing the heartbeats heard here to every other node"""
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                beats, self._beats = self._beats, {}
+            others = self.others()
+            if not beats or not others:
+                continue
+            payload = {'beats': [[username, ip, port, when.isoformat()]
+                                 for username, (ip, port, when) in beats.items()]}
+            # A node that misses a batch hears from those peers again before they expire
+            failed = self.post_all(others, '/cluster/heartbeats', payload)
+            if failed:
+                print(f"Heartbeat replication to {', '.join(failed)} failed")
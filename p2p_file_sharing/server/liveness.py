@@ -0,0 +1,234 @@
+"""In-memory peer liveness for the tracker.
+
+Heartbeats only touch a dictionary here; the latest heartbeat of every
+peer is written to the ``peers`` table in one batch every few seconds by
+``run_flusher``, instead of one UPDATE and commit per heartbeat.
+
+Peers are kept in a heap ordered by expiry, so working out who has gone
+quiet costs only as much as the number of peers that actually expired.
+Expired peers stay listed in ``expired()`` until the cleanup loop has
+removed their rows, which is what /files uses to hide their files without
+consulting ``last_heartbeat``.  ``fingerprint()`` identifies that set, for
+use in catalog ETags.
+
+When the tracker runs as several worker processes (see serve.py), each
+one only hears the heartbeats sent to it.  ``sync`` reads back what the
+others have flushed, so every worker converges on the same view within a
+couple of flush intervals, and forgets expired peers whose rows cleanup
+has since removed.  Nodes of a tracker cluster (see cluster.py) pass
+each other the heartbeats they hear, which ``merge`` takes in.
+"""
+import hashlib
+import heapq
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+def _parse(last_heartbeat):
+    if isinstance(last_heartbeat, str):
+        try:
+            return datetime.fromisoformat(last_heartbeat)
+        except ValueError:
+            return None
+    return last_heartbeat
+
+
+class LivenessRegistry:
+    def __init__(self, ttl=60):
+        self.ttl = timedelta(seconds=ttl)
+        self.generation = 0  # Changes whenever the set of live peers does
+        self._lock = threading.Lock()
+        self._last_beat = {}  # username -> datetime of last heartbeat
+        self._heap = []  # (expires_at, username); stale entries skipped lazily
+        self._expired = {}  # username -> last heartbeat, awaiting cleanup
+        self._dirty = {}  # username -> (last heartbeat, ip, port) not yet flushed
+        self._fingerprint = (None, None)  # (generation, fingerprint) last computed
+
+    def load(self, rows):
+        """Seed from (username, last_heartbeat) rows read at startup"""
+        with self._lock:
+            for username, last_heartbeat in rows:
+                last_heartbeat = _parse(last_heartbeat)
+                if last_heartbeat is None:
+                    continue
+                self._last_beat[username] = last_heartbeat
+                heapq.heappush(self._heap, (last_heartbeat + self.ttl, username))
+            self._expire(datetime.now())
+            self.generation += 1
+
+    def beat(self, username, ip, port, when=None):
+        when = when or datetime.now()
+        with self._lock:
+            self._beat(username, ip, port, when)
+
+    def merge(self, beats):
+        """Take in (username, ip, port, when) heartbeats another tracker node
+        received, ignoring any older than what we already have"""
+        with self._lock:
+            for username, ip, port, when in beats:
+                known = self._last_beat.get(username) or self._expired.get(username)
+                if known is None or known < when:
+                    self._beat(username, ip, port, when)
+
+    def _beat(self, username, ip, port, when):
+        if username not in self._last_beat or username in self._expired:
+            self.generation += 1  # A peer came (back) to life
+        self._expired.pop(username, None)
+        self._last_beat[username] = when
+        heapq.heappush(self._heap, (when + self.ttl, username))
+        self._dirty[username] = (when, ip, port)
+
+    def _expire(self, now):
+        expired_any = False
+        while self._heap and self._heap[0][0] < now:
+            expires_at, username = heapq.heappop(self._heap)
+            last_beat = self._last_beat.get(username)
+            if last_beat is None or last_beat + self.ttl != expires_at:
+                continue  # Superseded by a later heartbeat
+            del self._last_beat[username]
+            self._expired[username] = last_beat
+            expired_any = True
+        if expired_any:
+            self.generation += 1
+
+    def expired(self):
+        """Usernames whose heartbeats have lapsed but whose rows still exist"""
+        with self._lock:
+            self._expire(datetime.now())
+            return list(self._expired)
+
+    def counts(self):
+        """(live peers, expired peers awaiting cleanup)"""
+        with self._lock:
+            self._expire(datetime.now())
+            return len(self._last_beat), len(self._expired)
+
+    def fingerprint(self):
+        """Short hash of the expired peers, the only part of liveness /files depends on.
+
+        Unlike generation it is the same in every process holding the same
+        view, so ETags stay valid whichever worker answers.
+        """
+        with self._lock:
+            self._expire(datetime.now())
+            generation, fingerprint = self._fingerprint
+            if generation != self.generation:
+                fingerprint = hashlib.sha1(
+                    json.dumps(sorted(self._expired)).encode()).hexdigest()[:12]
+                self._fingerprint = (self.generation, fingerprint)
+            return fingerprint
+
+    def forget_expired(self, before):
+        """Drop expired peers whose last heartbeat is older than before.
+
+        Called once cleanup has deleted the rows of peers that went quiet
+        before that time.
+        """
+        with self._lock:
+            for username, last_beat in list(self._expired.items()):
+                if last_beat < before:
+                    del self._expired[username]
+
+    def knows(self, username):
+        """Whether username has a heartbeat on record here, live or expired"""
+        with self._lock:
+            return username in self._last_beat or username in self._expired
+
+    def forget(self, username):
+        with self._lock:
+            if self._last_beat.pop(username, None) is not None:
+                self.generation += 1
+            self._expired.pop(username, None)
+            self._dirty.pop(username, None)
+
+    def flush(self, conn, begin=None):
+        """Write heartbeats received since the last flush to the peers table.
+
+        begin(conn), if given, opens the write transaction.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        try:
+            if begin is not None:
+                begin(conn)
+            # Another worker may already have written a later heartbeat
+            conn.executemany('''UPDATE peers SET last_heartbeat = ?, ip = ?, port = ?
+                                WHERE username = ?
+                                AND (last_heartbeat IS NULL OR last_heartbeat < ?)''',
+                             [(when, ip, port, username, when)
+                              for username, (when, ip, port) in dirty.items()])
+            conn.commit()
+        except Exception:
+            with self._lock:
+                # Keep anything newer that arrived while we were writing
+                for username, entry in dirty.items():
+                    self._dirty.setdefault(username, entry)
+            raise
+        return len(dirty)
+
+    def sync(self, conn, since=None):
+        """Take in heartbeats written to the peers table after since (all if None).
+
+        Only moves heartbeats forward and never marks anything for
+        flushing.  Returns when the read started, for the next call.
+        """
+        started = datetime.now()
+        if since is None:
+            rows = conn.execute('SELECT username, last_heartbeat FROM peers').fetchall()
+        else:
+            rows = conn.execute('SELECT username, last_heartbeat FROM peers '
+                                'WHERE last_heartbeat > ?', (since,)).fetchall()
+        with self._lock:
+            expired = list(self._expired)
+        gone = []
+        if expired:
+            gone = [row[0] for row in conn.execute(
+                '''SELECT value FROM json_each(?)
+                   WHERE value NOT IN (SELECT username FROM peers)''', (json.dumps(expired),))]
+
+        with self._lock:
+            changed = False
+            for username, last_heartbeat in rows:
+                last_heartbeat = _parse(last_heartbeat)
+                known = self._last_beat.get(username) or self._expired.get(username)
+                if last_heartbeat is None or (known is not None and known >= last_heartbeat):
+                    continue
+                changed = changed or username not in self._last_beat
+                self._expired.pop(username, None)
+                self._last_beat[username] = last_heartbeat
+                heapq.heappush(self._heap, (last_heartbeat + self.ttl, username))
+            for username in gone:
+                # Cleanup (maybe in another process) has deleted the peer
+                changed = self._expired.pop(username, None) is not None or changed
+            if changed:
+                self.generation += 1
+            self._expire(datetime.now())
+        return started
+
+    def run_flusher(self, db, interval=5, on_flush=None, sync=False):
+        """Background loop persisting heartbeats every interval seconds.
+
+        on_flush(heartbeats written, seconds taken) is called after each
+        flush.  With sync, heartbeats other processes flushed are read back
+        after each flush.
+        """
+        since = None
+        while True:
+            time.sleep(interval)
+            conn = db.acquire()
+            try:
+                started = time.perf_counter()
+                count = self.flush(conn, lambda conn: db.begin_write(conn, 'heartbeat_flush'))
+                if on_flush is not None:
+                    on_flush(count, time.perf_counter() - started)
+                if sync:
+                    # Others flush heartbeats up to an interval after receiving them
+                    since = self.sync(conn, since) - timedelta(seconds=2 * interval)
+            except Exception as e:
+                print(f"Heartbeat flush error: {str(e)}")
+            finally:
+                db.release(conn)
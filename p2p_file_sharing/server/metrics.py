@@ -0,0 +1,266 @@
+"""Counters and histograms for the tracker, served in Prometheus text format.
+
+Deliberately small and dependency-free: a metric keeps one entry per
+combination of label values, and updating it costs a dictionary lookup
+and, for histograms, a bisect over the bucket bounds, under a lock held
+for just that.  That is cheap enough to time every request.
+
+Gauges are computed when scraped from a callback, so values that already
+exist elsewhere (live peers, pooled connections) need no bookkeeping.
+
+A tracker running as several processes (see serve.py) has a registry in
+each.  ``SnapshotDir`` has every process write its values to a shared
+directory every few seconds, and renders the sum of them all, so whichever
+process is scraped answers for the whole tracker.  Counters and histograms
+of processes that have exited still count; their gauges no longer do.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+
+# Seconds; from a heartbeat answered from memory up to a slow full listing
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SNAPSHOT_INTERVAL = 5  # Seconds between a process's snapshots
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, values, other, live):
+        for labels, value in other.items():
+            values[labels] = values.get(labels, 0) + value
+
+    def samples(self, values):
+        for labels, value in values.items():
+            yield self.name + _labels(self.labelnames, labels), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * (len(self.buckets) + 2)
+            entry[index] += 1
+            entry[-1] += value
+
+    def time(self, *labels):
+        """Context manager observing how long its body takes"""
+        return _Timer(self, labels)
+
+    def values(self):
+        with self._lock:
+            return {labels: list(entry) for labels, entry in self._values.items()}
+
+    def merge(self, values, other, live):
+        for labels, entry in other.items():
+            mine = values.setdefault(labels, [0] * len(entry))
+            for i, value in enumerate(entry):
+                mine[i] += value
+
+    def samples(self, values):
+        for labels, entry in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry):
+                cumulative += count
+                yield (self.name + '_bucket'
+                       + _labels(self.labelnames, labels, [('le', _number(bound))]), cumulative)
+            yield self.name + '_sum' + _labels(self.labelnames, labels), entry[-1]
+            yield self.name + '_count' + _labels(self.labelnames, labels), cumulative
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Gauge:
+    """A value read from func() at scrape time; func may return {label values: value}.
+
+    Across processes the values of running processes are combined with
+    combine (sum by default; max for values every process sees alike).
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, func, labelnames=(), combine=sum):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labelnames = tuple(labelnames)
+        self.combine = combine
+
+    def values(self):
+        value = self.func()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return value
+
+    def merge(self, values, other, live):
+        if live:
+            for labels, value in other.items():
+                values[labels] = self.combine((values[labels], value)) if labels in values else value
+
+    def samples(self, values):
+        for labels, number in values.items():
+            yield self.name + _labels(self.labelnames, labels), number
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def snapshot(self):
+        """Every metric's values as JSON-friendly data, for SnapshotDir"""
+        snapshot = {}
+        for metric in self._metrics:
+            try:
+                snapshot[metric.name] = [[list(labels), value]
+                                         for labels, value in metric.values().items()]
+            except Exception:
+                pass  # A broken gauge is reported when rendering
+        return snapshot
+
+    def render(self, others=()):
+        """Every metric in the text exposition format.
+
+        others are (snapshot, live) pairs from other processes to add in.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            try:
+                values = metric.values()
+                for snapshot, live in others:
+                    metric.merge(values, {tuple(labels): value for labels, value
+                                          in snapshot.get(metric.name, ())}, live)
+                lines.extend(f'{name} {_number(value)}' for name, value in metric.samples(values))
+            except Exception as e:
+                # One broken gauge must not take the whole scrape down
+                lines.append(f'# {metric.name} unavailable: {_escape(e)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SnapshotDir:
+    """Registries of sibling processes, shared through files in path"""
+
+    def __init__(self, path, registry):
+        self.path = path
+        self.registry = registry
+        self.pid = os.getpid()
+
+    def file(self, pid):
+        return os.path.join(self.path, f'{pid}.json')
+
+    def write(self):
+        """Replace this process's snapshot with its current values"""
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp, self.file(self.pid))
+
+    def others(self):
+        """(snapshot, live) of every other process that has written one"""
+        others = []
+        for name in os.listdir(self.path):
+            stem, ext = os.path.splitext(name)
+            if ext != '.json' or not stem.isdigit() or int(stem) == self.pid:
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    others.append((json.load(f), _alive(int(stem))))
+            except (OSError, ValueError):
+                continue  # Gone, or being replaced right now
+        return others
+
+    def render(self):
+        return self.registry.render(self.others())
+
+    def run_writer(self, interval=SNAPSHOT_INTERVAL):
+        """Background loop writing a snapshot every interval seconds"""
+        while True:
+            try:
+                self.write()
+            except Exception as e:
+                print(f"Metrics snapshot error: {str(e)}")
+            time.sleep(interval)
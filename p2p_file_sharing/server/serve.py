@@ -0,0 +1,266 @@
+"""Production entry point for the tracker: a supervisor and pre-forked workers.
+
+    python serve.py --workers 4 --port 5001
+
+The supervisor sets up the database, binds the listening socket and
+starts ``--workers`` worker processes that all accept on it, so requests
+are spread over as many cores.  Each worker serves the Flask app on a
+threaded WSGI server.  The supervisor handles no requests; it runs the
+inactive-peer cleanup, once for the whole tracker, and replaces workers
+that die.
+
+Signals to the supervisor:
+
+    SIGTERM, SIGINT   graceful shutdown: workers stop accepting, finish the
+                      requests in progress, write back their heartbeats and
+                      exit (they are killed after --grace seconds)
+    SIGHUP            graceful reload: new workers, running the current
+                      code, start on the same socket, then the old ones
+                      are stopped as above; no connection is refused.  The
+                      supervisor itself (and so the cleanup) is not reloaded.
+
+Heartbeats are held in memory by the worker that received them; workers
+write them to the database every few seconds and read back each other's
+(see liveness.py).  Metrics are per process as well and are merged when
+scraped (see metrics.py), so any worker answers /metrics for the whole
+tracker.  Needs a POSIX system; ``python server.py`` still runs the
+single-process development server.
+
+With --node-url the tracker is one node of a cluster sharing the catalog
+(see cluster.py).  Every node needs the same secret, which keeps anyone
+else off the node-to-node routes.  Three nodes on one machine:
+
+    export TRACKER_CLUSTER_SECRET=$(python -c 'import secrets; print(secrets.token_hex(16))')
+    python serve.py --port 5001 --db node1.db --node-url http://127.0.0.1:5001
+    python serve.py --port 5002 --db node2.db --node-url http://127.0.0.1:5002 \
+        --join http://127.0.0.1:5001
+    python serve.py --port 5003 --db node3.db --node-url http://127.0.0.1:5003 \
+        --join http://127.0.0.1:5001
+
+--join is only needed the first time a node starts; it remembers the
+membership in its database.
+"""
+import argparse
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import server
+from cluster import Cluster
+from metrics import SnapshotDir
+
+SHUTDOWN_GRACE = 30  # Seconds a stopping worker gets to finish its requests
+READY_TIMEOUT = 30  # Seconds a reloaded worker gets to start serving
+KEEPALIVE_TIMEOUT = 10  # Seconds an idle keep-alive connection is kept
+RESPAWN_DELAY = 1  # Seconds before replacing a worker that died right after starting
+SECRET_ENV = 'TRACKER_CLUSTER_SECRET'
+
+
+class RequestHandler(WSGIRequestHandler):
+    # Idle keep-alive connections must not hold up a graceful stop for long
+    timeout = KEEPALIVE_TIMEOUT
+
+
+def configure(args):
+    """Point the tracker at its database, and make it a cluster node if asked to"""
+    server.db.path = args.db
+    if args.node_url:
+        server.cluster = Cluster(args.node_url, args.cluster_secret)
+        server.cluster.on_call = server.record_cluster_call
+
+
+def run_worker(args):
+    """Serve the app on the supervisor's socket until SIGTERM"""
+    if args.quiet:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    configure(args)
+    server.init_db()
+    server.metrics_snapshots = SnapshotDir(args.metrics_dir, server.metrics)
+    threading.Thread(target=server.liveness.run_flusher, args=(server.db,),
+                     kwargs={'on_flush': server.record_flush, 'sync': True}, daemon=True).start()
+    if server.cluster is not None:
+        threading.Thread(target=server.cluster.run_refresher, args=(server.db,),
+                         daemon=True).start()
+        threading.Thread(target=server.cluster.run_replicator, daemon=True).start()
+
+    httpd = make_server(args.host, args.port, server.app, threaded=True,
+                        request_handler=RequestHandler, fd=args.worker_fd)
+    httpd.daemon_threads = False  # So server_close() waits for requests in progress
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=httpd.shutdown).start())
+    # Ctrl+C and SIGHUP reach the whole process group; the supervisor decides what they mean
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    server.metrics_snapshots.write()  # Also tells the supervisor we are ready
+    threading.Thread(target=server.metrics_snapshots.run_writer, daemon=True).start()
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        # Heartbeats only this worker heard would otherwise be lost
+        started = time.perf_counter()
+        with server.db.connection() as conn:
+            count = server.liveness.flush(
+                conn, lambda conn: server.db.begin_write(conn, 'heartbeat_flush'))
+        server.record_flush(count, time.perf_counter() - started)
+        server.metrics_snapshots.write()
+        server.db.close_all()
+
+
+class Supervisor:
+    def __init__(self, args):
+        self.args = args
+        self.workers = {}  # pid -> Popen of the workers serving now
+        self.retiring = {}  # pid -> (Popen, time by which it must have exited)
+        self.signals = []  # Handled by the main loop, not in the signal handler
+
+    def run(self):
+        configure(self.args)
+        server.init_db()  # Once here, before workers start opening the database
+        cluster = server.cluster
+        if cluster is not None and self.args.join and cluster.members == [cluster.url]:
+            try:
+                server.join_cluster(self.args.join)
+            except Exception as e:
+                sys.exit(f"Could not join the cluster through {self.args.join}: {str(e)}")
+        server.db.close_all()
+        self.metrics_dir = tempfile.mkdtemp(prefix='tracker-metrics-')
+        server.metrics_snapshots = SnapshotDir(self.metrics_dir, server.metrics)
+        self.sock = socket.create_server((self.args.host, self.args.port), backlog=1024)
+        self.sock.set_inheritable(True)
+
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+        for _ in range(self.args.workers):
+            self.spawn()
+        # Expiry runs here, once, rather than racing itself in every worker
+        threading.Thread(target=server.cleanup_inactive_peers, daemon=True).start()
+        if cluster is not None:
+            threading.Thread(target=server.rebalance_catalog, daemon=True).start()
+        threading.Thread(target=server.metrics_snapshots.run_writer, daemon=True).start()
+        print(f"Tracker listening on {self.args.host}:{self.args.port} with "
+              f"{self.args.workers} workers (supervisor pid {os.getpid()})")
+
+        try:
+            while True:
+                while self.signals:
+                    if self.signals.pop(0) == signal.SIGHUP:
+                        self.reload()
+                    else:
+                        self.shutdown()
+                        return
+                self.reap()
+                time.sleep(0.2)
+        finally:
+            self.sock.close()
+            shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def spawn(self):
+        fd = self.sock.fileno()
+        command = [sys.executable, os.path.abspath(__file__), '--host', self.args.host,
+                   '--port', str(self.args.port), '--db', self.args.db, '--worker-fd', str(fd),
+                   '--metrics-dir', self.metrics_dir]
+        if self.args.node_url:
+            command += ['--node-url', self.args.node_url]
+        if self.args.quiet:
+            command.append('--quiet')
+        env = os.environ
+        if self.args.node_url:
+            # Not on the command line, where any user could read it
+            env = dict(env, **{SECRET_ENV: self.args.cluster_secret})
+        process = subprocess.Popen(command, env=env, pass_fds=(fd,))
+        process.started = time.monotonic()
+        self.workers[process.pid] = process
+        return process
+
+    def retire(self, process):
+        """Ask a worker to finish up and exit"""
+        process.send_signal(signal.SIGTERM)
+        self.retiring[process.pid] = (process, time.monotonic() + self.args.grace)
+
+    def reap(self):
+        for pid, process in list(self.workers.items()):
+            if process.poll() is None:
+                continue
+            del self.workers[pid]
+            print(f"Worker {pid} exited with status {process.returncode}, starting another")
+            if time.monotonic() - process.started < RESPAWN_DELAY * 5:
+                time.sleep(RESPAWN_DELAY)  # Don't spin if workers die on startup
+            self.spawn()
+        for pid, (process, deadline) in list(self.retiring.items()):
+            if process.poll() is not None:
+                del self.retiring[pid]
+            elif time.monotonic() > deadline:
+                print(f"Worker {pid} did not stop in time, killing it")
+                process.kill()
+
+    def reload(self):
+        """Replace every worker, starting the new ones before stopping the old"""
+        print("Reloading workers")
+        old, self.workers = self.workers, {}
+        new = [self.spawn() for _ in range(self.args.workers)]
+        deadline = time.monotonic() + READY_TIMEOUT
+        while not all(os.path.exists(server.metrics_snapshots.file(process.pid))
+                      for process in new):
+            if time.monotonic() > deadline or any(process.poll() is not None
+                                                  for process in new):
+                print("New workers failed to start, keeping the old ones")
+                for process in new:
+                    self.retire(process)
+                self.workers = old
+                return
+            time.sleep(0.1)
+        for process in old.values():
+            self.retire(process)
+
+    def shutdown(self):
+        print("Shutting down, waiting for workers to finish their requests")
+        for process in self.workers.values():
+            self.retire(process)
+        self.workers = {}
+        while self.retiring:
+            self.reap()
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the tracker on several worker processes")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--grace', type=float, default=SHUTDOWN_GRACE,
+                        help="Seconds workers get to finish requests when stopping")
+    parser.add_argument('--quiet', action='store_true', help="Don't log every request")
+    parser.add_argument('--db', default='p2p.db', help="SQLite database file")
+    parser.add_argument('--node-url', help="Run as a cluster node, reached by the others at this URL")
+    parser.add_argument('--join', metavar='URL', help="Join the cluster of the node at URL")
+    parser.add_argument('--cluster-secret', default=os.environ.get(SECRET_ENV),
+                        help=f"Shared by all nodes of a cluster (default: ${SECRET_ENV})")
+    # Passed by the supervisor to the workers it starts
+    parser.add_argument('--worker-fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--metrics-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if (args.worker_fd is None) != (args.metrics_dir is None):
+        parser.error("--worker-fd and --metrics-dir are only used together, by the supervisor")
+    if args.node_url and not args.cluster_secret:
+        parser.error(f"a cluster node needs --cluster-secret or ${SECRET_ENV}")
+
+    if args.worker_fd is not None:
+        run_worker(args)
+    else:
+        Supervisor(args).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,206 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
 import sqlite3
 import threading
 import time
 from datetime import datetime, timedelta
+from functools import partial
+
+import requests
+
+from cluster import FORWARDED_HEADER, REFRESH_INTERVAL
+from liveness import LivenessRegistry
+from metrics import Registry
+from tracker_db import TrackerDB
+
+HEARTBEAT_TTL = 60  # Seconds without a heartbeat before a peer counts as gone
+CLEANUP_BATCH_SIZE = 500  # Peers expired per write transaction, adapted as it runs
+CLEANUP_LOCK_BUDGET = 0.05  # Seconds one cleanup transaction may hold the write lock
+CLEANUP_MIN_INTERVAL = 1
+CLEANUP_MAX_INTERVAL = 30
+REBALANCE_INTERVAL = 10  # Seconds between checks for rows another cluster node now owns
+REBALANCE_SETTLE = 30  # Seconds the membership must be unchanged before checks stop
+HANDOFF_BATCH = 1000  # Rows sent to another node per request when rebalancing
+NODE_EXHAUSTED = 'done'  # Cluster cursor position of a node with no more matches
+PASSWORD_SCHEME = 'pbkdf2_sha256'
+PASSWORD_ITERATIONS = 200000
 
 app = Flask(__name__)
+db = TrackerDB('p2p.db')
+liveness = LivenessRegistry(ttl=HEARTBEAT_TTL)
+fts_enabled = False  # Set by init_db when SQLite has FTS5
+MAX_PAGE_SIZE = 5000
+
+metrics = Registry()
+REQUESTS = metrics.counter('tracker_requests_total', 'HTTP requests handled',
+                           ('route', 'method', 'status'))
+REQUEST_SECONDS = metrics.histogram('tracker_request_duration_seconds',
+                                    'Time to handle an HTTP request', ('route', 'method'))
+in_flight = 0
+in_flight_lock = threading.Lock()
+metrics.gauge('tracker_requests_in_flight', 'HTTP requests being handled', lambda: in_flight)
+LOCK_WAIT_SECONDS = metrics.histogram('tracker_sqlite_lock_wait_seconds',
+                                      'Time spent waiting for the SQLite write lock', ('site',))
+db.on_lock_wait = lambda site, seconds: LOCK_WAIT_SECONDS.observe(seconds, site)
+metrics.gauge('tracker_db_connections', 'Pooled SQLite connections', lambda: dict(
+    zip([('open',), ('idle',)], db.stats())), ('state',))
+# Every worker process converges on the same view of the peers, so don't add them up
+metrics.gauge('tracker_peers', 'Peers by heartbeat state', lambda: dict(
+    zip([('live',), ('expired',)], liveness.counts())), ('state',), combine=max)
+CLEANUP_SECONDS = metrics.histogram('tracker_cleanup_duration_seconds',
+                                    'Time taken by one pass of the inactive peer cleanup')
+CLEANUP_BATCH_SECONDS = metrics.histogram('tracker_cleanup_batch_seconds',
+                                          'Time one cleanup transaction held the write lock')
+CLEANUP_RUNS = metrics.counter('tracker_cleanup_runs_total', 'Cleanup passes', ('result',))
+PEERS_EXPIRED = metrics.counter('tracker_peers_expired_total',
+                                'Peers removed for missing heartbeats')
+FLUSH_SECONDS = metrics.histogram('tracker_heartbeat_flush_duration_seconds',
+                                  'Time to write buffered heartbeats to the database')
+HEARTBEATS_FLUSHED = metrics.counter('tracker_heartbeats_flushed_total',
+                                     'Heartbeats written to the database')
+CLUSTER_CALLS = metrics.counter('tracker_cluster_calls_total', 'Requests to other cluster nodes',
+                                ('site', 'result'))
+CLUSTER_CALL_SECONDS = metrics.histogram('tracker_cluster_call_seconds',
+                                         'Time taken by requests to other cluster nodes', ('site',))
+metrics_snapshots = None  # A metrics.SnapshotDir when running as one of several processes
+cluster = None  # A cluster.Cluster when running as one node of several
+
+
+def record_flush(count, seconds):
+    if count:
+        FLUSH_SECONDS.observe(seconds)
+        HEARTBEATS_FLUSHED.inc(amount=count)
+
+
+def record_cluster_call(site, seconds, ok):
+    CLUSTER_CALL_SECONDS.observe(seconds, site)
+    CLUSTER_CALLS.inc(site, 'ok' if ok else 'error')
+
+
+@app.before_request
+def start_request_timer():
+    global in_flight
+    g.request_started = time.perf_counter()
+    with in_flight_lock:
+        in_flight += 1
+
+
+@app.after_request
+def record_request(response):
+    global in_flight
+    started = g.pop('request_started', None)
+    if started is not None:
+        with in_flight_lock:
+            in_flight -= 1
+        # The rule, not the path, so /manifest/<digest> is one series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method)
+        REQUESTS.inc(route, request.method, str(response.status_code))
+    return response
+
+
+@app.before_request
+def check_cluster_request():
+    if request.path.startswith('/cluster/'):
+        if cluster is None:
+            return jsonify({"message": "Not running as a cluster node"}), 404
+        if not cluster.authorized(request.headers):
+            return jsonify({"message": "Wrong cluster secret"}), 403
+
+
+def forward_to_owner(key):
+    """In a cluster, hand the current request to the node owning key.
+
+    Returns that node's response, or None when this node handles the
+    request itself: it owns key, there is no cluster, or the request was
+    already forwarded (so nodes that briefly disagree on the ring can't
+    pass it back and forth).
+    """
+    if cluster is None or request.headers.get(FORWARDED_HEADER):
+        return None
+    return forward_to(cluster.ring.owner(key))
+
+
+def forward_to_home(username):
+    """Like forward_to_owner, for requests only the node holding username's
+    password can answer.  That is the node it registered with, which the
+    ring may since have given the username to another node; an account
+    not copied here yet is looked for on the username's owner."""
+    if cluster is None or request.headers.get(FORWARDED_HEADER):
+        return None
+    with db.connection() as conn:
+        row = conn.execute('SELECT home FROM peers WHERE username = ?', (username,)).fetchone()
+    if row is None:
+        return forward_to(cluster.ring.owner(username))
+    return forward_to(row[0]) if row[0] else None
+
+
+def forward_to(node):
+    """Hand the current request to node, returning its response; None if node is this one"""
+    if node == cluster.url:
+        return None
+    try:
+        response = cluster.call(node, request.method, request.path, site=request.url_rule.rule,
+                                params=request.args, json=request.get_json(silent=True),
+                                headers={FORWARDED_HEADER: cluster.url})
+    except requests.RequestException as e:
+        return jsonify({"message": f"Tracker node {node} is unavailable: {str(e)}"}), 503
+    return app.response_class(response.content, status=response.status_code,
+                              content_type=response.headers.get('Content-Type'))
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    body = metrics_snapshots.render() if metrics_snapshots else metrics.render()
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+def init_fts(c):
+    """Create the files_fts filename index and the triggers keeping it in sync"""
+    global fts_enabled
+    try:
+        c.execute("SELECT 1 FROM sqlite_master WHERE name = 'files_fts'")
+        exists = c.fetchone() is not None
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS files_fts
+                    USING fts5(filename, content='files', content_rowid='rowid',
+                               prefix='2 3')''')
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 unavailable, filename search will scan: {str(e)}")
+        fts_enabled = False
+        return
+
+    c.execute('''CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+                    INSERT INTO files_fts(rowid, filename) VALUES (new.rowid, new.filename);
+                END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+                    INSERT INTO files_fts(files_fts, rowid, filename)
+                    VALUES ('delete', old.rowid, old.filename);
+                END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS files_fts_update AFTER UPDATE OF filename ON files BEGIN
+                    INSERT INTO files_fts(files_fts, rowid, filename)
+                    VALUES ('delete', old.rowid, old.filename);
+                    INSERT INTO files_fts(rowid, filename) VALUES (new.rowid, new.filename);
+                END''')
+    if not exists:
+        # Index whatever was shared before the index existed
+        c.execute("INSERT INTO files_fts(files_fts) VALUES ('rebuild')")
+    fts_enabled = True
 
 def init_db():
-    conn = sqlite3.connect('p2p.db')
+    """Create or upgrade the schema, and load peers' heartbeats.
+
+    Safe to run from several processes at once: it all happens in one
+    write transaction, so checks like "is this column missing?" can't be
+    raced by another process doing the same upgrade.
+    """
+    conn = db.acquire()
     c = conn.cursor()
-    
+    db.begin_write(conn, 'init_db')
+
     c.execute('''CREATE TABLE IF NOT EXISTS peers
                 (username TEXT PRIMARY KEY, password TEXT, ip TEXT, port INTEGER,
                 last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -20,85 +211,210 @@ def init_db():
                 shared_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY(username) REFERENCES peers(username))''')
     
+    c.execute('''CREATE TABLE IF NOT EXISTS manifests
+                (digest TEXT PRIMARY KEY, size INTEGER, piece_size INTEGER, pieces TEXT)''')
+
+    c.execute('CREATE TABLE IF NOT EXISTS catalog_state (version INTEGER)')
+    c.execute('INSERT INTO catalog_state SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM catalog_state)')
+
+    # Databases created before manifests existed lack the content columns
+    columns = [row[1] for row in c.execute('PRAGMA table_info(peers)')]
+    if 'share_version' not in columns:
+        c.execute('ALTER TABLE peers ADD COLUMN share_version INTEGER DEFAULT 0')
+    if 'home' not in columns:
+        # Cluster node holding the password of an account copied from it; NULL when this one
+        c.execute('ALTER TABLE peers ADD COLUMN home TEXT')
+
+    columns = [row[1] for row in c.execute('PRAGMA table_info(files)')]
+    if 'digest' not in columns:
+        c.execute('ALTER TABLE files ADD COLUMN digest TEXT')
+    if 'size' not in columns:
+        c.execute('ALTER TABLE files ADD COLUMN size INTEGER')
+
     c.execute('CREATE INDEX IF NOT EXISTS idx_filename ON files(filename)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_username ON files(username)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_digest ON files(digest)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_last_heartbeat ON peers(last_heartbeat)')
+    init_fts(c)
+    if cluster is not None:
+        cluster.init(c)
     
     conn.commit()
-    conn.close()
+    liveness.load(c.execute('SELECT username, last_heartbeat FROM peers'))
+    if cluster is not None:
+        cluster.refresh(conn)
+    db.release(conn)
+
+def hash_password(password):
+    """Salted hash of a password, as stored in peers.password"""
+    salt = os.urandom(16).hex()
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(),
+                                 PASSWORD_ITERATIONS).hex()
+    return f"{PASSWORD_SCHEME}${PASSWORD_ITERATIONS}${salt}${digest}"
+
+def is_password_hash(stored):
+    return stored.startswith(PASSWORD_SCHEME + '$')
+
+def check_password(stored, password):
+    """Whether password matches stored, a hash or a password kept from before hashing"""
+    if stored is None:
+        return False
+    if not is_password_hash(stored):
+        return hmac.compare_digest(stored.encode(), password.encode())
+    _, iterations, salt, digest = stored.split('$')
+    candidate = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(),
+                                    int(iterations)).hex()
+    return hmac.compare_digest(candidate, digest)
 
 @app.route('/register', methods=['POST'])
 def register():
     data = request.json
     if not all(key in data for key in ['username', 'password', 'ip', 'port']):
         return jsonify({"message": "Missing required fields!"}), 400
+    # The node owning the username decides whether it is taken
+    forwarded = forward_to_owner(data['username'])
+    if forwarded is not None:
+        return forwarded
     
-    conn = sqlite3.connect('p2p.db')
+    # Hashing is slow on purpose, so not while holding the write lock
+    password = hash_password(data['password'])
+    conn = db.acquire()
     c = conn.cursor()
     try:
+        db.begin_write(conn, 'register')
         c.execute('INSERT INTO peers (username, password, ip, port) VALUES (?, ?, ?, ?)',
-                 (data['username'], data['password'], data['ip'], data['port']))
+                 (data['username'], password, data['ip'], data['port']))
         conn.commit()
+        # A new peer starts out live, as its last_heartbeat default says
+        liveness.beat(data['username'], data['ip'], data['port'])
+        if cluster is not None:
+            copy_peer_to_cluster(data)
         return jsonify({"message": "Registration successful!"})
     except sqlite3.IntegrityError:
         return jsonify({"message": "Username already exists!"}), 400
     finally:
-        conn.close()
+        db.release(conn)
 
 @app.route('/login', methods=['POST'])
 def login():
     data = request.json
     if not all(key in data for key in ['username', 'password']):
         return jsonify({"message": "Missing credentials!"}), 400
+    # Only the account's home node has its password
+    forwarded = forward_to_home(data['username'])
+    if forwarded is not None:
+        return forwarded
 
-    conn = sqlite3.connect('p2p.db')
+    conn = db.acquire()
     c = conn.cursor()
     try:
-        c.execute('''SELECT username, ip, port FROM peers 
-                    WHERE username = ? AND password = ?''', 
-                    (data['username'], data['password']))
+        c.execute('SELECT username, password FROM peers WHERE username = ?',
+                  (data['username'],))
         result = c.fetchone()
         
-        if result:
+        if result and check_password(result[1], data['password']):
+            # A password stored before hashing is replaced by its hash, made
+            # before taking the write lock
+            upgraded = None if is_password_hash(result[1]) else hash_password(data['password'])
             # Update last_seen timestamp
-            c.execute('''UPDATE peers SET last_seen = ?, ip = ?, port = ? 
+            db.begin_write(conn, 'login')
+            c.execute('''UPDATE peers SET last_seen = ?, ip = ?, port = ?,
+                            password = COALESCE(?, password)
                         WHERE username = ?''',
-                     (datetime.now(), data['ip'], data['port'], data['username']))
+                     (datetime.now(), data['ip'], data['port'], upgraded, data['username']))
             conn.commit()
             return jsonify({"message": "Login successful!", "username": result[0]})
         return jsonify({"message": "Invalid credentials!"}), 401
     finally:
-        conn.close()
+        db.release(conn)
     
+def manifest_is_valid(manifest):
+    """Check a manifest's digest really covers its size and piece hashes"""
+    try:
+        size, piece_size, pieces = manifest['size'], manifest['piece_size'], manifest['pieces']
+        if len(pieces) != (size + piece_size - 1) // piece_size:
+            return False
+        h = hashlib.sha256(f"{size}:{piece_size}:".encode())
+        for piece in pieces:
+            h.update(bytes.fromhex(piece))
+        return h.hexdigest() == manifest['digest']
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return False
+
+def expire_inactive_peers(conn, threshold_time, batch_size=CLEANUP_BATCH_SIZE,
+                          lock_budget=CLEANUP_LOCK_BUDGET):
+    """Delete peers (and their files) whose last heartbeat is before threshold_time.
+
+    Works through them in batches, one short write transaction each, sizing
+    the batches so a transaction stays within lock_budget seconds and
+    pausing between them so other writers get the lock.  Returns the
+    number of peers removed.
+    """
+    c = conn.cursor()
+    removed = 0
+    while True:
+        db.begin_write(conn, 'cleanup')
+        started = time.monotonic()
+        c.execute('''SELECT username FROM peers WHERE last_heartbeat < ?
+                    LIMIT ?''', (threshold_time, batch_size))
+        expired = [row[0] for row in c.fetchall()]
+        usernames = json.dumps(expired)
+        count = len(expired)
+        if count:
+            c.execute('''DELETE FROM files
+                        WHERE username IN (SELECT value FROM json_each(?))''', (usernames,))
+            c.execute('''DELETE FROM peers
+                        WHERE username IN (SELECT value FROM json_each(?))''', (usernames,))
+            bump_catalog_version(c)
+        conn.commit()
+        elapsed = time.monotonic() - started
+        CLEANUP_BATCH_SECONDS.observe(elapsed)
+        removed += count
+        if count < batch_size:
+            return removed
+
+        if elapsed > lock_budget:
+            batch_size = max(1, batch_size // 2)
+        elif elapsed < lock_budget / 2:
+            batch_size *= 2
+        time.sleep(elapsed)  # Leave the lock free at least as long as we held it
+
+def next_cleanup_delay(c):
+    """Seconds until the longest-silent peer expires, within the cleanup bounds"""
+    c.execute('SELECT MIN(last_heartbeat) FROM peers')
+    oldest = c.fetchone()[0]
+    if oldest is None:
+        return CLEANUP_MAX_INTERVAL
+    if isinstance(oldest, str):
+        oldest = datetime.fromisoformat(oldest)
+    delay = (oldest + timedelta(seconds=HEARTBEAT_TTL) - datetime.now()).total_seconds()
+    return min(max(delay, CLEANUP_MIN_INTERVAL), CLEANUP_MAX_INTERVAL)
+
 def cleanup_inactive_peers():
-    """Remove files of inactive peers"""
+    """Remove inactive peers and their files"""
     while True:
+        delay = CLEANUP_MAX_INTERVAL
+        conn = db.acquire()
+        started = time.perf_counter()
         try:
-            conn = sqlite3.connect('p2p.db')
-            c = conn.cursor()
-            
-            threshold_time = datetime.now() - timedelta(seconds=60)  # 60 second grace period
-            
-            # Get inactive peers
-            c.execute('''SELECT username FROM peers 
-                        WHERE last_heartbeat < ?''', (threshold_time,))
-            inactive_peers = c.fetchall()
-            
-            for peer in inactive_peers:
-                username = peer[0]
-                print(f"Removing files for inactive peer: {username}")
-                
-                # Remove their files
-                c.execute('DELETE FROM files WHERE username = ?', (username,))
-                
-                # Optionally, remove the peer (uncomment if you want to remove peer entry)
-                c.execute('DELETE FROM peers WHERE username = ?', (username,))
-            
-            conn.commit()
+            # Persist the latest heartbeats before judging peers by them
+            record_flush(liveness.flush(conn, lambda conn: db.begin_write(conn, 'heartbeat_flush')),
+                         time.perf_counter() - started)
+            threshold_time = datetime.now() - timedelta(seconds=HEARTBEAT_TTL)
+            removed = expire_inactive_peers(conn, threshold_time)
+            if removed:
+                print(f"Removed {removed} inactive peer(s) and their files")
+                PEERS_EXPIRED.inc(amount=removed)
+            liveness.forget_expired(threshold_time)
+            delay = next_cleanup_delay(conn.cursor())
+            CLEANUP_RUNS.inc('ok')
         except Exception as e:
             print(f"Cleanup error: {str(e)}")
+            CLEANUP_RUNS.inc('error')
         finally:
-            conn.close()
-            time.sleep(30)  # Run cleanup every 30 seconds
+            db.release(conn)
+            CLEANUP_SECONDS.observe(time.perf_counter() - started)
+        time.sleep(delay)
 
 @app.route('/heartbeat', methods=['POST'])
 def heartbeat():
@@ -106,128 +422,734 @@ def heartbeat():
     if not all(key in data for key in ['username', 'ip', 'port']):
         return jsonify({"message": "Missing required fields!"}), 400
     
-    conn = sqlite3.connect('p2p.db')
-    c = conn.cursor()
-    try:
-        c.execute('''UPDATE peers 
-                    SET last_heartbeat = ?, ip = ?, port = ?
-                    WHERE username = ?''',
-                 (datetime.now(), data['ip'], data['port'], data['username']))
-        conn.commit()
-        return jsonify({"message": "Heartbeat received"})
-    except Exception as e:
-        return jsonify({"message": f"Error processing heartbeat: {str(e)}"}), 500
-    finally:
-        conn.close()
+    # Peers we have heard from are known without a query; only other names are looked up
+    if not liveness.knows(data['username']):
+        with db.connection() as conn:
+            known = conn.execute('SELECT 1 FROM peers WHERE username = ?',
+                                 (data['username'],)).fetchone()
+        if known is None:
+            return jsonify({"message": "Unknown peer!"}), 404
+
+    # Recorded in memory only; the flusher writes heartbeats back in batches
+    when = datetime.now()
+    liveness.beat(data['username'], data['ip'], data['port'], when)
+    if cluster is not None:
+        cluster.queue_beat(data['username'], data['ip'], data['port'], when)
+    return jsonify({"message": "Heartbeat received"})
 
 @app.route('/disconnect', methods=['POST'])
 def disconnect():
     data = request.json
     if 'username' not in data:
         return jsonify({"message": "Missing username!"}), 400
+    forwarded = forward_to_owner(data['username'])
+    if forwarded is not None:
+        return forwarded
     
-    conn = sqlite3.connect('p2p.db')
+    conn = db.acquire()
     c = conn.cursor()
     try:
+        db.begin_write(conn, 'disconnect')
+        if cluster is not None:
+            bump_share_version(c, data['username'])
+            conn.commit()
+            share_across_cluster(data, [], replace=True)
+            return jsonify({"message": "Disconnected successfully"})
         # Remove their files
         c.execute('DELETE FROM files WHERE username = ?', (data['username'],))
+        bump_share_version(c, data['username'])
+        bump_catalog_version(c)
         conn.commit()
         return jsonify({"message": "Disconnected successfully"})
     except Exception as e:
         return jsonify({"message": f"Error processing disconnect: {str(e)}"}), 500
     finally:
-        conn.close()
+        db.release(conn)
+
+def fts_match_expression(text):
+    """Turn free text into an FTS5 query: every word, as a prefix, must match"""
+    words = re.findall(r'[^\W_]+', text)
+    return ' AND '.join(f'"{word}"*' for word in words)
+
+def build_files_query(filename_query, username_query, digest_query, like=False,
+                      after=None, limit=None):
+    """SQL and parameters listing live files matching the given filters.
+
+    Filename searches go through the files_fts index (tokenized, prefix
+    matched, best matches first) unless like is set, FTS5 is unavailable or
+    the query has no words in it, in which case the old substring LIKE
+    scan is used.
+
+    Rows carry two extra trailing columns, the sort key (rank, rowid), so
+    callers can page with after=<sort key of the last row> and limit.
+    """
+    match = fts_match_expression(filename_query) if filename_query and not like else ''
+    use_fts = bool(match) and fts_enabled
+
+    query = '''SELECT files.filename, files.username, files.peer_ip,
+                      files.peer_port, files.shared_time, files.digest, files.size'''
+    if use_fts:
+        query += ''', files_fts.rank, files.rowid
+               FROM files_fts
+               JOIN files ON files.rowid = files_fts.rowid
+               JOIN peers ON files.username = peers.username
+               WHERE files_fts MATCH ?'''
+        params = [match]
+    else:
+        query += ''', NULL, files.rowid
+               FROM files 
+               JOIN peers ON files.username = peers.username
+               WHERE 1'''
+        params = []
+
+        if filename_query:
+            query += " AND files.filename LIKE ?"
+            params.append(f"%{filename_query}%")
+
+    # Hide files of peers whose heartbeats lapsed but haven't been cleaned up yet
+    expired = liveness.expired()
+    if expired:
+        query += " AND files.username NOT IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(expired))
+
+    if digest_query:
+        query += " AND files.digest = ?"
+        params.append(digest_query)
+    
+    if username_query:
+        query += " AND files.username LIKE ?"
+        params.append(f"%{username_query}%")
+
+    if after is not None:
+        rank, rowid = after
+        if use_fts:
+            query += " AND (files_fts.rank > ? OR (files_fts.rank = ? AND files.rowid > ?))"
+            params.extend([rank, rank, rowid])
+        else:
+            query += " AND files.rowid > ?"
+            params.append(rowid)
+
+    query += " ORDER BY files_fts.rank, files.rowid" if use_fts else " ORDER BY files.rowid"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return query, tuple(params)
+
+def encode_cursor(sort_key):
+    return base64.urlsafe_b64encode(json.dumps(sort_key).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        rank, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return rank, int(rowid)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+def bump_catalog_version(c):
+    """Record that the file catalog changed, invalidating clients' ETags"""
+    c.execute('UPDATE catalog_state SET version = version + 1')
+
+def catalog_etag(c):
+    """ETag for the current live catalog.
+
+    Combines the catalog version with the liveness fingerprint, since peers
+    dropping out of the heartbeat window change /files without any write.
+    """
+    c.execute('SELECT version FROM catalog_state')
+    version = c.fetchone()[0]
+    return f"{version}-{liveness.fingerprint()}"
+
+def file_filters():
+    """(filename, username, digest, like) of a /files request, for build_files_query"""
+    return (request.args.get('filename', default='', type=str),
+            request.args.get('username', default='', type=str),
+            request.args.get('digest', default='', type=str),
+            request.args.get('match', default='', type=str) == 'substring')
+
+def page_limit():
+    limit = request.args.get('limit', default=None, type=int)
+    return None if limit is None else max(1, min(limit, MAX_PAGE_SIZE))
+
+def listing_etag(version):
+    """ETag for a /files response: the catalog version and the query it answers.
+
+    Different searches over the same catalog are different responses, so
+    a client's ETag for one must not revalidate another.
+    """
+    key = json.dumps([version, *file_filters(), page_limit(),
+                      request.args.get('cursor', default='', type=str)])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def list_files(c):
+    """Shared body of /files and /search_files.
+
+    Supports ?limit= and ?cursor= keyset pagination and answers
+    If-None-Match with 304 when the catalog hasn't changed.  Without a
+    limit every matching row is returned, as before.
+    """
+    cursor = request.args.get('cursor', default='', type=str)
+
+    version = catalog_etag(c)
+    etag = listing_etag(version)
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    limit = page_limit()
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    c.execute(*build_files_query(*file_filters(), after, limit))
+    rows = c.fetchall()
+    next_cursor = None
+    if limit is not None and len(rows) == limit:
+        next_cursor = encode_cursor(rows[-1][-2:])
+
+    response = jsonify({"files": [row[:-2] for row in rows], "next_cursor": next_cursor,
+                        "version": version})
+    response.set_etag(etag)
+    return response
+
+def query_local_files(filters, after, limit):
+    """(catalog ETag, matching rows with their sort keys) from this node's shard"""
+    with db.connection() as conn:
+        c = conn.cursor()
+        etag = catalog_etag(c)
+        c.execute(*build_files_query(*filters, after, limit))
+        return etag, [list(row) for row in c.fetchall()]
+
+def query_node_files(node, filters, after, limit):
+    """query_local_files on another cluster node"""
+    filename_query, username_query, digest_query, like = filters
+    params = {'filename': filename_query, 'username': username_query, 'digest': digest_query}
+    if like:
+        params['match'] = 'substring'
+    if limit is not None:
+        params['limit'] = limit
+    if after is not None:
+        params['cursor'] = encode_cursor(after)
+    response = cluster.call(node, 'GET', '/cluster/files', params=params)
+    response.raise_for_status()
+    body = response.json()
+    return body['version'], body['files']
+
+def decode_cluster_cursor(cursor):
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {node: position if position == NODE_EXHAUSTED else (position[0], int(position[1]))
+                for node, position in positions.items()}
+    except (ValueError, TypeError, AttributeError, IndexError):
+        raise ValueError("Invalid cursor")
+
+def list_cluster_files():
+    """/files and /search_files on a cluster node: every node's matches, merged.
+
+    Each node's rows come in its own order (best FTS rank first), and
+    the cursor keeps a position per node.  Nodes that can't be reached
+    are listed under "unavailable"; such a partial answer has no ETag, so
+    it isn't cached in place of the whole catalog.
+    """
+    filters = file_filters()
+    limit = page_limit()
+    cursor = request.args.get('cursor', default='', type=str)
+    try:
+        positions = decode_cluster_cursor(cursor) if cursor else {}
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    calls = {}
+    for node in cluster.members:
+        after = positions.get(node)
+        if after == NODE_EXHAUSTED:
+            continue
+        query = query_local_files if node == cluster.url else partial(query_node_files, node)
+        calls[node] = partial(query, filters, after, limit)
+    results = cluster.gather(calls)
+    found = {node: result for node, result in results.items()
+             if not isinstance(result, Exception)}
+    unavailable = sorted(results.keys() - found.keys())
+
+    version = etag = None
+    if not unavailable:
+        version = hashlib.sha1(json.dumps(sorted((node, version)
+                                                 for node, (version, _) in found.items()))
+                               .encode()).hexdigest()[:16]
+        etag = listing_etag(version)
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+    entries = sorted(((node, row) for node, (_, rows) in found.items() for row in rows),
+                     key=lambda entry: (entry[1][-2] or 0, entry[1][-1], entry[0]))
+    next_cursor = None
+    if limit is not None and len(entries) >= limit:
+        entries = entries[:limit]
+        taken = {node: row[-2:] for node, row in entries}
+        for node, (_, rows) in found.items():
+            if len(rows) < limit and (not rows or taken.get(node) == rows[-1][-2:]):
+                positions[node] = NODE_EXHAUSTED
+            elif node in taken:
+                positions[node] = taken[node]
+        if any(positions.get(node) != NODE_EXHAUSTED for node in cluster.members):
+            next_cursor = encode_cursor(positions)
+
+    body = {"files": [row[:-2] for _, row in entries], "next_cursor": next_cursor,
+            "version": version}
+    if unavailable:
+        body['unavailable'] = unavailable
+    response = jsonify(body)
+    if etag:
+        response.set_etag(etag)
+    return response
 
 @app.route('/files', methods=['GET'])
 def get_files():
-    filename_query = request.args.get('filename', default='', type=str)
-    username_query = request.args.get('username', default='', type=str)
-    
-    conn = sqlite3.connect('p2p.db')
+    if cluster is not None:
+        return list_cluster_files()
+    conn = db.acquire()
     c = conn.cursor()
     try:
-        # Only return files from peers that have sent a heartbeat in the last minute
-        threshold_time = datetime.now() - timedelta(seconds=60)
-        query = '''SELECT files.filename, files.username, files.peer_ip,
-                          files.peer_port, files.shared_time
-                   FROM files 
-                   JOIN peers ON files.username = peers.username
-                   WHERE peers.last_heartbeat >= ?'''
-        params = [threshold_time]
-        
-        if filename_query:
-            query += " AND files.filename LIKE ?"
-            params.append(f"%{filename_query}%")
-        
-        if username_query:
-            query += " AND files.username LIKE ?"
-            params.append(f"%{username_query}%")
-        
-        c.execute(query, tuple(params))
-        files = c.fetchall()
-        return jsonify({"files": files})
+        return list_files(c)
     finally:
-        conn.close()
+        db.release(conn)
 
 
 @app.route('/search_files', methods=['GET'])
 def search_files():
     # If using a separate search endpoint
-    filename_query = request.args.get('filename', default='', type=str)
-    username_query = request.args.get('username', default='', type=str)
-    
-    conn = sqlite3.connect('p2p.db')
+    if cluster is not None:
+        return list_cluster_files()
+    conn = db.acquire()
     c = conn.cursor()
     try:
-        # Only return files from peers that have sent a heartbeat in the last minute
-        threshold_time = datetime.now() - timedelta(seconds=60)
-        query = '''SELECT files.filename, files.username, files.peer_ip,
-                          files.peer_port, files.shared_time
-                   FROM files 
-                   JOIN peers ON files.username = peers.username
-                   WHERE peers.last_heartbeat >= ?'''
-        params = [threshold_time]
-        
-        if filename_query:
-            query += " AND files.filename LIKE ?"
-            params.append(f"%{filename_query}%")
-        
-        if username_query:
-            query += " AND files.username LIKE ?"
-            params.append(f"%{username_query}%")
-        
-        c.execute(query, tuple(params))
-        files = c.fetchall()
-        return jsonify({"files": files})
+        return list_files(c)
     except Exception as e:
         return jsonify({"message": f"Error searching files: {str(e)}"}), 500
     finally:
-        conn.close()
+        db.release(conn)
+
+
+def check_manifests(data, filenames):
+    manifests = data.get('manifests') or {}
+    for filename in filenames:
+        manifest = manifests.get(filename)
+        if manifest is not None and not manifest_is_valid(manifest):
+            raise ValueError(f"Invalid manifest for {filename}")
+
+def store_files(c, username, peer_ip, peer_port, files, manifests):
+    """Bulk-insert (filename, digest, size) files shared by username, and manifests"""
+    c.executemany('''INSERT OR IGNORE INTO manifests (digest, size, piece_size, pieces)
+                    VALUES (?, ?, ?, ?)''',
+                  [(m['digest'], m['size'], m['piece_size'], json.dumps(m['pieces']))
+                   for m in manifests])
+    c.executemany('''INSERT INTO files (filename, username, peer_ip, peer_port, digest, size)
+                    VALUES (?, ?, ?, ?, ?, ?)''',
+                  [(filename, username, peer_ip, peer_port, digest, size)
+                   for filename, digest, size in files])
+
+def shared_files(data, filenames):
+    """The (filename, digest, size) rows and the manifests of filenames in a share request"""
+    manifests = data.get('manifests') or {}
+    found = [manifests.get(filename) for filename in filenames]
+    return ([(filename, m['digest'] if m else None, m['size'] if m else None)
+             for filename, m in zip(filenames, found)],
+            [m for m in found if m])
+
+def insert_shared_files(c, data, filenames):
+    """Bulk-insert filenames shared by data['username'] with their manifests"""
+    check_manifests(data, filenames)
+    store_files(c, data['username'], data['peer_ip'], data['peer_port'],
+                *shared_files(data, filenames))
 
+def bump_share_version(c, username):
+    """Advance a peer's share version, returning the new one (None if unknown peer)"""
+    c.execute('UPDATE peers SET share_version = share_version + 1 WHERE username = ?', (username,))
+    c.execute('SELECT share_version FROM peers WHERE username = ?', (username,))
+    result = c.fetchone()
+    return result[0] if result else None
+
+def claim_share_version(c, username, base_version):
+    """Advance a peer's share version only if it is still base_version.
+
+    Returns the new version, or None if the peer is unknown or another
+    share got there first.  Checking and advancing in one statement means
+    two deltas can never both apply on top of the same base.
+    """
+    c.execute('''UPDATE peers SET share_version = share_version + 1
+                WHERE username = ? AND share_version = ?''', (username, base_version))
+    return base_version + 1 if c.rowcount == 1 else None
 
 @app.route('/share_files', methods=['POST'])
 def share_files():
+    """Replace everything a peer shares (initial sync)"""
     data = request.json
     if not all(key in data for key in ['username', 'filename', 'peer_ip', 'peer_port']):
         return jsonify({"message": "Missing required fields!"}), 400
+    # The node owning the username keeps its share version
+    forwarded = forward_to_owner(data['username'])
+    if forwarded is not None:
+        return forwarded
 
-    conn = sqlite3.connect('p2p.db')
+    conn = db.acquire()
     c = conn.cursor()
     try:
+        db.begin_write(conn, 'share_files')
+        if cluster is not None:
+            check_manifests(data, data['filename'])
+            version = bump_share_version(c, data['username'])
+            conn.commit()
+            share_across_cluster(data, data['filename'], replace=True)
+            return jsonify({"message": "Files shared successfully!", "version": version})
         # Clear previous files shared by this peer
         c.execute('DELETE FROM files WHERE username = ?', (data['username'],))
         
-        # Add new files
-        for filename in data['filename']:
-            c.execute('''INSERT INTO files (filename, username, peer_ip, peer_port)
-                        VALUES (?, ?, ?, ?)''',
-                     (filename, data['username'], data['peer_ip'], data['peer_port']))
+        # Add new files, with their content manifests when the peer sent them
+        insert_shared_files(c, data, data['filename'])
+        version = bump_share_version(c, data['username'])
+        bump_catalog_version(c)
+        conn.commit()
+        return jsonify({"message": "Files shared successfully!", "version": version})
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"message": f"Error sharing files: {str(e)}"}), 500
+    finally:
+        db.release(conn)
+
+@app.route('/share_files_delta', methods=['POST'])
+def share_files_delta():
+    """Apply added/removed filenames on top of the version the peer last synced"""
+    data = request.json
+    if not all(key in data for key in ['username', 'peer_ip', 'peer_port', 'base_version']):
+        return jsonify({"message": "Missing required fields!"}), 400
+    forwarded = forward_to_owner(data['username'])
+    if forwarded is not None:
+        return forwarded
+
+    conn = db.acquire()
+    c = conn.cursor()
+    try:
+        db.begin_write(conn, 'share_files_delta')
+        version = claim_share_version(c, data['username'], data['base_version'])
+        if version is None:
+            # The peer's idea of what we hold is stale; it must resend everything
+            c.execute('SELECT share_version FROM peers WHERE username = ?', (data['username'],))
+            result = c.fetchone()
+            return jsonify({"message": "Share version mismatch, full sync required",
+                            "version": result[0] if result else None}), 409
+
+        # Removals first so a changed file can be removed and re-added in one delta
+        removed = data.get('removed') or []
+        if cluster is not None:
+            check_manifests(data, data.get('added') or [])
+            conn.commit()
+            # If a node fails to apply its part, the peer's next delta gets a 409,
+            # since its base version was used up here, and it resends everything
+            share_across_cluster(data, data.get('added') or [], removed)
+            return jsonify({"message": "Files shared successfully!", "version": version})
+        c.executemany('DELETE FROM files WHERE username = ? AND filename = ?',
+                      [(data['username'], filename) for filename in removed])
+        insert_shared_files(c, data, data.get('added') or [])
+        bump_catalog_version(c)
         conn.commit()
-        return jsonify({"message": "Files shared successfully!"})
+        return jsonify({"message": "Files shared successfully!", "version": version})
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
     except Exception as e:
         return jsonify({"message": f"Error sharing files: {str(e)}"}), 500
     finally:
-        conn.close()
+        db.release(conn)
+
+@app.route('/manifest/<digest>', methods=['GET'])
+def get_manifest(digest):
+    forwarded = forward_to_owner(digest)
+    if forwarded is not None:
+        return forwarded
+    conn = db.acquire()
+    c = conn.cursor()
+    try:
+        c.execute('SELECT size, piece_size, pieces FROM manifests WHERE digest = ?', (digest,))
+        result = c.fetchone()
+        if not result:
+            return jsonify({"message": "Manifest not found!"}), 404
+        return jsonify({"digest": digest, "size": result[0], "piece_size": result[1],
+                        "pieces": json.loads(result[2])})
+    finally:
+        db.release(conn)
+
+# Cluster mode: see cluster.py
+
+def post_to_nodes(path, payloads, local=None):
+    """POST payloads[node] to path on each node, calling local(payload) for
+    this node instead.  Returns the nodes that failed."""
+    calls = {node: partial(local, payload) if node == cluster.url
+             else partial(cluster.call, node, 'POST', path, json=payload)
+             for node, payload in payloads.items()}
+    failed = []
+    for node, result in cluster.gather(calls).items():
+        if isinstance(result, Exception):
+            print(f"{path} on {node} failed: {str(result)}")
+            failed.append(node)
+        elif node != cluster.url and result.status_code != 200:
+            print(f"{path} on {node} failed with status {result.status_code}")
+            failed.append(node)
+    return failed
+
+def share_across_cluster(data, added, removed=(), replace=False):
+    """Apply a peer's share to the nodes owning the filenames and manifests in it.
+
+    With replace every node first drops all the peer's files, as a full
+    sync must clear whatever it shared before wherever that was.
+    """
+    files, manifests = shared_files(data, added)
+    files = cluster.ring.partition(files, key=lambda row: row[0])
+    removed = cluster.ring.partition(removed)
+    manifests = cluster.ring.partition({m['digest']: m for m in manifests}.values(),
+                                       key=lambda m: m['digest'])
+    payloads = {node: {'username': data['username'], 'peer_ip': data.get('peer_ip'),
+                       'peer_port': data.get('peer_port'), 'replace': replace,
+                       'files': files[node], 'removed': removed[node],
+                       'manifests': manifests[node]}
+                for node in cluster.ring.nodes
+                if replace or files[node] or removed[node] or manifests[node]}
+    failed = post_to_nodes('/cluster/share', payloads, apply_share)
+    if failed:
+        raise RuntimeError(f"not applied on {', '.join(failed)}")
+
+def apply_share(payload):
+    """Apply this node's part of a share sent by share_across_cluster"""
+    with db.connection() as conn:
+        c = conn.cursor()
+        db.begin_write(conn, 'cluster_share')
+        if payload['replace']:
+            c.execute('DELETE FROM files WHERE username = ?', (payload['username'],))
+        c.executemany('DELETE FROM files WHERE username = ? AND filename = ?',
+                      [(payload['username'], filename) for filename in payload['removed']])
+        store_files(c, payload['username'], payload['peer_ip'], payload['peer_port'],
+                    payload['files'], payload['manifests'])
+        bump_catalog_version(c)
+        conn.commit()
+
+def copy_peer_to_cluster(data):
+    """Give every other node the account just registered here, without its password"""
+    row = [data['username'], data['ip'], data['port'], datetime.now().isoformat(), 0,
+           cluster.url]
+    failed = cluster.post_all(cluster.others(), '/cluster/peers', {'peers': [row]})
+    if failed:
+        print(f"Registration of {data['username']} not copied to {', '.join(failed)}")
+
+def store_peers(rows):
+    """Take in (username, ip, port, last_heartbeat, share_version, home) accounts
+    from another node, keeping the share versions and liveness we have.
+
+    Accounts whose home is this node are already here, with their password.
+    """
+    rows = [(username, ip, port,
+             datetime.fromisoformat(last_heartbeat) if last_heartbeat else None, share_version,
+             home)
+            for username, ip, port, last_heartbeat, share_version, home in rows
+            if home != cluster.url]
+    with db.connection() as conn:
+        db.begin_write(conn, 'cluster_peers')
+        conn.executemany('''INSERT INTO peers (username, ip, port, last_heartbeat, share_version,
+                                               home)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                            ON CONFLICT(username) DO UPDATE SET ip = excluded.ip,
+                                port = excluded.port''', rows)
+        conn.commit()
+    liveness.merge((username, ip, port, last_heartbeat)
+                   for username, ip, port, last_heartbeat, _, _ in rows if last_heartbeat)
+
+def copy_peers(via):
+    response = cluster.call(via, 'GET', '/cluster/peers', timeout=60)
+    response.raise_for_status()
+    store_peers(response.json()['peers'])
+
+def join_cluster(via):
+    """Join the cluster that node via belongs to, and copy its peers"""
+    via = via.rstrip('/')
+    members = cluster.join(via)
+    with db.connection() as conn:
+        cluster.add_members(conn, members, lambda conn: db.begin_write(conn, 'cluster_members'))
+    copy_peers(via)
+    # Nodes that hadn't heard we joined yet didn't send us their new registrations
+    timer = threading.Timer(2 * REFRESH_INTERVAL, copy_peers, (via,))
+    timer.daemon = True
+    timer.start()
+    print(f"Joined the cluster of {', '.join(cluster.members)}")
+
+def hand_off(conn, rows, key, payload_key, delete):
+    """Send the rows this node doesn't own to their owners, then delete them here.
+
+    key(row) is the ring key of a row, payload_key what /cluster/handoff
+    calls them, and delete(c, rows) removes rows once their owner has
+    stored them.  Returns how many rows moved.
+    """
+    parts = cluster.ring.partition(rows, key=key)
+    parts.pop(cluster.url, None)
+    parts = {node: part for node, part in parts.items() if part}
+    if not parts:
+        return 0
+    # files rows start with their rowid, which means nothing to the owner
+    skip = 1 if payload_key == 'files' else 0
+    failed = post_to_nodes('/cluster/handoff', {
+        node: {payload_key: [row[skip:] for row in part]} for node, part in parts.items()})
+    done = [row for node, part in parts.items() if node not in failed for row in part]
+    if done:
+        c = conn.cursor()
+        db.begin_write(conn, 'cluster_handoff')
+        delete(c, done)
+        bump_catalog_version(c)
+        conn.commit()
+    return len(done)
+
+def delete_files(c, rows):
+    # Matching on more than the rowid, in case it was reused meanwhile
+    c.executemany('DELETE FROM files WHERE rowid = ? AND filename = ? AND username = ?',
+                  [row[:3] for row in rows])
+
+def delete_manifests(c, rows):
+    c.executemany('DELETE FROM manifests WHERE digest = ?', [row[:1] for row in rows])
+
+def hand_off_misplaced(conn):
+    """Move the files rows and manifests other nodes now own to them; returns rows moved"""
+    c = conn.cursor()
+    moved = 0
+    last = 0
+    while True:
+        c.execute('''SELECT rowid, filename, username, peer_ip, peer_port, shared_time, digest,
+                            size FROM files WHERE rowid > ? ORDER BY rowid LIMIT ?''',
+                  (last, HANDOFF_BATCH))
+        rows = c.fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        moved += hand_off(conn, rows, lambda row: row[1], 'files', delete_files)
+    last = ''
+    while True:
+        c.execute('''SELECT digest, size, piece_size, pieces FROM manifests
+                    WHERE digest > ? ORDER BY digest LIMIT ?''', (last, HANDOFF_BATCH))
+        rows = c.fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        moved += hand_off(conn, rows, lambda row: row[0], 'manifests', delete_manifests)
+    return moved
+
+def rebalance_catalog():
+    """Background loop moving rows to the nodes owning them after the membership changes.
+
+    Keeps checking until the membership has been stable for
+    REBALANCE_SETTLE seconds, since nodes that haven't noticed a change
+    yet still send writes by the old ring.
+    """
+    settled = None
+    while True:
+        try:
+            with db.connection() as conn:
+                cluster.refresh(conn)
+                if cluster.version != settled:
+                    moved = hand_off_misplaced(conn)
+                    if moved:
+                        print(f"Moved {moved} catalog row(s) to the nodes owning them")
+                    elif time.monotonic() - cluster.changed_at > REBALANCE_SETTLE:
+                        settled = cluster.version
+        except Exception as e:
+            print(f"Rebalance error: {str(e)}")
+        time.sleep(REBALANCE_INTERVAL)
+
+@app.route('/cluster/share', methods=['POST'])
+def cluster_share():
+    apply_share(request.json)
+    return jsonify({"message": "Share applied"})
+
+@app.route('/cluster/files', methods=['GET'])
+def cluster_files():
+    """This node's part of a cluster-wide /files, with the rows' sort keys"""
+    cursor = request.args.get('cursor', default='', type=str)
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    etag, rows = query_local_files(file_filters(), after, page_limit())
+    return jsonify({"files": rows, "version": etag})
+
+@app.route('/cluster/peers', methods=['GET'])
+def cluster_get_peers():
+    with db.connection() as conn:
+        # Passwords never leave their home node
+        rows = conn.execute('''SELECT username, ip, port, last_heartbeat, share_version,
+                                      COALESCE(home, ?) FROM peers''', (cluster.url,)).fetchall()
+    return jsonify({"peers": rows})
+
+@app.route('/cluster/peers', methods=['POST'])
+def cluster_add_peers():
+    store_peers(request.json['peers'])
+    return jsonify({"message": "Peers stored"})
+
+@app.route('/cluster/heartbeats', methods=['POST'])
+def cluster_heartbeats():
+    liveness.merge([(username, ip, port, datetime.fromisoformat(when))
+                    for username, ip, port, when in request.json['beats']])
+    return jsonify({"message": "Heartbeats received"})
+
+@app.route('/cluster/join', methods=['POST'])
+def cluster_join():
+    url = request.json['url'].rstrip('/')
+    with db.connection() as conn:
+        members = cluster.add_members(conn, [url],
+                                      lambda conn: db.begin_write(conn, 'cluster_members'))
+    members = members or cluster.members
+    # The new node takes the list from our answer
+    failed = cluster.post_all([node for node in cluster.others() if node != url],
+                              '/cluster/members', {'members': members})
+    print(f"{url} joined the cluster" +
+          (f", not yet known to {', '.join(failed)}" if failed else ""))
+    return jsonify({"members": members})
+
+@app.route('/cluster/members', methods=['POST'])
+def cluster_members():
+    received = request.json['members']
+    with db.connection() as conn:
+        members = cluster.add_members(conn, received,
+                                      lambda conn: db.begin_write(conn, 'cluster_members'))
+    if members is not None and set(members) != set(received):
+        # We know of nodes the sender didn't; make sure everyone hears of them
+        cluster.post_all(cluster.others(), '/cluster/members', {'members': members})
+    return jsonify({"members": cluster.members})
+
+@app.route('/cluster/handoff', methods=['POST'])
+def cluster_handoff():
+    """Store catalog rows another node found this one owns"""
+    data = request.json
+    with db.connection() as conn:
+        c = conn.cursor()
+        db.begin_write(conn, 'cluster_handoff')
+        c.executemany('''INSERT OR IGNORE INTO manifests (digest, size, piece_size, pieces)
+                        VALUES (?, ?, ?, ?)''', data.get('manifests') or [])
+        # A handoff whose reply was lost is sent again; rows stored the first time are skipped
+        c.executemany('''INSERT INTO files (filename, username, peer_ip, peer_port, shared_time,
+                                            digest, size)
+                        SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7
+                        WHERE NOT EXISTS (SELECT 1 FROM files
+                                          WHERE filename = ?1 AND username = ?2 AND peer_ip = ?3
+                                            AND peer_port = ?4 AND digest IS ?6)''',
+                      data.get('files') or [])
+        bump_catalog_version(c)
+        conn.commit()
+    return jsonify({"message": "Rows stored"})
+
+@app.route('/cluster/status', methods=['GET'])
+def cluster_status():
+    with db.connection() as conn:
+        rows = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                for table in ('peers', 'files', 'manifests')}
+    return jsonify({"node": cluster.url, "members": cluster.members,
+                    "membership_version": cluster.version, "rows": rows})
 
 if __name__ == '__main__':
     init_db()
@@ -235,5 +1157,7 @@ if __name__ == '__main__':
     # Start cleanup thread
     cleanup_thread = threading.Thread(target=cleanup_inactive_peers, daemon=True)
     cleanup_thread.start()
+    threading.Thread(target=liveness.run_flusher, args=(db,), kwargs={'on_flush': record_flush},
+                     daemon=True).start()
     
     app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,42 @@
+"""Fixtures shared by the tracker tests.
+
+server.py is run as a script from its directory, so that directory goes
+on sys.path for the tests to import it the same way.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from liveness import LivenessRegistry  # noqa: E402
+from tracker_db import TrackerDB  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Test client of a tracker with a fresh database in tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    db = TrackerDB(str(tmp_path / 'p2p.db'))
+    db.on_lock_wait = server.db.on_lock_wait
+    monkeypatch.setattr(server, 'db', db)
+    monkeypatch.setattr(server, 'liveness', LivenessRegistry(ttl=server.HEARTBEAT_TTL))
+    # Stored hashes carry their iteration count, so fewer only makes the tests faster
+    monkeypatch.setattr(server, 'PASSWORD_ITERATIONS', 1000)
+    server.init_db()
+    yield server.app.test_client()
+    db.close_all()
+
+
+@pytest.fixture
+def peer(client):
+    """register(username) signs up a live peer and returns its share_files fields"""
+    def register(username, port=6000):
+        fields = {'username': username, 'ip': '127.0.0.1', 'port': port}
+        response = client.post('/register', json=dict(fields, password='secret'))
+        assert response.status_code == 200
+        client.post('/heartbeat', json=fields)
+        return {'username': username, 'peer_ip': '127.0.0.1', 'peer_port': port}
+    return register
@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def conn(client):
+    with server.db.connection() as conn:
+        yield conn
+
+
+def add_peer(conn, username, last_heartbeat, files=2):
+    conn.execute('INSERT INTO peers (username, ip, port, last_heartbeat) VALUES (?, ?, ?, ?)',
+                 (username, '127.0.0.1', 6000, last_heartbeat))
+    conn.executemany('INSERT INTO files (filename, username) VALUES (?, ?)',
+                     [(f'{username}-{i}', username) for i in range(files)])
+    conn.commit()
+
+
+def catalog_version(conn):
+    return conn.execute('SELECT version FROM catalog_state').fetchone()[0]
+
+
+def test_stale_peers_are_removed_in_batches(conn, monkeypatch):
+    now = datetime.now()
+    for i in range(10):
+        add_peer(conn, f'old{i}', now - timedelta(seconds=300))
+    add_peer(conn, 'fresh', now)
+    version = catalog_version(conn)
+    monkeypatch.setattr(server.time, 'sleep', lambda seconds: None)
+
+    removed = server.expire_inactive_peers(conn, now - timedelta(seconds=60), batch_size=3)
+
+    assert removed == 10
+    assert [row[0] for row in conn.execute('SELECT username FROM peers')] == ['fresh']
+    assert conn.execute('SELECT COUNT(*) FROM files').fetchone()[0] == 2
+    assert catalog_version(conn) > version
+    assert not conn.in_transaction
+
+
+def test_nothing_stale(conn):
+    add_peer(conn, 'fresh', datetime.now())
+    version = catalog_version(conn)
+
+    assert server.expire_inactive_peers(conn, datetime.now() - timedelta(seconds=60)) == 0
+    assert catalog_version(conn) == version
+
+
+def test_cleanup_wakes_when_the_oldest_peer_expires(conn):
+    c = conn.cursor()
+    assert server.next_cleanup_delay(c) == server.CLEANUP_MAX_INTERVAL
+
+    add_peer(conn, 'a', datetime.now() - timedelta(seconds=server.HEARTBEAT_TTL - 10))
+    assert 5 < server.next_cleanup_delay(c) <= 10
+
+    add_peer(conn, 'b', datetime.now() - timedelta(seconds=server.HEARTBEAT_TTL + 10))
+    assert server.next_cleanup_delay(c) == server.CLEANUP_MIN_INTERVAL
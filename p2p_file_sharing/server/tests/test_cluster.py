@@ -0,0 +1,119 @@
+import pytest
+import requests
+
+import server
+from cluster import FORWARDED_HEADER, SECRET_HEADER, Cluster, HashRing
+
+NODE = 'http://node-a:5001'
+HOME = 'http://node-b:5001'
+AUTH = {SECRET_HEADER: 'secret'}
+
+
+def test_ring_gives_every_key_one_owner():
+    ring = HashRing(['http://a', 'http://b', 'http://c'])
+    keys = [f"file-{i}" for i in range(3000)]
+    parts = ring.partition(keys)
+    assert sorted(parts) == ring.nodes
+    assert sum(len(part) for part in parts.values()) == len(keys)
+    # Roughly even, with VNODES points per node
+    assert all(len(part) > len(keys) / 6 for part in parts.values())
+    assert all(ring.owner(key) == node for node, part in parts.items() for key in part)
+
+
+def test_joining_node_only_takes_keys_for_itself():
+    before = HashRing(['http://a', 'http://b', 'http://c'])
+    after = HashRing(['http://a', 'http://b', 'http://c', 'http://d'])
+    keys = [f"file-{i}" for i in range(3000)]
+    moved = [key for key in keys if before.owner(key) != after.owner(key)]
+    assert all(after.owner(key) == 'http://d' for key in moved)
+    assert len(moved) < len(keys) / 2
+
+
+def test_node_needs_a_secret():
+    with pytest.raises(ValueError):
+        Cluster(NODE, '')
+
+
+@pytest.fixture
+def node(client, monkeypatch):
+    """Make the tracker behind client a cluster of one, reached at NODE;
+    returns the list of (node, path, json) requests it sends to others"""
+    sent = []
+
+    def call(node, method, path, site=None, **kwargs):
+        sent.append((node, path, kwargs.get('json')))
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"message": "Login successful!"}'
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+    cluster = Cluster(NODE, 'secret')
+    monkeypatch.setattr(cluster, 'call', call)
+    monkeypatch.setattr(server, 'cluster', cluster)
+    server.init_db()
+    return sent
+
+
+def test_cluster_routes_need_a_cluster(client):
+    assert client.get('/cluster/status', headers=AUTH).status_code == 404
+
+
+def test_cluster_routes_need_the_secret(client, node):
+    assert client.get('/cluster/status').status_code == 403
+    assert client.get('/cluster/status', headers={SECRET_HEADER: 'guess'}).status_code == 403
+    assert client.get('/cluster/status', headers=AUTH).json['node'] == NODE
+
+
+def test_handoff_sent_twice_is_stored_once(client, node):
+    row = ['a.txt', 'alice', '127.0.0.1', 6000, '2026-01-01T00:00:00', None, None]
+    for _ in range(2):
+        response = client.post('/cluster/handoff', json={'files': [row]}, headers=AUTH)
+        assert response.status_code == 200
+    assert client.get('/cluster/status', headers=AUTH).json['rows']['files'] == 1
+
+
+def copy_account(client, username, home=HOME):
+    row = [username, '10.0.0.2', 6000, '2026-01-01T00:00:00', 0, home]
+    response = client.post('/cluster/peers', json={'peers': [row]}, headers=AUTH)
+    assert response.status_code == 200
+
+
+def test_accounts_are_copied_without_passwords(client, node, peer):
+    peer('alice')
+    copy_account(client, 'bob')
+    peers = client.get('/cluster/peers', headers=AUTH).json['peers']
+    # username, ip, port, share_version, home
+    assert sorted(row[:3] + row[4:] for row in peers) == [
+        ['alice', '127.0.0.1', 6000, 0, NODE],
+        ['bob', '10.0.0.2', 6000, 0, HOME]]
+
+
+def test_login_is_answered_by_the_home_node(client, node, peer):
+    peer('alice')
+    copy_account(client, 'bob')
+    credentials = {'password': 'secret', 'ip': '127.0.0.1', 'port': 6000}
+
+    assert client.post('/login', json=dict(credentials, username='alice')).status_code == 200
+    assert node == []
+
+    assert client.post('/login', json=dict(credentials, username='bob')).status_code == 200
+    assert node == [(HOME, '/login', dict(credentials, username='bob'))]
+
+
+def test_forwarded_login_is_not_forwarded_again(client, node):
+    copy_account(client, 'bob')
+    response = client.post('/login', headers={FORWARDED_HEADER: HOME},
+                           json={'username': 'bob', 'password': 'secret',
+                                 'ip': '127.0.0.1', 'port': 6000})
+    assert response.status_code == 401
+    assert node == []
+
+
+def test_copy_of_an_account_keeps_the_local_password(client, node, peer):
+    peer('alice')
+    copy_account(client, 'alice')
+    response = client.post('/login', json={'username': 'alice', 'password': 'secret',
+                                           'ip': '127.0.0.1', 'port': 6000})
+    assert response.status_code == 200
+    assert node == []
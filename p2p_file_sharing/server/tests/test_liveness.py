@@ -0,0 +1,140 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+from liveness import LivenessRegistry
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE peers (username TEXT PRIMARY KEY, ip TEXT, port INTEGER, '
+                 'last_heartbeat TIMESTAMP)')
+    conn.executemany('INSERT INTO peers (username) VALUES (?)', [('alice',), ('bob',)])
+    yield conn
+    conn.close()
+
+
+def test_heartbeats_are_flushed_in_one_batch(conn):
+    registry = LivenessRegistry()
+    registry.beat('alice', '10.0.0.1', 6000)
+    registry.beat('bob', '10.0.0.2', 6001)
+    registry.beat('alice', '10.0.0.3', 6002)
+
+    assert registry.flush(conn) == 2
+    assert registry.flush(conn) == 0
+    rows = dict((row[0], row[1:]) for row in conn.execute('SELECT username, ip, port FROM peers'))
+    assert rows == {'alice': ('10.0.0.3', 6002), 'bob': ('10.0.0.2', 6001)}
+
+
+def test_failed_flush_keeps_the_heartbeats(conn):
+    registry = LivenessRegistry()
+    registry.beat('alice', '10.0.0.1', 6000)
+    conn.execute('DROP TABLE peers')
+
+    with pytest.raises(sqlite3.OperationalError):
+        registry.flush(conn)
+    conn.execute('CREATE TABLE peers (username TEXT, ip TEXT, port INTEGER, last_heartbeat TIMESTAMP)')
+    assert registry.flush(conn) == 1
+
+
+def test_quiet_peers_expire_and_come_back():
+    registry = LivenessRegistry(ttl=60)
+    long_ago = datetime.now() - timedelta(seconds=120)
+    registry.beat('alice', '10.0.0.1', 6000, when=long_ago)
+    registry.beat('bob', '10.0.0.2', 6001)
+    fingerprint = registry.fingerprint()
+
+    assert registry.expired() == ['alice']
+    assert registry.knows('alice')
+
+    registry.beat('alice', '10.0.0.1', 6000)
+    assert registry.expired() == []
+    assert registry.fingerprint() != fingerprint
+
+
+def test_forget_expired_only_drops_cleaned_up_peers():
+    registry = LivenessRegistry(ttl=60)
+    registry.beat('alice', '10.0.0.1', 6000, when=datetime.now() - timedelta(seconds=300))
+    registry.beat('bob', '10.0.0.2', 6001, when=datetime.now() - timedelta(seconds=90))
+    registry.expired()
+
+    registry.forget_expired(datetime.now() - timedelta(seconds=120))
+
+    assert registry.expired() == ['bob']
+    assert not registry.knows('alice')
+
+
+def test_load_seeds_from_stored_heartbeats():
+    registry = LivenessRegistry(ttl=60)
+    recent = datetime.now().isoformat(' ')
+    registry.load([('alice', recent), ('bob', '2000-01-01 00:00:00'), ('carol', None)])
+
+    assert registry.knows('alice') and registry.expired() == ['bob']
+    assert not registry.knows('carol')
+
+
+def test_heartbeat_from_unknown_peer(client):
+    response = client.post('/heartbeat', json={'username': 'nobody', 'ip': '127.0.0.1',
+                                               'port': 6000})
+    assert response.status_code == 404
+
+
+def test_registered_peer_heartbeats_without_touching_the_table(client, peer):
+    peer('alice')
+    with server.db.connection() as conn:
+        before = conn.execute("SELECT last_heartbeat FROM peers WHERE username = 'alice'").fetchone()
+
+    response = client.post('/heartbeat', json={'username': 'alice', 'ip': '10.0.0.9', 'port': 7000})
+
+    assert response.status_code == 200
+    with server.db.connection() as conn:
+        assert conn.execute("SELECT last_heartbeat FROM peers WHERE username = 'alice'").fetchone() == before
+        server.liveness.flush(conn)
+        assert conn.execute("SELECT ip, port FROM peers WHERE username = 'alice'").fetchone() == ('10.0.0.9', 7000)
+
+
+def test_sync_takes_in_heartbeats_other_workers_flushed(conn):
+    mine, theirs = LivenessRegistry(), LivenessRegistry()
+    theirs.beat('alice', '10.0.0.1', 6000)
+    theirs.flush(conn)
+
+    since = mine.sync(conn)
+
+    assert mine.knows('alice') and mine.expired() == []
+    assert mine.flush(conn) == 0  # Read back, not ours to write
+    theirs.beat('bob', '10.0.0.2', 6001)
+    theirs.flush(conn)
+    mine.sync(conn, since)
+    assert mine.knows('bob')
+
+
+def test_flush_never_moves_a_heartbeat_back(conn):
+    mine, theirs = LivenessRegistry(), LivenessRegistry()
+    theirs.beat('alice', '10.0.0.1', 6000)
+    theirs.flush(conn)
+    mine.beat('alice', '10.0.0.9', 7000, when=datetime.now() - timedelta(seconds=30))
+
+    mine.flush(conn)
+
+    assert conn.execute("SELECT ip FROM peers WHERE username = 'alice'").fetchone() == ('10.0.0.1',)
+
+
+def test_workers_with_the_same_view_agree_on_the_fingerprint(conn):
+    mine, theirs = LivenessRegistry(ttl=60), LivenessRegistry(ttl=60)
+    theirs.beat('alice', '10.0.0.1', 6000)
+    theirs.beat('bob', '10.0.0.2', 6001, when=datetime.now() - timedelta(seconds=120))
+    theirs.flush(conn)
+    since = mine.sync(conn)
+
+    assert mine.expired() == theirs.expired() == ['bob']
+    assert mine.fingerprint() == theirs.fingerprint()
+
+    # Cleanup, in whichever process, deletes bob
+    fingerprint = mine.fingerprint()
+    conn.execute("DELETE FROM peers WHERE username = 'bob'")
+    mine.sync(conn, since)
+    assert mine.expired() == []
+    assert mine.fingerprint() != fingerprint
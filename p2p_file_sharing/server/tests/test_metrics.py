@@ -0,0 +1,131 @@
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+import server
+from metrics import Counter, Gauge, Histogram, Registry, SnapshotDir
+
+
+def samples(metric):
+    return dict(metric.samples(metric.values()))
+
+
+def test_counter_keeps_one_series_per_label_combination():
+    counter = Counter('hits_total', 'Hits', ('route', 'status'))
+    counter.inc('/a', '200')
+    counter.inc('/a', '200', amount=2)
+    counter.inc('/b', '404')
+
+    assert samples(counter) == {'hits_total{route="/a",status="200"}': 3,
+                                       'hits_total{route="/b",status="404"}': 1}
+
+
+def test_label_values_are_escaped():
+    counter = Counter('c', 'C', ('name',))
+    counter.inc('say "hi"\\\n')
+    assert list(counter.samples(counter.values())) == [(r'c{name="say \"hi\"\\\n"}', 1)]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('t', 'T', buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 7):
+        histogram.observe(value)
+
+    assert samples(histogram) == {
+        't_bucket{le="0.1"}': 2, 't_bucket{le="1"}': 3, 't_bucket{le="+Inf"}': 4,
+        't_sum': pytest.approx(7.65), 't_count': 4}
+
+
+def test_histogram_timer():
+    histogram = Histogram('t', 'T', ('op',))
+    with histogram.time('sleep'):
+        pass
+    assert samples(histogram)['t_count{op="sleep"}'] == 1
+
+
+def test_render_survives_a_broken_gauge():
+    registry = Registry()
+    registry.gauge('broken', 'Fails', lambda: 1 / 0)
+    registry.gauge('pool', 'Pool', lambda: {('open',): 3, ('idle',): 1}, ('state',))
+
+    text = registry.render()
+
+    assert '# TYPE broken gauge\n# broken unavailable: division by zero\n' in text
+    assert 'pool{state="open"} 3\npool{state="idle"} 1\n' in text
+
+
+def scrape(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    return {match[1]: float(match[2]) for match in
+            re.finditer(r'^(\S+) (\S+)$', response.get_data(as_text=True), re.M)}
+
+
+def test_requests_are_counted_by_route(client):
+    key = 'tracker_requests_total{route="/manifest/<digest>",method="GET",status="404"}'
+    before = scrape(client).get(key, 0)
+
+    client.get('/manifest/abc')
+    client.get('/manifest/def')
+
+    assert scrape(client)[key] == before + 2
+
+
+def test_write_lock_waits_are_timed_by_site(client, peer):
+    key = 'tracker_sqlite_lock_wait_seconds_count{site="register"}'
+    before = scrape(client).get(key, 0)
+
+    peer('alice')
+
+    after = scrape(client)
+    assert after[key] == before + 1
+    assert after['tracker_peers{state="live"}'] == 1
+    assert after['tracker_db_connections{state="open"}'] >= 1
+
+
+@pytest.fixture
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def make_registry(requests, peers):
+    registry = Registry()
+    registry.counter('requests_total', 'Requests').inc(amount=requests)
+    registry.register(Gauge('connections', 'Open connections', lambda: 2))
+    registry.gauge('peers', 'Live peers', lambda: peers, combine=max)
+    return registry
+
+
+def test_snapshots_of_other_processes_are_added_in(tmp_path, dead_pid):
+    for pid, requests, peers in [(os.getppid(), 10, 5), (dead_pid, 100, 9)]:
+        other = SnapshotDir(str(tmp_path), make_registry(requests, peers))
+        other.pid = pid
+        other.write()
+    (tmp_path / 'junk.json').write_text('{')
+
+    text = SnapshotDir(str(tmp_path), make_registry(1, 4)).render()
+
+    # Counters count every process ever; gauges only the running ones
+    assert 'requests_total 111\n' in text
+    assert 'connections 4\n' in text
+    assert 'peers 5\n' in text
+
+
+def test_scrape_answers_for_every_worker(client, tmp_path, monkeypatch):
+    key = 'tracker_requests_total{route="/manifest/<digest>",method="GET",status="404"}'
+    client.get('/manifest/abc')
+    # Another worker that has seen exactly what this one has
+    other = SnapshotDir(str(tmp_path), server.metrics)
+    other.pid = os.getppid()
+    other.write()
+    monkeypatch.setattr(server, 'metrics_snapshots', SnapshotDir(str(tmp_path), server.metrics))
+
+    scraped = scrape(client)[key]
+
+    assert scraped == 2 * samples(server.REQUESTS)[key]
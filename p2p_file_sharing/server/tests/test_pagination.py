@@ -0,0 +1,69 @@
+import pytest
+
+import server
+
+
+@pytest.fixture
+def catalog(client, peer):
+    fields = peer('alice')
+    client.post('/share_files', json=dict(fields, filename=[f'file{i:02}.txt' for i in range(25)]))
+    return client
+
+
+def walk(client, **query):
+    names, cursor = [], None
+    while True:
+        args = dict(query, cursor=cursor) if cursor else query
+        body = client.get('/files', query_string=args).json
+        names += [row[0] for row in body['files']]
+        cursor = body['next_cursor']
+        if cursor is None:
+            return names
+
+
+@pytest.mark.parametrize('query', [{}, {'filename': 'file'}, {'filename': 'file', 'match': 'substring'}])
+def test_pages_cover_every_row_once(catalog, query):
+    assert sorted(walk(catalog, limit=10, **query)) == [f'file{i:02}.txt' for i in range(25)]
+
+
+def test_without_a_limit_everything_comes_back(catalog):
+    body = catalog.get('/files').json
+    assert len(body['files']) == 25 and body['next_cursor'] is None
+
+
+def test_limit_is_capped(catalog, monkeypatch):
+    monkeypatch.setattr(server, 'MAX_PAGE_SIZE', 7)
+    assert len(catalog.get('/files', query_string={'limit': 100}).json['files']) == 7
+
+
+def test_invalid_cursor(catalog):
+    assert catalog.get('/files', query_string={'cursor': 'nonsense'}).status_code == 400
+
+
+def test_unchanged_listing_revalidates(catalog):
+    first = catalog.get('/files')
+    etag = first.headers['ETag']
+
+    again = catalog.get('/files', headers={'If-None-Match': etag})
+
+    assert again.status_code == 304 and again.data == b''
+    assert again.headers['ETag'] == etag
+
+
+def test_sharing_changes_the_etag(catalog, peer):
+    etag = catalog.get('/files').headers['ETag']
+    catalog.post('/share_files', json=dict(peer('bob', port=6001), filename=['new.txt']))
+
+    assert catalog.get('/files', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_etag_depends_on_the_query(catalog):
+    etag = catalog.get('/files', query_string={'filename': 'file01'}).headers['ETag']
+
+    other = catalog.get('/files', query_string={'filename': 'file02'},
+                        headers={'If-None-Match': etag})
+
+    assert other.status_code == 200
+    assert [row[0] for row in other.json['files']] == ['file02.txt']
+    # The body still reports the catalog version, which both searches share
+    assert other.json['version'] == catalog.get('/files').json['version']
@@ -0,0 +1,53 @@
+import pytest
+
+import server
+
+
+def names(response):
+    assert response.status_code == 200
+    return [row[0] for row in response.json['files']]
+
+
+@pytest.fixture
+def catalog(client, peer):
+    fields = peer('alice')
+    client.post('/share_files', json=dict(fields, filename=[
+        'Holiday Photos 2023.zip', 'holiday-video.mp4', 'report_final.pdf', 'photoshop.exe']))
+    return client
+
+
+def test_fts_index_is_in_use(catalog):
+    assert server.fts_enabled
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('holiday', ['Holiday Photos 2023.zip', 'holiday-video.mp4']),
+    ('hol pho', ['Holiday Photos 2023.zip']),  # Every word, as a prefix
+    ('photo', ['Holiday Photos 2023.zip', 'photoshop.exe']),
+    ('final', ['report_final.pdf']),
+    ('nothing', []),
+])
+def test_words_match_as_prefixes(catalog, query, expected):
+    found = names(catalog.get('/files', query_string={'filename': query}))
+    assert sorted(found) == expected
+    assert sorted(names(catalog.get('/search_files', query_string={'filename': query}))) == expected
+
+
+def test_substring_match_scans(catalog):
+    found = names(catalog.get('/files', query_string={'filename': 'liday', 'match': 'substring'}))
+    assert sorted(found) == ['Holiday Photos 2023.zip', 'holiday-video.mp4']
+
+
+def test_query_without_words_falls_back_to_substring(catalog):
+    assert names(catalog.get('/files', query_string={'filename': '-'})) == ['holiday-video.mp4']
+
+
+def test_index_follows_removed_files(catalog):
+    fields = {'username': 'alice', 'peer_ip': '127.0.0.1', 'peer_port': 6000}
+    catalog.post('/share_files', json=dict(fields, filename=['report_final.pdf']))
+    assert names(catalog.get('/files', query_string={'filename': 'holiday'})) == []
+
+
+def test_match_expression_quotes_words():
+    assert server.fts_match_expression('a "b" c*') == '"a"* AND "b"* AND "c"*'
+    assert server.fts_match_expression('__') == ''
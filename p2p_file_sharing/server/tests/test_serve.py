@@ -0,0 +1,84 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+SERVE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'serve.py')
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason="serve.py needs fork and signals")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def tracker(tmp_path):
+    """A supervisor with two workers on a fresh database, as (process, base url)"""
+    port = free_port()
+    process = subprocess.Popen([sys.executable, SERVE, '--host', '127.0.0.1', '--port', str(port),
+                                '--workers', '2', '--grace', '5', '--quiet'],
+                               cwd=tmp_path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               text=True)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while True:
+        assert process.poll() is None, process.stdout.read()
+        try:
+            requests.get(f"{base}/metrics", timeout=1)
+            break
+        except requests.ConnectionError:
+            assert time.monotonic() < deadline, "tracker did not start"
+            time.sleep(0.1)
+    yield process, base
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)  # Killing it would orphan the workers
+        try:
+            process.communicate(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+
+
+def test_workers_share_the_database(tracker):
+    _, base = tracker
+    peer = {'username': 'alice', 'password': 'secret', 'ip': '127.0.0.1', 'port': 6000}
+
+    assert requests.post(f"{base}/register", json=peer).status_code == 200
+    # Spread over both workers by the kernel; each has to see the account
+    for _ in range(10):
+        with requests.Session() as session:
+            assert session.post(f"{base}/login", json=peer).status_code == 200
+
+
+def test_reload_and_shutdown_refuse_no_requests(tracker):
+    process, base = tracker
+
+    process.send_signal(signal.SIGHUP)
+    deadline = time.monotonic() + 3
+    while time.monotonic() < deadline:
+        with requests.Session() as session:
+            assert session.get(f"{base}/metrics", timeout=5).status_code == 200
+
+    process.send_signal(signal.SIGTERM)
+    output, _ = process.communicate(timeout=15)
+    assert process.returncode == 0
+    assert "Reloading workers" in output and "did not stop in time" not in output
+
+
+@pytest.mark.parametrize('arguments', [['--workers', '0'], ['--worker-fd', '3'],
+                                       ['--node-url', 'http://127.0.0.1:5001']])
+def test_bad_arguments(arguments):
+    env = {name: value for name, value in os.environ.items()
+           if name != 'TRACKER_CLUSTER_SECRET'}
+    result = subprocess.run([sys.executable, SERVE] + arguments, capture_output=True, text=True,
+                            timeout=30, env=env)
+    assert result.returncode == 2
+    assert "error:" in result.stderr
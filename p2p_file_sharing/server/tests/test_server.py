@@ -0,0 +1,118 @@
+import hashlib
+
+import server
+
+
+def make_manifest(data, piece_size=4):
+    pieces = [hashlib.sha256(data[i:i + piece_size]).hexdigest()
+              for i in range(0, len(data), piece_size)]
+    h = hashlib.sha256(f"{len(data)}:{piece_size}:".encode())
+    for piece in pieces:
+        h.update(bytes.fromhex(piece))
+    return {'size': len(data), 'piece_size': piece_size, 'pieces': pieces,
+            'digest': h.hexdigest()}
+
+
+def test_shared_manifests_are_served_by_digest(client, peer):
+    fields = peer('alice')
+    manifest = make_manifest(b"hello world")
+    response = client.post('/share_files', json=dict(fields, filename=['a.txt', 'b.txt'],
+                                                     manifests={'a.txt': manifest}))
+    assert response.status_code == 200
+
+    rows = {row[0]: row for row in client.get('/files').json['files']}
+    assert rows['a.txt'][5:7] == [manifest['digest'], manifest['size']]
+    assert rows['b.txt'][5:7] == [None, None]
+
+    served = client.get(f"/manifest/{manifest['digest']}").json
+    assert served == manifest
+    found = client.get('/files', query_string={'digest': manifest['digest']}).json['files']
+    assert [row[0] for row in found] == ['a.txt']
+
+
+def test_inconsistent_manifest_is_refused(client, peer):
+    fields = peer('alice')
+    manifest = make_manifest(b"hello world")
+    manifest['pieces'][0] = '00' * 32
+    response = client.post('/share_files', json=dict(fields, filename=['a.txt'],
+                                                     manifests={'a.txt': manifest}))
+    assert response.status_code == 400
+
+
+def test_unknown_manifest(client):
+    assert client.get('/manifest/' + '00' * 32).status_code == 404
+
+
+def shared_names(client):
+    return sorted(row[0] for row in client.get('/files').json['files'])
+
+
+def test_deltas_apply_on_top_of_the_full_sync(client, peer):
+    fields = peer('alice')
+    version = client.post('/share_files', json=dict(fields, filename=['a', 'b'])).json['version']
+
+    response = client.post('/share_files_delta', json=dict(
+        fields, base_version=version, added=['c'], removed=['a']))
+
+    assert response.status_code == 200
+    assert response.json['version'] == version + 1
+    assert shared_names(client) == ['b', 'c']
+
+
+def test_stale_delta_needs_a_full_sync(client, peer):
+    fields = peer('alice')
+    version = client.post('/share_files', json=dict(fields, filename=['a'])).json['version']
+    delta = dict(fields, base_version=version, added=['b'], removed=[])
+    assert client.post('/share_files_delta', json=delta).status_code == 200
+
+    # A second delta on the same base must not apply
+    response = client.post('/share_files_delta', json=dict(delta, added=['c']))
+
+    assert response.status_code == 409
+    assert response.json['version'] == version + 1
+    assert shared_names(client) == ['a', 'b']
+
+
+def test_delta_for_unknown_peer(client):
+    response = client.post('/share_files_delta', json={
+        'username': 'nobody', 'peer_ip': '127.0.0.1', 'peer_port': 6000,
+        'base_version': 0, 'added': ['a']})
+    assert response.status_code == 409
+    assert response.json['version'] is None
+
+
+def stored_password(username):
+    with server.db.connection() as conn:
+        return conn.execute('SELECT password FROM peers WHERE username = ?',
+                            (username,)).fetchone()[0]
+
+
+def login(client, username, password):
+    return client.post('/login', json={'username': username, 'password': password,
+                                       'ip': '127.0.0.1', 'port': 6000}).status_code
+
+
+def test_passwords_are_stored_hashed(client, peer):
+    peer('alice')
+    stored = stored_password('alice')
+    assert stored.startswith(server.PASSWORD_SCHEME + '$') and 'secret' not in stored
+    assert login(client, 'alice', 'secret') == 200
+    assert login(client, 'alice', 'guess') == 401
+    assert stored_password('alice') == stored
+
+
+def test_password_from_before_hashing_is_hashed_on_login(client, peer):
+    peer('alice')
+    with server.db.connection() as conn:
+        conn.execute("UPDATE peers SET password = 'secret' WHERE username = 'alice'")
+        conn.commit()
+
+    assert login(client, 'alice', 'guess') == 401
+    assert stored_password('alice') == 'secret'
+    assert login(client, 'alice', 'secret') == 200
+    assert server.is_password_hash(stored_password('alice'))
+    assert login(client, 'alice', 'secret') == 200
+
+
+def test_unknown_user_cannot_log_in(client):
+    assert login(client, 'nobody', 'secret') == 401
@@ -0,0 +1,56 @@
+import threading
+
+from tracker_db import TrackerDB
+
+
+def test_connections_are_reused_and_in_wal_mode(tmp_path):
+    db = TrackerDB(str(tmp_path / 't.db'))
+    try:
+        with db.connection() as conn:
+            assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        with db.connection() as again:
+            assert again is conn
+    finally:
+        db.close_all()
+
+
+def test_uncommitted_work_is_rolled_back_on_release(tmp_path):
+    db = TrackerDB(str(tmp_path / 't.db'))
+    try:
+        with db.connection() as conn:
+            conn.execute('CREATE TABLE t (x INTEGER)')
+            conn.commit()
+            conn.execute('INSERT INTO t VALUES (1)')
+        with db.connection() as conn:
+            assert not conn.in_transaction
+            assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 0
+    finally:
+        db.close_all()
+
+
+def test_pool_keeps_at_most_pool_size_connections(tmp_path):
+    db = TrackerDB(str(tmp_path / 't.db'), pool_size=2)
+    try:
+        conns = [db.acquire() for _ in range(4)]
+        for conn in conns:
+            db.release(conn)
+        assert len(db._all) == 2
+    finally:
+        db.close_all()
+
+
+def test_connections_can_be_used_from_other_threads(tmp_path):
+    db = TrackerDB(str(tmp_path / 't.db'))
+    conn = db.acquire()
+    db.release(conn)
+    results = []
+
+    def borrow():
+        with db.connection() as conn:
+            results.append(conn.execute('SELECT 1').fetchone()[0])
+
+    thread = threading.Thread(target=borrow)
+    thread.start()
+    thread.join()
+    db.close_all()
+    assert results == [1]
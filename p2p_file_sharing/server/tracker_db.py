@@ -0,0 +1,100 @@
+"""Pooled SQLite access for the tracker.
+
+Opening a connection per request costs a file open, schema parse and cold
+page cache every time, and the default rollback journal makes readers and
+the writer block each other.  Instead, routes borrow connections from a
+small pool:
+
+* the database runs in WAL mode, so searches and heartbeats can read while
+  a share is being written;
+* ``synchronous=NORMAL`` (safe with WAL), a larger page cache, in-memory
+  temp tables and a busy timeout are set once per connection;
+* each pooled connection keeps its own prepared-statement cache, so the
+  routes' fixed SQL strings are compiled once and reused.
+
+Writers open their transaction with ``begin_write``, which takes the write
+lock up front and reports how long that took to ``on_lock_wait``.
+
+Connections are handed to one thread at a time, which is what sqlite3
+requires; they are just not tied to the thread that created them, since
+the Flask server uses a fresh thread per request.
+"""
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+PRAGMAS = (
+    # First, so that switching to WAL waits out other processes opening the file
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-65536',  # 64 MB
+    'PRAGMA temp_store=MEMORY',
+)
+
+
+class TrackerDB:
+    def __init__(self, path='p2p.db', pool_size=16, cached_statements=256):
+        self.path = path
+        self.cached_statements = cached_statements
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._lock = threading.Lock()
+        self._all = []
+        self.on_lock_wait = None  # on_lock_wait(site, seconds), if set
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        with self._lock:
+            self._all.append(conn)
+        return conn
+
+    def acquire(self):
+        """Borrow a connection; give it back with release()"""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            # Whatever the route didn't commit must not leak into the next borrower
+            conn.rollback()
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            with self._lock:
+                self._all.remove(conn)
+            conn.close()
+
+    def begin_write(self, conn, site):
+        """Start a write transaction on conn, waiting for the write lock now"""
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        if self.on_lock_wait is not None:
+            self.on_lock_wait(site, time.perf_counter() - started)
+
+    def stats(self):
+        """(connections open, connections idle in the pool)"""
+        with self._lock:
+            return len(self._all), self._pool.qsize()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        with self._lock:
+            conns, self._all = self._all, []
+        while not self._pool.empty():
+            self._pool.get_nowait()
+        for conn in conns:
+            conn.close()